@@ -19,7 +19,7 @@ transitrelay --usage=.../PATH/TO/usage.sqlite".
 """
 
 import sys
-from wormhole_transit_relay.database import open_existing_db, create_db
+from wormhole_transit_relay.database import open_existing_db, create_db, mood_code
 
 source_fn = sys.argv[1]
 source_db = open_existing_db(source_fn)
@@ -28,12 +28,16 @@ target_db = create_db("usage.sqlite")
 num_rows = 0
 for row in source_db.execute("SELECT * FROM `transit_usage`"
                              " ORDER BY `started`").fetchall():
+    waiting_time = row["waiting_time"]
     target_db.execute("INSERT INTO `usage`"
-                      " (`started`, `total_time`, `waiting_time`,"
-                      "  `total_bytes`, `result`)"
+                      " (`started`, `total_time_ms`, `waiting_time_ms`,"
+                      "  `total_bytes`, `mood`)"
                       " VALUES(?,?,?,?,?)",
-                      (row["started"], row["total_time"], row["waiting_time"],
-                       row["total_bytes"], row["result"]))
+                      (int(row["started"]),
+                       int(round((row["total_time"] or 0) * 1000)),
+                       None if waiting_time is None else int(round(waiting_time * 1000)),
+                       int(row["total_bytes"] or 0),
+                       mood_code(row["result"])))
     num_rows += 1
 target_db.execute("INSERT INTO `current`"
                   " (`rebooted`, `updated`, `connected`, `waiting`,"
@@ -0,0 +1,164 @@
+"""Measure how fast a Transit Relay moves data, and what it costs.
+
+This starts "twist transitrelay" on a local port with whatever extra
+arguments are given (e.g. --relay-backend=io_uring, or --offload-threads=2),
+connects PAIRS pairs of clients to it, and has one side of each pair send
+MB megabytes to the other as fast as the relay will take them. It prints
+the total throughput and the CPU time the relay process used, which is the
+number to compare between backends: a backend that batches well moves more
+bytes per CPU-second. It also prints the relay's peak resident memory
+and the peak kernel memory used by all TCP sockets during the run, which
+is where the socket options (--sndbuf=, --rcvbuf=, --notsent-lowat=) show
+their effect:
+
+  python misc/relay_bench.py -- --notsent-lowat=131072 --tcp-nodelay
+
+--chunk=BYTES makes the senders write (with TCP_NODELAY) in chunks of
+that size, like an application sending many small messages; compare
+with and without --relay-writev:
+
+  python misc/relay_bench.py --chunk=512 -- --relay-writev
+
+  python misc/relay_bench.py [--pairs=PAIRS] [--mb=MB] -- [RELAY ARGS..]
+
+Linux only (the CPU time and memory come from /proc).
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+CHUNK = 256 * 1024
+
+
+def relay_cpu_seconds(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def relay_peak_rss_kb(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+
+def tcp_kernel_memory_kb():
+    with open("/proc/net/sockstat") as f:
+        for line in f:
+            if line.startswith("TCP:"):
+                fields = line.split()
+                pages = int(fields[fields.index("mem") + 1])
+                return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+class PeakSampler(threading.Thread):
+    def __init__(self, sample):
+        super().__init__(daemon=True)
+        self.sample = sample
+        self.peak = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(0.05):
+            self.peak = max(self.peak, self.sample())
+
+
+def connect(port, token, side):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(b"please relay %s for side %s\n" % (token, side))
+    return s
+
+
+def expect_ok(s):
+    assert s.recv(3) == b"ok\n"
+
+
+def send(s, total, size):
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    chunk = b"\x00" * size
+    while total > 0:
+        s.sendall(chunk[:total])
+        total -= size
+    s.shutdown(socket.SHUT_WR)
+
+
+def receive(s, total):
+    buf = bytearray(CHUNK)
+    while total > 0:
+        n = s.recv_into(buf)
+        assert n, "relay closed early"
+        total -= n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=16)
+    parser.add_argument("--mb", type=int, default=256, help="per pair")
+    parser.add_argument("--chunk", type=int, default=CHUNK, help="bytes per send")
+    parser.add_argument("--port", type=int, default=4101)
+    parser.add_argument("relay_args", nargs="*")
+    args = parser.parse_args()
+
+    relay = subprocess.Popen(
+        [os.path.join(os.path.dirname(sys.executable), "twist"),
+         "transitrelay", "--port=tcp:%d:interface=127.0.0.1" % args.port]
+        + args.relay_args,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", args.port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+
+        total = args.mb * 1000 * 1000
+        pairs = []
+        for i in range(args.pairs):
+            token = b"%064d" % i
+            pairs.append((connect(args.port, token, b"1" * 16),
+                          connect(args.port, token, b"2" * 16)))
+        for a, b in pairs:
+            expect_ok(a)
+            expect_ok(b)
+
+        sampler = PeakSampler(tcp_kernel_memory_kb)
+        sampler.start()
+        cpu_before = relay_cpu_seconds(relay.pid)
+        started = time.monotonic()
+        threads = []
+        for a, b in pairs:
+            threads.append(threading.Thread(target=send, args=(a, total, args.chunk)))
+            threads.append(threading.Thread(target=receive, args=(b, total)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - started
+        cpu = relay_cpu_seconds(relay.pid) - cpu_before
+        sampler.done.set()
+        sampler.join()
+
+        moved = total * args.pairs / 1e6
+        print("%d pairs, %d MB: %.1f MB/s, relay used %.2f CPU-seconds (%.0f MB per CPU-second)"
+              % (args.pairs, moved, moved / elapsed, cpu, moved / cpu if cpu else 0))
+        print("relay peak RSS %d kB, peak TCP socket memory %d kB"
+              % (relay_peak_rss_kb(relay.pid), sampler.peak))
+        for a, b in pairs:
+            a.close()
+            b.close()
+    finally:
+        relay.terminate()
+        relay.wait()
+
+
+if __name__ == "__main__":
+    main()
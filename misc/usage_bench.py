@@ -0,0 +1,160 @@
+"""Measure how long recording usage holds up the reactor.
+
+Each connection's usage record is made while its state-machine is
+closing it, and the reactor is what every other connection is waiting
+on. This makes RECORDS of them, --rate= per second, through a
+UsageTracker with the two backends which wait for the disk: a --usage-db=
+database, and a --log-fd= file which takes --delay= milliseconds per
+record to write (like a busy disk). Meanwhile a probe asks the reactor to
+call it back every millisecond, and notes how late each call is: that
+is how long any other connection would have waited for its turn.
+
+It does this three ways:
+
+* synchronous: each record() gives the record to the backends right
+  away (as the relay used to)
+* reactor: records are queued, and delivered from the reactor a few at
+  a time
+* thread: records are queued, and written in batches by a worker
+  thread (as the relay does now)
+
+and prints how long the record() calls and the reactor's turns took:
+
+  python misc/usage_bench.py [--records=RECORDS] [--rate=PER_SECOND] [--delay=MS]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer, task
+
+from wormhole_transit_relay.database import get_db
+from wormhole_transit_relay.usage import (
+    UsageTracker,
+    DatabaseUsageRecorder,
+    LogFileUsageRecorder,
+)
+
+# seconds between the probe's calls
+PROBE_INTERVAL = 0.001
+# seconds between bursts of records
+BURST_INTERVAL = 0.01
+
+
+class SlowFile(object):
+    """
+    A file which takes ``delay`` seconds to write each line.
+    """
+
+    def __init__(self, f, delay):
+        self._f = f
+        self._delay = delay
+
+    def write(self, data):
+        time.sleep(self._delay * data.count("\n"))
+        self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class TurnProbe(object):
+    """
+    Notes how late the reactor runs a call scheduled every
+    PROBE_INTERVAL seconds.
+    """
+
+    def __init__(self, reactor):
+        self._reactor = reactor
+        self._call = None
+        self.lateness = []
+
+    def start(self):
+        self._schedule()
+
+    def _schedule(self):
+        self._due = time.perf_counter() + PROBE_INTERVAL
+        self._call = self._reactor.callLater(PROBE_INTERVAL, self._fired)
+
+    def _fired(self):
+        self.lateness.append(max(0.0, time.perf_counter() - self._due))
+        self._schedule()
+
+    def stop(self):
+        self._call.cancel()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+@defer.inlineCallbacks
+def run(reactor, mode, records, rate, delay, basedir):
+    db = get_db(os.path.join(basedir, mode + ".sqlite"))
+    log_file = SlowFile(open(os.path.join(basedir, mode + ".log"), "w"), delay)
+    tracker = UsageTracker(blur_usage=None, reactor=None if mode == "synchronous" else reactor)
+    for backend in (DatabaseUsageRecorder(db), LogFileUsageRecorder(log_file)):
+        if mode == "reactor":
+            backend.blocking = False
+        tracker.add_backend(backend)
+
+    probe = TurnProbe(reactor)
+    probe.start()
+    latencies = []
+    per_burst = max(1, int(rate * BURST_INTERVAL))
+    made = 0
+    while made < records:
+        for _ in range(min(per_burst, records - made)):
+            start = time.perf_counter()
+            tracker.record(started=time.time(), buddy_started=None, result="happy",
+                           bytes_sent=made, buddy_bytes=None)
+            latencies.append(time.perf_counter() - start)
+            made += 1
+        yield task.deferLater(reactor, BURST_INTERVAL, lambda: None)
+    # let the queues drain at their own pace, then wait for the last batch
+    while sum(len(queue) for queue in tracker._queues):
+        yield task.deferLater(reactor, BURST_INTERVAL, lambda: None)
+    yield tracker.flush()
+    probe.stop()
+    db.close()
+    log_file.close()
+    return sorted(latencies), sorted(probe.lateness)
+
+
+def _summary(values):
+    return "median {:8.1f}us  p99 {:8.1f}us  max {:8.1f}us".format(
+        percentile(values, 0.5) * 1e6,
+        percentile(values, 0.99) * 1e6,
+        values[-1] * 1e6,
+    )
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--rate", type=int, default=1000,
+                        help="records per second")
+    parser.add_argument("--delay", type=float, default=0.5,
+                        help="milliseconds the log file takes per record")
+    args = parser.parse_args()
+
+    basedir = tempfile.mkdtemp()
+    try:
+        for mode in ("synchronous", "reactor", "thread"):
+            latencies, lateness = yield run(reactor, mode, args.records, args.rate,
+                                            args.delay / 1000.0, basedir)
+            print("{:12} record():      {}".format(mode, _summary(latencies)))
+            print("{:12} reactor turns: {}".format("", _summary(lateness)))
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == "__main__":
+    task.react(main)
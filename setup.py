@@ -17,6 +17,11 @@ setup(name="magic-wormhole-transit-relay",
                 "twisted.plugins",
                 ],
       package_data={"wormhole_transit_relay": ["db-schemas/*.sql"]},
+      entry_points={
+          "console_scripts": [
+              "wormhole-transit-munin = wormhole_transit_relay.munin:main",
+          ],
+      },
       install_requires=[
           "twisted >= 21.2.0",
           "autobahn >= 21.3.1",
@@ -1,5 +1,8 @@
 import os
+import time
 import sqlite3
+import calendar
+import datetime
 import tempfile
 from pkg_resources import resource_string
 from twisted.python import log
@@ -12,12 +15,35 @@ def get_schema(version):
                                    "db-schemas/v%d.sql" % version)
     return schema_bytes.decode("utf-8")
 
-## def get_upgrader(new_version):
-##     schema_bytes = resource_string("wormhole_transit_relay",
-##                                    "db-schemas/upgrade-to-v%d.sql" % new_version)
-##     return schema_bytes.decode("utf-8")
+def get_upgrader_script(new_version):
+    schema_bytes = resource_string("wormhole_transit_relay",
+                                   "db-schemas/upgrade-to-v%d.sql" % new_version)
+    return schema_bytes.decode("utf-8")
+
+TARGET_VERSION = 5
+
+# Integer codes for the `mood` column (schema v2 and later). Never
+# renumber these, only append new moods. Anything unrecognized is
+# recorded as "unknown".
+MOODS = (
+    "unknown",
+    "happy",
+    "lonely",
+    "errory",
+    "redundant",
+    "impatient",
+    "jilted",
+    "empty",
+    "idle",
+    "evicted",
+)
+MOOD_CODES = dict((name, code) for (code, name) in enumerate(MOODS))
 
-TARGET_VERSION = 1
+def mood_code(mood):
+    return MOOD_CODES.get(mood, 0)
+
+# rows copied per transaction when upgrading a large `usage` table
+UPGRADE_BATCH_SIZE = 10000
 
 def dict_factory(cursor, row):
     d = {}
@@ -30,11 +56,26 @@ def _initialize_db_schema(db, target_version):
     """
     log.msg("populating new database with schema v%s" % target_version)
     schema = get_schema(target_version)
+    # this only takes effect before the first table is created; it lets
+    # the retention code hand freed pages back with incremental_vacuum
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
     db.executescript(schema)
     db.execute("INSERT INTO version (version) VALUES (?)",
                (target_version,))
     db.commit()
 
+def _sync_moods(db):
+    """Make sure every mood we know about has a row in `moods`, so external
+    tools can turn the codes back into names.
+    """
+    known = set(row["mood"] for row in db.execute("SELECT `mood` FROM `moods`"))
+    missing = [(code, name) for (code, name) in enumerate(MOODS)
+               if code not in known]
+    if missing:
+        db.executemany("INSERT INTO `moods` (`mood`, `name`) VALUES (?,?)",
+                       missing)
+        db.commit()
+
 def _initialize_db_connection(db):
     """Sets up the db connection object with a row factory and with necessary
     foreign key settings.
@@ -94,24 +135,126 @@ def get_db(dbfile, target_version=TARGET_VERSION):
 
     version = db.execute("SELECT version FROM version").fetchone()["version"]
 
-    ## while version < target_version:
-    ##     log.msg(" need to upgrade from %s to %s" % (version, target_version))
-    ##     try:
-    ##         upgrader = get_upgrader(version+1)
-    ##     except ValueError: # ResourceError??
-    ##         log.msg(" unable to upgrade %s to %s" % (version, version+1))
-    ##         raise DBError("Unable to upgrade %s to version %s, left at %s"
-    ##                       % (dbfile, version+1, version))
-    ##     log.msg(" executing upgrader v%s->v%s" % (version, version+1))
-    ##     db.executescript(upgrader)
-    ##     db.commit()
-    ##     version = version+1
+    while version < target_version:
+        log.msg(" need to upgrade from %s to %s" % (version, target_version))
+        try:
+            upgrader = get_upgrader(version+1)
+        except EnvironmentError:
+            log.msg(" unable to upgrade %s to %s" % (version, version+1))
+            raise DBError("Unable to upgrade %s to version %s, left at %s"
+                          % (dbfile, version+1, version))
+        log.msg(" executing upgrader v%s->v%s" % (version, version+1))
+        upgrader(db)
+        db.commit()
+        version = version+1
 
     if version != target_version:
         raise DBError("Unable to handle db version %s" % version)
 
+    if version >= 2:
+        _sync_moods(db)
     return db
 
+def _run_upgrade_script(db, new_version):
+    db.executescript(get_upgrader_script(new_version))
+
+def _mood_case(column):
+    """SQL expression turning a v1 mood name into its v2 code."""
+    return "CASE %s %s ELSE 0 END" % (
+        column,
+        " ".join("WHEN '%s' THEN %d" % (name, code)
+                 for (name, code) in MOOD_CODES.items()),
+    )
+
+def _copy_in_batches(db, source, target, columns, batch_size):
+    """Copy `source` into `target` a batch of rows (in rowid order) per
+    transaction, keeping the rowids. If a previous attempt was interrupted,
+    this picks up after the last row it committed.
+    """
+    last = db.execute("SELECT MAX(`rowid`) AS `last` FROM `%s`" % target
+                      ).fetchone()["last"]
+    if last is None:
+        last = 0
+    while True:
+        with db:
+            cursor = db.execute(
+                "INSERT INTO `%s` (`rowid`, %s)"
+                " SELECT `rowid`, %s FROM `%s`"
+                " WHERE `rowid` > ? ORDER BY `rowid` LIMIT ?"
+                % (target, ", ".join("`%s`" % c for (c, _) in columns),
+                   ", ".join(expr for (_, expr) in columns), source),
+                (last, batch_size)
+            )
+        if cursor.rowcount < batch_size:
+            return
+        last = db.execute("SELECT MAX(`rowid`) AS `last` FROM `%s`" % target
+                          ).fetchone()["last"]
+
+def _upgrade_to_v2(db, batch_size=None):
+    """v1 -> v2: integer mood codes, explicit millisecond durations, and one
+    covering index instead of two.
+
+    The `usage` table can be very large, so it is copied into its new shape
+    in bounded batches (each its own transaction) rather than with a single
+    statement, and the old table is only swapped out at the very end.
+    """
+    if batch_size is None:
+        batch_size = UPGRADE_BATCH_SIZE
+    _run_upgrade_script(db, 2)
+    _sync_moods(db)
+
+    _copy_in_batches(db, "usage", "usage_v2", [
+        ("started", "CAST(`started` AS INTEGER)"),
+        ("total_time_ms", "CAST(ROUND(COALESCE(`total_time`, 0) * 1000) AS INTEGER)"),
+        ("waiting_time_ms", "CAST(ROUND(`waiting_time` * 1000) AS INTEGER)"),
+        ("total_bytes", "CAST(COALESCE(`total_bytes`, 0) AS INTEGER)"),
+        ("mood", _mood_case("`result`")),
+    ], batch_size)
+
+    had_rollups = db.execute("SELECT COUNT() AS `n` FROM `sqlite_master`"
+                             " WHERE `type`='table' AND `name`='usage_rollups'"
+                             ).fetchone()["n"]
+
+    db.execute("BEGIN")
+    if had_rollups:
+        # --usage-retention used these before there was a v2 schema: they
+        # have one row per day and mood, so there are few enough of them
+        # to copy in one go
+        db.execute(
+            "INSERT OR REPLACE INTO `usage_rollups_v2`"
+            " (`day`, `mood`, `connections`, `total_bytes`,"
+            "  `total_time_ms`, `waiting_time_ms`)"
+            " SELECT `day`, %s, `connections`, `total_bytes`,"
+            "  CAST(ROUND(`total_time` * 1000) AS INTEGER),"
+            "  CAST(ROUND(`waiting_time` * 1000) AS INTEGER)"
+            " FROM `usage_rollups`" % _mood_case("`result`")
+        )
+        db.execute("DROP TABLE `usage_rollups`")
+    db.execute("DROP TABLE `usage`")
+    db.execute("ALTER TABLE `usage_v2` RENAME TO `usage`")
+    db.execute("ALTER TABLE `usage_rollups_v2` RENAME TO `usage_rollups`")
+    db.execute("CREATE INDEX `usage_started_mood_index`"
+               " ON `usage` (`started`, `mood`, `total_bytes`)")
+    db.execute("UPDATE `version` SET `version` = 2")
+    db.commit()
+
+_UPGRADERS = {
+    2: _upgrade_to_v2,
+}
+
+def get_upgrader(new_version):
+    """Return a function that takes a db connection at version
+    ``new_version - 1`` and upgrades it to ``new_version``. Most upgrades
+    are just an ``upgrade-to-vN.sql`` script; the ones that have to move a
+    lot of rows around are written in Python.
+
+    Raises EnvironmentError if we don't know how to get to that version.
+    """
+    if new_version in _UPGRADERS:
+        return _UPGRADERS[new_version]
+    get_upgrader_script(new_version) # raises if there isn't one
+    return lambda db: _run_upgrade_script(db, new_version)
+
 class DBDoesntExist(Exception):
     pass
 
@@ -121,6 +264,12 @@ def open_existing_db(dbfile):
         raise DBDoesntExist()
     return _open_db_connection(dbfile)
 
+def db_filename(db):
+    """Return the path of the file behind the connection ``db``, or None if
+    it is an in-memory database.
+    """
+    return db.execute("PRAGMA database_list").fetchone()["file"] or None
+
 class DBAlreadyExists(Exception):
     pass
 
@@ -136,8 +285,191 @@ def create_db(dbfile):
         raise DBAlreadyExists()
     else:
         db = _atomic_create_and_initialize_db(dbfile, TARGET_VERSION)
+    _sync_moods(db)
     return db
 
+# --usage-db-partition periods
+PERIODS = ("day", "week", "month")
+_DAY = 24*60*60
+
+def partition_bounds(timestamp, period):
+    """Return (start, end) of the UTC day/week/month containing
+    ``timestamp``, as integer seconds since the epoch. Weeks start on
+    Monday.
+    """
+    t = time.gmtime(int(timestamp))
+    day = calendar.timegm((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0))
+    if period == "day":
+        return day, day + _DAY
+    if period == "week":
+        start = day - t.tm_wday*_DAY
+        return start, start + 7*_DAY
+    if period == "month":
+        start = calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+        year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+        return start, calendar.timegm((year, month, 1, 0, 0, 0))
+    raise ValueError("unknown partition period %r" % (period,))
+
+def partition_filename(dbfile, start, period):
+    """``usage.sqlite`` -> ``usage.2024-11.sqlite`` (for a month), or
+    ``usage.2024-11-06.sqlite`` / ``usage.2024-W45.sqlite`` for a day/week
+    """
+    base, ext = os.path.splitext(os.path.basename(dbfile))
+    if period == "month":
+        label = time.strftime("%Y-%m", time.gmtime(start))
+    elif period == "week":
+        date = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+        year, week, _ = date.isocalendar()
+        label = "%04d-W%02d" % (year, week)
+    else:
+        label = time.strftime("%Y-%m-%d", time.gmtime(start))
+    return "%s.%s%s" % (base, label, ext)
+
+class PartitionedDB(object):
+    """A usage database split by time: ``index`` is a normal database
+    (holding `current`, the rollups, and the list of `partitions`), and the
+    `usage` rows for each period go into a separate database file next to
+    it. Dropping old data is then just a matter of deleting files, and a
+    query for a time range only has to open the partitions that overlap it.
+    """
+
+    # partitions we keep open for writing: the current period, and the
+    # previous one (connections which started before a period boundary
+    # are recorded after it)
+    MAX_OPEN = 2
+
+    def __init__(self, dbfile, period, index):
+        if period not in PERIODS:
+            raise ValueError("unknown partition period %r" % (period,))
+        self.dbfile = dbfile
+        self.period = period
+        self.index = index
+        self._open = {} # start -> db connection, oldest first
+
+    def partition_path(self, filename):
+        return os.path.join(os.path.dirname(self.dbfile), filename)
+
+    def partition_for(self, timestamp):
+        """Return the db connection for the partition holding
+        ``timestamp``, creating it if necessary.
+        """
+        start, end = partition_bounds(timestamp, self.period)
+        db = self._open.get(start)
+        if db is None:
+            row = self.index.execute("SELECT `filename` FROM `partitions`"
+                                     " WHERE `start`=?", (start,)).fetchone()
+            if row is None:
+                filename = partition_filename(self.dbfile, start, self.period)
+                db = get_db(self.partition_path(filename))
+                self.index.execute("INSERT INTO `partitions`"
+                                   " (`start`, `end`, `filename`) VALUES (?,?,?)",
+                                   (start, end, filename))
+                self.index.commit()
+            else:
+                db = get_db(self.partition_path(row["filename"]))
+            self._open[start] = db
+            while len(self._open) > self.MAX_OPEN:
+                # (never the one we are about to return, however old)
+                oldest = self._open.pop(min(s for s in self._open if s != start))
+                oldest.commit()
+                oldest.close()
+        return db
+
+    def commit(self):
+        """Commit whatever was written to the open partitions.
+        """
+        for db in self._open.values():
+            db.commit()
+
+    def open_partitions(self):
+        """Return the set of starts of the partitions we have open.
+        """
+        return set(self._open)
+
+    def close_partition(self, start):
+        """Commit and close the partition beginning at ``start``, if we
+        have it open (so it can be dropped).
+        """
+        db = self._open.pop(start, None)
+        if db is not None:
+            try:
+                db.commit()
+            finally:
+                db.close()
+
+    def partitions(self, start=None, end=None):
+        """Return a list of (start, end, path) for each partition which
+        overlaps the time range [start, end), oldest first. Either bound may
+        be None.
+        """
+        rows = self.index.execute(
+            "SELECT `start`, `end`, `filename` FROM `partitions`"
+            " WHERE `end` > ? AND `start` < ? ORDER BY `start`",
+            (start if start is not None else -2**62,
+             end if end is not None else 2**62)
+        ).fetchall()
+        return [(r["start"], r["end"], self.partition_path(r["filename"]))
+                for r in rows]
+
+    def execute(self, sql, params=(), start=None, end=None):
+        """Run a query against each partition overlapping [start, end) and
+        yield all the result rows. The query itself must still restrict
+        `started` if only part of a partition is wanted.
+        """
+        for (p_start, _, path) in self.partitions(start, end):
+            db = self._open.get(p_start)
+            if db is not None:
+                for row in db.execute(sql, params):
+                    yield row
+            elif os.path.exists(path):
+                db = open_existing_db(path)
+                try:
+                    for row in db.execute(sql, params):
+                        yield row
+                finally:
+                    db.close()
+
+    def close(self):
+        for db in self._open.values():
+            db.close()
+        self._open.clear()
+        self.index.close()
+
+def get_partitioned_db(dbfile, period):
+    """Open or create a time-partitioned usage database, with its index at
+    ``dbfile``. Returns a PartitionedDB, or raises DBError.
+    """
+    assert dbfile != ":memory:"
+    return PartitionedDB(dbfile, period, get_db(dbfile))
+
+def stats_history(db, start, end, step=None):
+    """Read the `stats_history` between ``start`` (inclusive) and ``end``
+    (exclusive), for charting the relay's load over that time.
+
+    With ``step`` (in seconds), the points are averaged into one for each
+    ``step`` seconds, whose `updated` is the start of that step; otherwise
+    every stored point is returned. Each point is a dict with `updated`,
+    `connected`, `waiting` and `incomplete_bytes`, oldest first.
+    """
+    if step is None:
+        return db.execute(
+            "SELECT `updated`, `connected`, `waiting`, `incomplete_bytes`"
+            " FROM `stats_history` WHERE `updated` >= ? AND `updated` < ?"
+            " ORDER BY `updated`",
+            (start, end)
+        ).fetchall()
+    step = int(step)
+    # (rows that were downsampled stand for `points` snapshots each)
+    return db.execute(
+        "SELECT `updated` / ? * ? AS `updated`,"
+        " 1.0 * SUM(`connected` * `points`) / SUM(`points`) AS `connected`,"
+        " 1.0 * SUM(`waiting` * `points`) / SUM(`points`) AS `waiting`,"
+        " 1.0 * SUM(`incomplete_bytes` * `points`) / SUM(`points`) AS `incomplete_bytes`"
+        " FROM `stats_history` WHERE `updated` >= ? AND `updated` < ?"
+        " GROUP BY 1 ORDER BY 1",
+        (step, step, start, end)
+    ).fetchall()
+
 def dump_db(db):
     # to let _iterdump work, we need to restore the original row factory
     orig = db.row_factory
@@ -0,0 +1,31 @@
+-- First half of the v1->v2 upgrade: new tables are created alongside the
+-- old ones. The rows are then copied over in batches (see
+-- database._upgrade_to_v2), and the old tables are only replaced by the
+-- new ones (and the version bumped) once everything has been copied. So
+-- this must be safe to run again if an upgrade was interrupted.
+
+CREATE TABLE IF NOT EXISTS `moods`
+(
+ `mood` INTEGER PRIMARY KEY,
+ `name` VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS `usage_v2`
+(
+ `started` INTEGER NOT NULL, -- seconds since epoch (UTC), rounded to "blur time"
+ `total_time_ms` INTEGER NOT NULL, -- milliseconds from open to last close
+ `waiting_time_ms` INTEGER, -- ms from start to 2nd side appearing, or NULL
+ `total_bytes` INTEGER NOT NULL, -- total bytes relayed (both directions)
+ `mood` INTEGER NOT NULL -- see `moods`
+);
+
+CREATE TABLE IF NOT EXISTS `usage_rollups_v2`
+(
+ `day` INTEGER NOT NULL, -- seconds since epoch of the start of the (UTC) day
+ `mood` INTEGER NOT NULL,
+ `connections` INTEGER NOT NULL, -- number of `usage` rows summarized
+ `total_bytes` INTEGER NOT NULL, -- sums over those rows
+ `total_time_ms` INTEGER NOT NULL,
+ `waiting_time_ms` INTEGER NOT NULL,
+ PRIMARY KEY (`day`, `mood`)
+) WITHOUT ROWID;
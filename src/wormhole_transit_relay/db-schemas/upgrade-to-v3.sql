@@ -0,0 +1,9 @@
+
+CREATE TABLE `partitions` -- with --usage-db-partition, `usage` rows live in these files
+(
+ `start` INTEGER PRIMARY KEY, -- seconds since epoch (UTC) of the start of the period
+ `end` INTEGER NOT NULL, -- seconds since epoch of the start of the next period
+ `filename` VARCHAR NOT NULL -- in the same directory as this database
+);
+
+UPDATE `version` SET `version` = 3;
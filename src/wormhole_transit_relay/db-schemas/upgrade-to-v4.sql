@@ -0,0 +1,16 @@
+
+ALTER TABLE `usage` ADD COLUMN `weight` INTEGER NOT NULL DEFAULT 1;
+
+DROP INDEX `usage_started_mood_index`;
+CREATE INDEX `usage_started_mood_index` ON `usage` (`started`, `mood`, `total_bytes`, `weight`);
+
+CREATE TABLE `usage_totals` -- exact counts, even when `usage` is sampled
+(
+ `updated` INTEGER NOT NULL, -- when these were written; they cover the time since the previous row
+ `mood` INTEGER NOT NULL,
+ `connections` INTEGER NOT NULL,
+ `total_bytes` INTEGER NOT NULL,
+ PRIMARY KEY (`updated`, `mood`)
+) WITHOUT ROWID;
+
+UPDATE `version` SET `version` = 4;
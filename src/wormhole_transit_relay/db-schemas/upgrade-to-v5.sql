@@ -0,0 +1,10 @@
+CREATE TABLE `stats_history` -- every `current` that was written, oldest first
+(
+ `updated` INTEGER PRIMARY KEY, -- as in `current`
+ `points` INTEGER NOT NULL DEFAULT 1, -- snapshots averaged into this row (see --stats-history-downsample)
+ `connected` INTEGER NOT NULL,
+ `waiting` INTEGER NOT NULL,
+ `incomplete_bytes` INTEGER NOT NULL
+) WITHOUT ROWID;
+
+UPDATE `version` SET `version` = 5;
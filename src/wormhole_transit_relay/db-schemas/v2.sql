@@ -0,0 +1,49 @@
+
+CREATE TABLE `version` -- contains one row
+(
+ `version` INTEGER -- set to 2
+);
+
+
+CREATE TABLE `current` -- contains one row
+(
+ `rebooted` INTEGER, -- seconds since epoch of most recent reboot
+ `updated` INTEGER, -- when `current` was last updated
+ `connected` INTEGER, -- number of current paired connections
+ `waiting` INTEGER, -- number of not-yet-paired connections
+ `incomplete_bytes` INTEGER -- bytes sent through not-yet-complete connections
+);
+
+CREATE TABLE `moods` -- names for the integer `mood` codes used below
+(
+ `mood` INTEGER PRIMARY KEY,
+ `name` VARCHAR NOT NULL -- happy, lonely, errory, redundant, ...
+ -- transit moods:
+ --  "errory": one side gave the wrong handshake
+ --  "lonely": good handshake, but the other side never showed up
+ --  "redundant": good handshake, abandoned in favor of different connection
+ --  "happy": both sides gave correct handshake
+);
+
+CREATE TABLE `usage`
+(
+ `started` INTEGER NOT NULL, -- seconds since epoch (UTC), rounded to "blur time"
+ `total_time_ms` INTEGER NOT NULL, -- milliseconds from open to last close
+ `waiting_time_ms` INTEGER, -- ms from start to 2nd side appearing, or NULL
+ `total_bytes` INTEGER NOT NULL, -- total bytes relayed (both directions)
+ `mood` INTEGER NOT NULL -- see `moods`
+);
+-- covers the time-range (+ mood) counts and byte sums without touching
+-- the table itself
+CREATE INDEX `usage_started_mood_index` ON `usage` (`started`, `mood`, `total_bytes`);
+
+CREATE TABLE `usage_rollups` -- `usage` rows removed by --usage-retention
+(
+ `day` INTEGER NOT NULL, -- seconds since epoch of the start of the (UTC) day
+ `mood` INTEGER NOT NULL,
+ `connections` INTEGER NOT NULL, -- number of `usage` rows summarized
+ `total_bytes` INTEGER NOT NULL, -- sums over those rows
+ `total_time_ms` INTEGER NOT NULL,
+ `waiting_time_ms` INTEGER NOT NULL,
+ PRIMARY KEY (`day`, `mood`)
+) WITHOUT ROWID;
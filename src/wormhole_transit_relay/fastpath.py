@@ -0,0 +1,191 @@
+"""
+A cheaper read path for paired TCP connections.
+
+Twisted's tcp.Connection.doRead allocates a new ``bytes`` for every read
+(of at most 64KiB), which for a relay moving gigabits per second is a
+lot of allocator and garbage-collector work for data we only pass
+along. Once both halves of a pair are plain TCP connections, a
+RelayReader takes over their ``doRead``: it reads, with ``recv_into``,
+into a single preallocated buffer (shared by every relaying connection,
+since everything happens on the reactor thread) and hands our protocol
+a ``memoryview`` of it.
+
+That view is only valid until the next read, so whatever receives it
+must be done with it before returning. ``send_view`` does that for the
+partner's side: if nothing is queued on the partner's transport it
+writes the view straight to the partner's socket, and only copies the
+part the kernel didn't take into a ``bytes`` for the transport's usual
+write buffer.
+
+When a receiver is slower than its sender, the partner's transport
+queues many chunks, which Twisted's doWrite joins into one ``bytes``
+before each ``send``. A VectoredWriter replaces that doWrite for paired
+TCP connections with one ``sendmsg`` of all the queued chunks (up to
+IOV_MAX of them), so there is no join copy and one system call per
+writable event.
+"""
+
+import os
+from errno import EWOULDBLOCK, ENOBUFS
+
+from twisted.internet import main
+
+READ_SIZE = 256 * 1024
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError): # pragma: nocover
+    IOV_MAX = 16 # pragma: nocover
+if IOV_MAX <= 0: # pragma: nocover
+    IOV_MAX = 16 # pragma: nocover
+
+
+class RelayReader(object):
+    """
+    I read relayed data for every paired TCP connection, into one
+    buffer of ``read_size`` bytes.
+    """
+
+    def __init__(self, read_size=READ_SIZE):
+        self.read_size = read_size
+        self._buffer = bytearray(read_size)
+        self._view = memoryview(self._buffer)
+        # counters, for tests and benchmarks
+        self.reads = 0
+        self.direct_bytes = 0
+        self.copied_bytes = 0
+
+    def install(self, protocol):
+        """
+        Make ``protocol`` (a TransitConnection, now paired) read through
+        me. Transports that aren't real sockets are left alone.
+        """
+        transport = protocol.transport
+        if getattr(transport, "socket", None) is None:
+            return
+        original = transport.doRead
+
+        def doRead():
+            if protocol.line_mode:
+                # still handshaking: let LineReceiver see the bytes
+                return original()
+            return self._read(transport, protocol)
+        transport.doRead = doRead
+
+    def _read(self, transport, protocol):
+        try:
+            count = transport.socket.recv_into(self._buffer)
+        except OSError as se:
+            if se.args[0] == EWOULDBLOCK:
+                return
+            return main.CONNECTION_LOST
+        if not count:
+            return main.CONNECTION_DONE
+        self.reads += 1
+        protocol.rawDataReceived(self._view[:count])
+
+    def send_view(self, transport, view):
+        """
+        Write ``view`` (which will be overwritten by the next read) to
+        ``transport``, directly to its socket if nothing is queued ahead
+        of it.
+
+        :returns bytes: a copy of whatever still needs to go through
+            ``transport.write()``
+        """
+        sock = getattr(transport, "socket", None)
+        if (sock is None or not transport.connected or transport.disconnecting
+                or transport.dataBuffer or transport._tempDataBuffer):
+            self.copied_bytes += len(view)
+            return bytes(view)
+        try:
+            sent = sock.send(view)
+        except OSError:
+            # including EWOULDBLOCK: the transport's own write path will
+            # notice (and report) whatever is wrong with the socket
+            sent = 0
+        self.direct_bytes += sent
+        self.copied_bytes += len(view) - sent
+        return bytes(view[sent:])
+
+
+class VectoredWriter(object):
+    """
+    I write the queued data of every paired TCP connection with
+    ``sendmsg``, keeping the transport's buffers and producer
+    bookkeeping exactly as its own doWrite would.
+    """
+
+    def __init__(self):
+        # counters, for tests and benchmarks
+        self.calls = 0
+        self.chunks = 0
+
+    def install(self, protocol):
+        """
+        Make ``protocol``'s transport write through me. Transports that
+        aren't real sockets, or platforms without ``sendmsg``, are left
+        alone.
+        """
+        transport = protocol.transport
+        sock = getattr(transport, "socket", None)
+        if sock is None or not hasattr(sock, "sendmsg"):
+            return
+        transport.doWrite = lambda: self._write(transport)
+
+    def _write(self, t):
+        chunks = []
+        remaining = len(t.dataBuffer) - t.offset
+        if remaining:
+            chunks.append(memoryview(t.dataBuffer)[t.offset:])
+        chunks.extend(t._tempDataBuffer[:IOV_MAX - len(chunks)])
+        if chunks:
+            try:
+                sent = t.socket.sendmsg(chunks)
+            except OSError as se:
+                if se.args[0] not in (EWOULDBLOCK, ENOBUFS):
+                    return main.CONNECTION_LOST
+                sent = 0
+            self.calls += 1
+            self.chunks += len(chunks)
+            self._consume(t, sent, remaining)
+
+        if t.offset == len(t.dataBuffer) and not t._tempDataLen:
+            # everything is written: the same as FileDescriptor.doWrite
+            t.dataBuffer = b""
+            t.offset = 0
+            t.stopWriting()
+            if t.producer is not None and (
+                (not t.streamingProducer) or t.producerPaused
+            ):
+                t.producerPaused = False
+                t.producer.resumeProducing()
+            elif t.disconnecting:
+                return t._postLoseConnection()
+            elif t._writeDisconnecting:
+                t._writeDisconnected = True
+                return t._closeWriteConnection()
+        return None
+
+    def _consume(self, t, sent, remaining):
+        """
+        Account for ``sent`` bytes written from the front of ``t``'s
+        buffers. A partly-written chunk becomes the new ``dataBuffer``.
+        """
+        if sent < remaining:
+            t.offset += sent
+            return
+        sent -= remaining
+        t.dataBuffer = b""
+        t.offset = 0
+        done = 0
+        for chunk in t._tempDataBuffer:
+            if sent <= 0:
+                break
+            done += 1
+            t._tempDataLen -= len(chunk)
+            if sent < len(chunk):
+                t.dataBuffer = chunk
+                t.offset = sent
+            sent -= len(chunk)
+        del t._tempDataBuffer[:done]
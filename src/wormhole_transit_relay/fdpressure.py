@@ -0,0 +1,133 @@
+"""
+Making room when we are about to run out of file descriptors.
+
+increase_rlimits() raises RLIMIT_NOFILE, but a busy relay can still
+reach it, and then ``accept()`` fails for everybody: including the
+second sides that would complete a pair (and free up a waiting
+connection by doing so). An FdMonitor keeps an estimate of how many
+descriptors are open, and once that passes ``high_water`` (a fraction of
+the limit) it closes the oldest lonely connections in PendingRequests
+(the ones that have waited longest for a partner that may never come)
+until we are back down to ``low_water``.
+
+The estimate is the number of open connections (counted as they come
+and go) plus a baseline for everything else (listening ports, log files,
+the usage database, offload pipes). The baseline is only re-measured,
+from /proc/self/fd, when the estimate says we are over the high-water
+mark (and then at most once per RECOUNT connections), so the common case
+costs a couple of additions per connection.
+"""
+
+import os
+
+try:
+    # 'resource' is unix-only
+    from resource import getrlimit, RLIMIT_NOFILE
+except ImportError: # pragma: nocover
+    getrlimit, RLIMIT_NOFILE = None, None # pragma: nocover
+from twisted.python import log
+
+
+def count_open_fds():
+    """
+    :returns: the number of file descriptors this process has open, or
+        None if we can't tell
+    """
+    for directory in ("/proc/self/fd", "/dev/fd"):
+        try:
+            # (minus the one listdir itself opened)
+            return len(os.listdir(directory)) - 1
+        except OSError:
+            continue
+    return None
+
+
+def fd_limit():
+    """
+    :returns: the soft RLIMIT_NOFILE, or None if there is none (or we
+        can't tell)
+    """
+    if getrlimit is None:
+        return None
+    soft, _ = getrlimit(RLIMIT_NOFILE)
+    if soft <= 0:
+        # RLIM_INFINITY
+        return None
+    return soft
+
+
+class FdMonitor(object):
+    """
+    I estimate how many file descriptors are open, and evict lonely
+    connections when that gets too close to ``limit``.
+    """
+
+    # while over the high-water mark, how many connections we accept
+    # between re-measurements of the baseline
+    RECOUNT = 100
+
+    def __init__(self, limit, high_water=0.9, low_water=0.8, count_fds=count_open_fds):
+        """
+        :param int limit: the most file descriptors we may have open
+
+        :param float high_water: evict once this fraction of ``limit``
+            is open ..
+
+        :param float low_water: .. until only this fraction is
+        """
+        if not 0 < low_water <= high_water <= 1:
+            raise ValueError("need 0 < low_water <= high_water <= 1")
+        self.limit = limit
+        self._high = int(limit * high_water)
+        self._low = int(limit * low_water)
+        self._count_fds = count_fds
+        self._baseline = count_fds() or 0
+        self._connections = 0
+        # connections accepted since the baseline was measured
+        self._unmeasured = 0
+        # states we have evicted, whose connections haven't closed yet
+        self._closing = set()
+        # connections we have evicted since we started
+        self.evicted = 0
+        # whether we have said that there was nothing left to evict
+        self._warned = False
+
+    def estimate(self):
+        """
+        :returns int: about how many file descriptors are open, not
+            counting connections we are already closing
+        """
+        return self._baseline + self._connections - len(self._closing)
+
+    def connection_made(self, pending_requests):
+        """
+        A connection was accepted: if that takes us over the high-water
+        mark, evict the oldest lonely connections in ``pending_requests``.
+        """
+        self._connections += 1
+        self._unmeasured += 1
+        if self.estimate() < self._high:
+            self._warned = False
+            return
+        if self._unmeasured >= self.RECOUNT or not self._warned:
+            actual = self._count_fds()
+            if actual is not None:
+                self._baseline = actual - self._connections
+                self._unmeasured = 0
+                if self.estimate() < self._high:
+                    return
+        excess = self.estimate() - self._low
+        evicted = pending_requests.evict_oldest(excess)
+        self._closing.update(evicted)
+        self.evicted += len(evicted)
+        if not evicted and not self._warned:
+            self._warned = True
+            log.msg("{} of {} file descriptors open, and no lonely connections"
+                    " left to close".format(self.estimate(), self.limit))
+
+    def connection_lost(self, state):
+        """
+        The connection of TransitServerState ``state`` has closed.
+        """
+        self._connections -= 1
+        self._closing.discard(state)
@@ -0,0 +1,115 @@
+"""
+Measuring how far behind the reactor is running, and shedding load when
+it is too far behind.
+
+Everything in the relay (except offloaded pairs) happens on the one
+reactor thread, so when a turn of the reactor takes too long, every
+connection waits: handshakes time out on the client side, and nothing
+in our own logs says why. A LagMonitor asks the reactor to call it every
+``interval`` seconds, and notes how much later than that the call
+actually came. The delays go into a histogram of fixed buckets (cheap to
+keep, and reported as statsd counters), and into a smoothed lag.
+
+With a ``threshold``, the monitor is ``shedding`` while the smoothed lag
+is above it: the Transit then refuses new connections (closing them as
+soon as they are accepted, before they cost us anything else) while the
+pairs that are already relaying carry on.
+"""
+
+from twisted.application.service import Service
+from twisted.python import log
+
+# upper bounds of the histogram buckets, in milliseconds (the last
+# bucket takes everything slower)
+LAG_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class LagMonitor(Service):
+    """
+    I measure the reactor's scheduling delay every ``interval`` seconds.
+    """
+
+    # how much of each new measurement goes into the smoothed lag
+    SMOOTHING = 0.25
+
+    def __init__(self, reactor, interval=0.1, threshold=None):
+        """
+        :param float interval: seconds between probes
+
+        :param float threshold: None, or the smoothed lag (in seconds)
+            above which new connections should be refused
+        """
+        self._reactor = reactor
+        self.interval = interval
+        self.threshold = threshold
+        self._call = None
+        self._expected = None
+        # probes per bucket of LAG_BUCKETS, plus one for the rest
+        self.histogram = [0] * (len(LAG_BUCKETS) + 1)
+        self.lag = 0.0 # smoothed, in seconds
+        self.shedding = False
+        # connections refused while shedding
+        self.shed = 0
+
+    def startService(self):
+        Service.startService(self)
+        self._schedule()
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._expected = self._reactor.seconds() + self.interval
+        self._call = self._reactor.callLater(self.interval, self._probe)
+
+    def _probe(self):
+        self.record(max(0.0, self._reactor.seconds() - self._expected))
+        self._schedule()
+
+    def record(self, lag):
+        """
+        Note one measurement of ``lag`` seconds.
+        """
+        ms = lag * 1000
+        for i, bound in enumerate(LAG_BUCKETS):
+            if ms <= bound:
+                break
+        else:
+            i = len(LAG_BUCKETS)
+        self.histogram[i] += 1
+        self.lag += self.SMOOTHING * (lag - self.lag)
+        if self.threshold is None:
+            return
+        shedding = self.lag > self.threshold
+        if shedding != self.shedding:
+            self.shedding = shedding
+            if shedding:
+                log.msg("reactor is {:.0f}ms behind: refusing new connections".format(
+                    self.lag * 1000))
+            else:
+                log.msg("reactor has caught up: accepting new connections again")
+
+    def refuse(self):
+        """
+        :returns bool: True if a new connection should be refused now
+            (which is then counted)
+        """
+        if self.shedding:
+            self.shed += 1
+            return True
+        return False
+
+    def get_counters(self):
+        """
+        :returns: dict of counters for statsd: the probes in each bucket
+            (``reactor_lag.le_5ms`` counts the probes that were more than
+            2ms, and at most 5ms, late), and the connections we shed
+        """
+        counters = {"shed": self.shed}
+        for bound, count in zip(LAG_BUCKETS, self.histogram):
+            counters["reactor_lag.le_%dms" % bound] = count
+        counters["reactor_lag.over_%dms" % LAG_BUCKETS[-1]] = self.histogram[-1]
+        return counters
@@ -0,0 +1,98 @@
+"""
+Caps on how many connections one source address may hold at once.
+
+Every connection (pending or relaying, TCP or WebSocket) counts against
+its source: an IPv4 address, or the IPv6 network of ``ipv6_prefix``
+bits around it (a single host usually has a whole /64 to pick addresses
+from). The counts live in one dict keyed by the packed address bytes
+(4 for IPv4, ``ipv6_prefix``/8 for IPv6), and a source's entry is
+deleted as soon as its count drops to zero, so the dict only ever holds
+the sources that are connected right now.
+
+Sources in the ``exempt`` networks (like our own monitoring) are not
+counted at all.
+"""
+
+import ipaddress
+import socket
+
+_IPV4_MAPPED = b"\x00" * 10 + b"\xff\xff"
+
+
+class ConnectionLimiter(object):
+    """
+    I count connections per source, and refuse any beyond ``limit``.
+    """
+
+    def __init__(self, limit, ipv6_prefix=64, exempt=()):
+        # (more than 32 bits, so IPv6 keys are never mistaken for IPv4)
+        if not 32 < ipv6_prefix <= 128:
+            raise ValueError("ipv6_prefix must be between 33 and 128")
+        self.limit = limit
+        self._prefix_bytes, bits = divmod(ipv6_prefix, 8)
+        if bits:
+            self._prefix_bytes += 1
+        self._last_mask = (0xff << (8 - bits)) & 0xff if bits else 0xff
+        self._exempt = [ipaddress.ip_network(n, strict=False) for n in exempt]
+        self._counts = {}
+        # connections we have refused since we started
+        self.refused = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def key_for(self, host):
+        """
+        :param str host: the source address, as in ``IAddress.host``
+
+        :returns: the packed key that ``host`` is counted under, or None
+            if it isn't counted (it is exempt, or not an IP address)
+        """
+        if self._exempt and self._is_exempt(host):
+            return None
+        try:
+            return socket.inet_pton(socket.AF_INET, host)
+        except (OSError, TypeError):
+            pass
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, host)
+        except (OSError, TypeError):
+            return None
+        if packed.startswith(_IPV4_MAPPED):
+            # an IPv4 client of a dual-stack listener
+            return packed[12:]
+        last = self._prefix_bytes - 1
+        return packed[:last] + bytes([packed[last] & self._last_mask])
+
+    def _is_exempt(self, host):
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        return any(address in network for network in self._exempt)
+
+    def acquire(self, key):
+        """
+        A connection from ``key`` has arrived.
+
+        :returns bool: False (and nothing is counted) if ``key`` is
+            already at the limit
+        """
+        count = self._counts.get(key, 0)
+        if count >= self.limit:
+            self.refused += 1
+            return False
+        self._counts[key] = count + 1
+        return True
+
+    def release(self, key):
+        """
+        A connection from ``key`` (which was acquired) has gone.
+        """
+        count = self._counts[key] - 1
+        if count:
+            self._counts[key] = count
+        else:
+            del self._counts[key]
@@ -0,0 +1,393 @@
+"""
+Munin graphs of a relay's usage database (and --stats-shm= file).
+
+``wormhole-transit-munin`` draws every graph that misc/munin offers from
+a single invocation, using munin's "multigraph" protocol. Link it into
+/etc/munin/plugins/ (as ``wormhole_transit``, say), and in
+/etc/munin/plugin-conf.d/wormhole put:
+
+    [wormhole_transit*]
+    env.usagedb /path/to/your/wormhole/server/usage.sqlite
+    # optional, if the relay runs with --stats-shm=
+    env.statsshm /dev/shm/wormhole-transit
+
+Linked under the name of one of the GRAPHS instead, it draws just that
+graph, like the separate scripts in misc/munin did (they now call this).
+
+Each reading of the database is one query of the ``usage`` table, grouped
+by mood, plus the (small) ``usage_rollups`` (and the same for each
+partition file, with --usage-db-partition=). The totals are kept in a
+cache file in munin's plugin-state directory, along with the last
+``usage`` row they include, so the next run only reads the rows written
+after it, or everything again if that row has gone. (A whole reading is
+also reused for CACHE_SECONDS, for the separate scripts that munin runs
+one after another.) Rows that --usage-retention= moved into the rollups
+since are subtracted again, and the cache starts over when the relay
+restarts.
+
+With env.statsshm, the current and since-restart graphs come from that
+file instead, and the database is only read for the all-time graphs.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from urllib.request import pathname2url
+
+from .shmstats import read_stats
+
+MINUTE = 60.0
+# older data is shown as unknown
+STALE = 5*MINUTE
+# a whole reading is reused for this long
+CACHE_SECONDS = 60.0
+CACHE_VERSION = 3
+CACHE_FILENAME = "wormhole_transit.json"
+
+EVENT_MOODS = ("happy", "errory", "lonely", "redundant")
+
+
+def _config(title, vlabel, fields):
+    lines = [
+        "graph_title Magic-Wormhole Transit %s" % title,
+        "graph_vlabel %s" % vlabel,
+        "graph_category wormhole",
+    ]
+    for name, label in fields:
+        lines += [
+            "%s.label %s" % (name, label),
+            "%s.draw LINE1" % name,
+            "%s.type GAUGE" % name,
+        ]
+    return "\n".join(lines)
+
+_BYTES_FIELDS = [("bytes", "Transit Bytes (complete)"),
+                 ("incomplete", "Transit Bytes (incomplete)")]
+_EVENT_FIELDS = [(mood, mood.capitalize()) for mood in EVENT_MOODS]
+
+# graph name -> (its config, whether it needs the usage database)
+GRAPHS = {
+    "wormhole_transit_active": (
+        _config("Active Channels", "Channels",
+                [("waiting", "Transit Waiting"), ("connected", "Transit Connected")]),
+        False),
+    "wormhole_transit_bytes": (
+        _config("Usage (since reboot)", "Bytes Since Reboot", _BYTES_FIELDS),
+        False),
+    "wormhole_transit_bytes_alltime": (
+        _config("Usage (all time)", "Bytes Since DB Creation", _BYTES_FIELDS),
+        True),
+    "wormhole_transit_events": (
+        _config("Server Events (since reboot)", "Events Since Reboot", _EVENT_FIELDS),
+        False),
+    "wormhole_transit_events_alltime": (
+        _config("Server Events (all time)", "Events", _EVENT_FIELDS),
+        True),
+}
+
+
+def graph_values(graph, reading, now):
+    """
+    :returns list: (field, value) for the ``graph``, from a reading made
+        by read_usage_db() or read_shm(); the value is "U" (unknown) if
+        the reading is stale
+    """
+    if graph == "wormhole_transit_active":
+        fields = [("waiting", reading["waiting"]),
+                  ("connected", reading["connected"])]
+    elif graph in ("wormhole_transit_bytes", "wormhole_transit_bytes_alltime"):
+        complete = reading["bytes" if graph == "wormhole_transit_bytes" else "all_time_bytes"]
+        fields = [("bytes", complete),
+                  ("incomplete", complete + reading["incomplete_bytes"])]
+    else:
+        counts = reading["connections" if graph == "wormhole_transit_events"
+                         else "all_time_connections"]
+        fields = [(mood, counts.get(mood, 0)) for mood in EVENT_MOODS]
+    if now > reading["updated"] + STALE:
+        return [(name, "U") for (name, _) in fields]
+    return fields
+
+
+def open_usage_db(dbfile):
+    """
+    :returns: a read-only connection to the relay's ``dbfile``
+    """
+    # (mode=ro, so a wrong path is an error rather than a new database)
+    return sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(dbfile)),
+                           uri=True)
+
+
+def _add(totals, mood, connections, total_bytes):
+    t = totals.setdefault(mood, [0, 0])
+    t[0] += connections
+    t[1] += total_bytes
+
+
+def _read_source(db, source, rebooted, moods, dropped=()):
+    """
+    Bring ``source``, the cached totals of one database file (the index,
+    or a partition), up to date with its `usage` rows and rollups.
+
+    :param dropped: the cached totals of partitions that have been folded
+        into this file's rollups since last time
+    """
+    rollups = {}
+    for (mood, connections, total_bytes) in db.execute(
+            "SELECT `mood`, SUM(`connections`), SUM(`total_bytes`)"
+            " FROM `usage_rollups` GROUP BY 1"):
+        _add(rollups, moods.get(mood, "unknown"), connections, total_bytes)
+
+    # `usage` has no AUTOINCREMENT, so a new row gets the largest rowid
+    # there is, plus one: rowids are only reused once the row we stopped
+    # at last time is gone (say, --usage-retention deleted every row).
+    # While it is still there, the rows after it are exactly the new ones.
+    if source.get("rowid") is not None:
+        row = db.execute("SELECT `started` FROM `usage` WHERE rowid = ?",
+                         (source["rowid"],)).fetchone()
+        if row is None or row[0] != source["started"]:
+            source["rowid"] = None
+    if source.get("rowid") is None:
+        # count everything again
+        source.update(rowid=None, started=None, since_reboot={}, usage={})
+    else:
+        # Pruning adds exactly the sums of the rows it deletes to the
+        # rollups (and dropping a partition adds everything that was in
+        # it), so take those rows back out of our `usage` totals.
+        pruned = {}
+        for mood, (connections, total_bytes) in rollups.items():
+            (old_connections, old_bytes) = source["rollups"].get(mood, (0, 0))
+            _add(pruned, mood, connections - old_connections, total_bytes - old_bytes)
+        for totals in dropped:
+            for mood, (connections, total_bytes) in totals.items():
+                _add(pruned, mood, -connections, -total_bytes)
+        for mood, (connections, total_bytes) in pruned.items():
+            _add(source["usage"], mood, -connections, -total_bytes)
+    source["rollups"] = rollups
+
+    # Without a row to start after, read everything through the covering
+    # index instead of the table.
+    query = ("SELECT `mood`, `started` > ? AS `recent`, SUM(`weight`),"
+             " SUM(`total_bytes` * `weight`), MAX(rowid) FROM `usage`")
+    args = (rebooted,)
+    if source["rowid"] is not None:
+        query += " WHERE rowid > ?"
+        args += (source["rowid"],)
+    for (mood, recent, connections, total_bytes, last) in db.execute(
+            query + " GROUP BY 1, 2", args):
+        name = moods.get(mood, "unknown")
+        _add(source["usage"], name, connections, total_bytes)
+        if recent:
+            _add(source["since_reboot"], name, connections, total_bytes)
+        source["rowid"] = max(source["rowid"] or 0, last)
+    if source["rowid"] is not None:
+        # (to know it again)
+        (source["started"],) = db.execute("SELECT `started` FROM `usage` WHERE rowid = ?",
+                                          (source["rowid"],)).fetchone()
+
+
+def _all_time(source):
+    totals = {}
+    for part in (source["rollups"], source["usage"]):
+        for mood, (connections, total_bytes) in part.items():
+            _add(totals, mood, connections, total_bytes)
+    return totals
+
+
+def read_usage_db(db, cache, directory=None):
+    """
+    Read the current statistics, and the usage totals since the relay
+    restarted and of all time, from the usage database ``db``.
+
+    :param dict cache: the totals this kept last time (from the cache
+        file), or an empty dict; it is updated in place
+
+    :param str directory: where the database is, to find its partitions
+        (with --usage-db-partition=); None to only read ``db`` itself
+
+    :returns dict: the reading, or None if the relay has not written any
+        statistics yet
+    """
+    # (one read transaction, so the list of partitions and the rollups
+    # that dropped partitions went into agree)
+    db.execute("BEGIN")
+    try:
+        current = db.execute("SELECT `rebooted`, `updated`, `connected`, `waiting`,"
+                             " `incomplete_bytes` FROM `current`").fetchone()
+        if current is None:
+            return None
+        (rebooted, updated, connected, waiting, incomplete_bytes) = current
+        moods = dict(db.execute("SELECT `mood`, `name` FROM `moods`").fetchall())
+        partitions = []
+        if directory is not None:
+            partitions = [filename for (filename,) in db.execute(
+                "SELECT `filename` FROM `partitions` ORDER BY `start`")]
+
+        if cache.get("version") != CACHE_VERSION or cache.get("rebooted") != rebooted:
+            cache.clear()
+            cache.update(version=CACHE_VERSION, rebooted=rebooted, sources={})
+        sources = cache["sources"]
+        # ("" is the index itself)
+        dropped = [_all_time(sources.pop(name)) for name in list(sources)
+                   if name and name not in partitions]
+        _read_source(db, sources.setdefault("", {}), rebooted, moods, dropped)
+    finally:
+        db.execute("COMMIT")
+    for filename in partitions:
+        path = os.path.join(directory, filename)
+        if not os.path.exists(path):
+            # (dropped since we looked)
+            continue
+        part = open_usage_db(path)
+        try:
+            _read_source(part, sources.setdefault(filename, {}), rebooted, moods)
+        finally:
+            part.close()
+
+    all_time = {}
+    since_reboot = {}
+    for source in sources.values():
+        for mood, (connections, total_bytes) in _all_time(source).items():
+            _add(all_time, mood, connections, total_bytes)
+        for mood, (connections, total_bytes) in source["since_reboot"].items():
+            _add(since_reboot, mood, connections, total_bytes)
+    return {
+        "updated": updated,
+        "connected": connected,
+        "waiting": waiting,
+        "incomplete_bytes": incomplete_bytes,
+        "connections": dict((m, c) for (m, (c, _)) in since_reboot.items()),
+        "bytes": sum(b for (_, b) in since_reboot.values()),
+        "all_time_connections": dict((m, c) for (m, (c, _)) in all_time.items()),
+        "all_time_bytes": sum(b for (_, b) in all_time.values()),
+    }
+
+
+def read_shm(path):
+    """
+    :returns dict: a reading (without the all-time totals) from the
+        relay's --stats-shm= file
+    """
+    stats = read_stats(path)
+    prefix = "connections."
+    return {
+        "updated": stats["updated"],
+        "connected": stats["connected"],
+        "waiting": stats["waiting"],
+        "incomplete_bytes": stats["incomplete_bytes"],
+        "connections": dict((name[len(prefix):], value)
+                            for (name, value) in stats.items()
+                            if name.startswith(prefix)),
+        "bytes": stats["bytes"],
+    }
+
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(path, cache):
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, path)
+    except OSError:
+        # (we'll just read more next time)
+        pass
+
+
+def read(environ, now, graphs):
+    """
+    :returns dict: the reading needed for ``graphs``, or None
+    """
+    dbfile = environ.get("usagedb")
+    shm = environ.get("statsshm")
+    need_db = dbfile and (not shm or any(GRAPHS[g][1] for g in graphs))
+    reading = {}
+    if need_db:
+        cache_path = os.path.join(environ.get("MUNIN_PLUGSTATE", tempfile.gettempdir()), CACHE_FILENAME)
+        cache = _load_cache(cache_path)
+        if (cache.get("dbfile") == dbfile
+                and 0 <= now - cache.get("read_at", 0) < CACHE_SECONDS):
+            reading = cache["reading"]
+        else:
+            db = open_usage_db(dbfile)
+            try:
+                totals = cache.get("totals", {}) if cache.get("dbfile") == dbfile else {}
+                reading = read_usage_db(db, totals,
+                                        os.path.dirname(os.path.abspath(dbfile)))
+            finally:
+                db.close()
+            if reading is None:
+                return None
+            _save_cache(cache_path, dict(dbfile=dbfile, read_at=now,
+                                         reading=reading, totals=totals))
+    if shm:
+        reading.update(read_shm(shm))
+    return reading
+
+
+def main(argv=None, environ=None, out=None):
+    """
+    The plugin: ``config``, ``autoconf``, or (with no argument) print the
+    values.
+    """
+    argv = sys.argv if argv is None else argv
+    environ = os.environ if environ is None else environ
+    out = sys.stdout if out is None else out
+    command = argv[1] if len(argv) > 1 else "fetch"
+
+    if not environ.get("usagedb") and not environ.get("statsshm"):
+        if command == "autoconf":
+            print("no (set env.usagedb or env.statsshm)", file=out)
+            return 0
+        print("set env.usagedb (or env.statsshm) in the munin plugin config",
+              file=sys.stderr)
+        return 1
+    if command == "autoconf":
+        print("yes", file=out)
+        return 0
+
+    name = os.path.basename(argv[0])
+    if name in GRAPHS:
+        graphs = [name]
+        multigraph = False
+        if GRAPHS[name][1] and not environ.get("usagedb"):
+            print("%s needs env.usagedb" % name, file=sys.stderr)
+            return 1
+    else:
+        graphs = [g for (g, (_, needs_db)) in GRAPHS.items()
+                  if environ.get("usagedb") or not needs_db]
+        multigraph = True
+        if environ.get("MUNIN_CAP_MULTIGRAPH") != "1":
+            print("this plugin needs munin 1.4 or later (multigraph)", file=sys.stderr)
+            return 1
+
+    if command == "config":
+        for graph in graphs:
+            if multigraph:
+                print("multigraph %s" % graph, file=out)
+            print(GRAPHS[graph][0], file=out)
+        return 0
+
+    now = time.time()
+    reading = read(environ, now, graphs)
+    if reading is None:
+        return 1
+    for graph in graphs:
+        if multigraph:
+            print("multigraph %s" % graph, file=out)
+        for field, value in graph_values(graph, reading, now):
+            print("%s.value" % field, value, file=out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,516 @@
+"""
+Moving the busiest relayed pairs off the reactor thread.
+
+A pair of TCP connections which relays more than ``threshold`` bytes
+within the first OFFLOAD_WINDOW seconds is an "elephant": it is likely
+to be a large transfer, which on the reactor would mean millions of
+read/write callbacks, each one delaying every other connection's
+handshake. Once both transports have empty write buffers, their sockets
+are taken away from the reactor and handed to one of a few pump threads,
+which copy bytes between them with non-blocking ``recv_into``/``send``
+(or ``os.splice`` through a pipe, where available) driven by a selector.
+
+The pump threads never touch the protocol objects. Byte counts go back
+to each TransitServerState every REPORT_INTERVAL seconds (through
+``callFromThread``), and when either side closes or fails, any data
+still in flight is handed back to the reactor along with the sockets,
+which are then closed through the usual ``loseConnection`` path so the
+usage is recorded exactly as it would have been. The relay can also ask
+for a pair back (with ``Offloader.release``), say to close it for being
+idle.
+"""
+
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+
+from twisted.application.service import Service
+
+from .requestlog import log_request
+
+# seconds after pairing within which a pair must reach the threshold
+OFFLOAD_WINDOW = 5.0
+# seconds between byte-count reports back to the reactor
+REPORT_INTERVAL = 1.0
+# bytes copied per recv (and the size of each direction's buffer)
+BUFSIZE = 256 * 1024
+
+_SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+
+class _Flow(object):
+    """
+    One direction of a pair: bytes from ``src`` to ``dst``. ``head`` is
+    data that was already read (by the reactor) and is sent first.
+    """
+
+    def __init__(self, src, dst, head=b""):
+        self.src = src
+        self.dst = dst
+        self._head = memoryview(head)
+        self.moved = 0
+
+    def pending(self):
+        return len(self._head) + self._pending()
+
+    def fill(self):
+        """
+        :returns bool: False if ``src`` has closed
+        """
+        n = self._fill()
+        self.moved += n
+        return n > 0
+
+    def drain(self):
+        if self._head:
+            self._head = self._head[self.dst.send(self._head):]
+            if self._head:
+                return
+        if self._pending():
+            self._drain()
+
+    def leftover(self):
+        return bytes(self._head) + self._leftover()
+
+
+class _BufferFlow(_Flow):
+    """
+    Bytes read from ``src`` wait in a preallocated buffer until they
+    have been sent to ``dst``.
+    """
+
+    def __init__(self, src, dst, head=b""):
+        _Flow.__init__(self, src, dst, head)
+        self._buffer = bytearray(BUFSIZE)
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0
+
+    def _pending(self):
+        return self._end - self._start
+
+    def _fill(self):
+        n = self.src.recv_into(self._view)
+        self._start, self._end = 0, n
+        return n
+
+    def _drain(self):
+        self._start += self.dst.send(self._view[self._start:self._end])
+
+    def _leftover(self):
+        return bytes(self._view[self._start:self._end])
+
+    def close(self):
+        self._view.release()
+
+
+class _SpliceFlow(_Flow):
+    """
+    Bytes are moved through a pipe with ``os.splice``, so they never
+    enter userspace.
+    """
+
+    def __init__(self, src, dst, head=b""):
+        _Flow.__init__(self, src, dst, head)
+        self._r, self._w = os.pipe2(os.O_NONBLOCK)
+        self._in_pipe = 0
+
+    def _pending(self):
+        return self._in_pipe
+
+    def _fill(self):
+        n = os.splice(self.src.fileno(), self._w, BUFSIZE, flags=_SPLICE_FLAGS)
+        self._in_pipe += n
+        return n
+
+    def _drain(self):
+        self._in_pipe -= os.splice(self._r, self.dst.fileno(), self._in_pipe,
+                                   flags=_SPLICE_FLAGS)
+
+    def _leftover(self):
+        data = []
+        while self._in_pipe:
+            chunk = os.read(self._r, self._in_pipe)
+            self._in_pipe -= len(chunk)
+            data.append(chunk)
+        return b"".join(data)
+
+    def close(self):
+        os.close(self._r)
+        os.close(self._w)
+
+
+def _flow_type():
+    return _SpliceFlow if hasattr(os, "splice") else _BufferFlow
+
+
+class _Pair(object):
+    """
+    Two sockets being pumped by one RelayPump.
+    """
+
+    def __init__(self, key, sockets, head, flow_type):
+        self.key = key
+        self.sockets = sockets
+        # flows[i] carries what sockets[i] sends
+        self.flows = (
+            flow_type(sockets[0], sockets[1], head),
+            flow_type(sockets[1], sockets[0]),
+        )
+        self.events = [0, 0]
+        self.reported = [0, 0]
+
+    def wanted(self, i):
+        events = 0
+        if not self.flows[i].pending():
+            events |= selectors.EVENT_READ
+        if self.flows[1 - i].pending():
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def unreported(self):
+        return [f.moved - r for (f, r) in zip(self.flows, self.reported)]
+
+
+class RelayPump(threading.Thread):
+    """
+    A thread which copies bytes between the sockets of the pairs it has
+    been given, until one side of each closes.
+    """
+
+    def __init__(self, call_from_thread, report, finished, flow_type=None):
+        """
+        :param call_from_thread: run a function in the reactor thread
+
+        :param report: called (in the reactor thread) with a list of
+            ``(key, [bytes_from_0, bytes_from_1])`` moved since the last
+            report
+
+        :param finished: called (in the reactor thread) with ``(key,
+            closed, leftovers)`` when a pair is done: ``closed`` is the
+            index of the socket that closed or failed (or None if the
+            pump was stopped), and ``leftovers[i]`` is data that was
+            read but not yet sent *to* socket ``i``
+        """
+        threading.Thread.__init__(self, name="relay-pump", daemon=True)
+        self._call = call_from_thread
+        self._report = report
+        self._finished = finished
+        self._flow_type = flow_type or _flow_type()
+        self._selector = selectors.DefaultSelector()
+        self._new = queue.SimpleQueue()
+        self._releasing = queue.SimpleQueue()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._selector.register(self._waker_r, selectors.EVENT_READ)
+        self._pairs = set()
+        self._stopping = False
+        self.remaining = [] # (key, closed, leftovers, moved) of pairs left at stop()
+
+    def load(self):
+        """
+        :returns int: the number of pairs this pump has (or is about to
+            have)
+        """
+        return len(self._pairs) + self._new.qsize()
+
+    def add_pair(self, key, sock0, sock1, head=b""):
+        """
+        Start pumping between two (connected, non-blocking) sockets.
+        Thread-safe.
+
+        :param bytes head: already received from ``sock0``, to be sent
+            to ``sock1`` before anything else
+        """
+        self._new.put((key, (sock0, sock1), head))
+        self._wake()
+
+    def release_pair(self, key):
+        """
+        Stop pumping the pair added as ``key``, and hand it back through
+        ``finished`` (with ``closed`` None), as if one side had closed.
+        Nothing happens if the pair is already done. Thread-safe.
+        """
+        self._releasing.put(key)
+        self._wake()
+
+    def stop(self):
+        """
+        Stop pumping and wait for the thread to exit. Afterwards,
+        ``remaining`` holds the pairs that were still open.
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wake()
+        self.join()
+        self._selector.close()
+        self._waker_r.close()
+        self._waker_w.close()
+
+    def _wake(self):
+        try:
+            self._waker_w.send(b"x")
+        except BlockingIOError:
+            pass # already awake
+
+    def run(self):
+        next_report = time.monotonic() + REPORT_INTERVAL
+        while not self._stopping:
+            for key, mask in self._selector.select(REPORT_INTERVAL):
+                if key.fileobj is self._waker_r:
+                    self._waker_r.recv(4096)
+                    continue
+                pair, i = key.data
+                if pair in self._pairs:
+                    self._service(pair, i, mask)
+            self._add_new_pairs()
+            self._release_pairs()
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + REPORT_INTERVAL
+                self._send_report()
+        self._add_new_pairs()
+        # stop() reports these (and their unreported bytes) itself
+        for pair in list(self._pairs):
+            self.remaining.append(self._release(pair, None))
+
+    def _add_new_pairs(self):
+        while not self._new.empty():
+            key, sockets, head = self._new.get()
+            pair = _Pair(key, sockets, head, self._flow_type)
+            self._pairs.add(pair)
+            self._update(pair)
+
+    def _release_pairs(self):
+        while not self._releasing.empty():
+            key = self._releasing.get()
+            for pair in list(self._pairs):
+                if pair.key == key:
+                    self._finish(pair, None)
+
+    def _service(self, pair, i, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                pair.flows[1 - i].drain()
+            if mask & selectors.EVENT_READ and not pair.flows[i].fill():
+                return self._finish(pair, i)
+        except BlockingIOError:
+            pass
+        except OSError:
+            return self._finish(pair, i)
+        if pair.flows[i].pending():
+            # usually the other side can take it right away
+            try:
+                pair.flows[i].drain()
+            except BlockingIOError:
+                pass
+            except OSError:
+                return self._finish(pair, 1 - i)
+        self._update(pair)
+
+    def _update(self, pair):
+        for i, sock in enumerate(pair.sockets):
+            events = pair.wanted(i)
+            if events == pair.events[i]:
+                continue
+            if not events:
+                self._selector.unregister(sock)
+            elif not pair.events[i]:
+                self._selector.register(sock, events, (pair, i))
+            else:
+                self._selector.modify(sock, events, (pair, i))
+            pair.events[i] = events
+
+    def _send_report(self):
+        reports = []
+        for pair in self._pairs:
+            moved = pair.unreported()
+            if any(moved):
+                reports.append((pair.key, moved))
+                pair.reported = [f.moved for f in pair.flows]
+        if reports:
+            self._call(self._report, reports)
+
+    def _release(self, pair, closed):
+        self._pairs.discard(pair)
+        for i, sock in enumerate(pair.sockets):
+            if pair.events[i]:
+                self._selector.unregister(sock)
+        leftovers = [pair.flows[1].leftover(), pair.flows[0].leftover()]
+        for flow in pair.flows:
+            flow.close()
+        return (pair.key, closed, leftovers, pair.unreported())
+
+    def _finish(self, pair, closed):
+        key, closed, leftovers, moved = self._release(pair, closed)
+        if any(moved):
+            self._call(self._report, [(key, moved)])
+        self._call(self._finished, key, closed, leftovers)
+
+
+class Offloader(Service):
+    """
+    Watches relayed TCP pairs and hands the elephants to a pool of
+    RelayPump threads (or some other kind of pump, like
+    uring.UringPump).
+    """
+
+    def __init__(self, reactor, threads, threshold, window=OFFLOAD_WINDOW,
+                 pump=RelayPump):
+        """
+        :param int threads: number of pump threads
+
+        :param int threshold: bytes (in both directions together) a pair
+            must relay within ``window`` seconds of pairing to be
+            offloaded. With 0, every TCP pair is offloaded as soon as it
+            is paired.
+
+        :param pump: the class of the pumps
+        """
+        self._reactor = reactor
+        self._threads = threads
+        self._threshold = threshold
+        self._window = window
+        self._pump = pump
+        self._pumps = []
+        # TransitConnection -> (key, pump) for each pumped pair
+        self._owners = {}
+        # key -> what to call instead of closing, when it comes back
+        self._releasing = {}
+        self.offloaded = 0 # pairs moved to a pump, ever
+
+    def startService(self):
+        Service.startService(self)
+        self._pumps = [
+            self._pump(self._reactor.callFromThread, self._report, self._finished)
+            for _ in range(self._threads)
+        ]
+        for pump in self._pumps:
+            pump.start()
+
+    def stopService(self):
+        Service.stopService(self)
+        pumps, self._pumps = self._pumps, []
+        for pump in pumps:
+            pump.stop()
+            for (key, closed, leftovers, moved) in pump.remaining:
+                self._report([(key, moved)])
+                self._finished(key, closed, leftovers)
+
+    def paired(self, conn, other):
+        """
+        ``conn`` has just been glued to ``other`` (both TCP
+        TransitConnections).
+        """
+        if self._threshold == 0:
+            # We take every pair. The sockets can't be handed over yet
+            # ("ok\n" is still waiting to be written), so observe() does
+            # that when the first data arrives.
+            conn.offload = other.offload = True
+
+    def observe(self, conn, other, data):
+        """
+        ``conn`` (a TransitConnection relaying to the TransitConnection
+        ``other``) has just received ``data``: if the pair has turned out
+        to be an elephant, offload it.
+
+        :returns bool: True if the pair was offloaded, in which case a
+            pump thread will relay ``data``
+        """
+        if conn.offload is False or not self._pumps:
+            return False
+        if conn.offload is None:
+            session = conn._state._session
+            elapsed = time.time() - session.paired_time
+            moved = session.total_bytes
+            if moved < self._threshold and elapsed <= self._window:
+                return False
+            conn.offload = other.offload = moved >= self._threshold
+            if not conn.offload:
+                return False
+        # Wait until everything already given to the transports has been
+        # written (with backpressure, reading resumes only once the
+        # partner's buffer is empty), so there's nothing but ``data`` to
+        # hand over.
+        if len(data) > BUFSIZE or not (_is_idle(conn.transport) and _is_idle(other.transport)):
+            return False
+        self._offload(conn, other, data)
+        return True
+
+    def _offload(self, conn, other, data):
+        for c in (conn, other):
+            c.transport.unregisterProducer()
+            c.transport.stopReading()
+            c.transport.stopWriting()
+        pump = min(self._pumps, key=lambda p: p.load())
+        key = (conn, other)
+        self._owners[conn] = self._owners[other] = (key, pump)
+        # ``data`` may be a view of the RelayReader's buffer
+        pump.add_pair(key, conn.transport.socket, other.transport.socket, bytes(data))
+        conn._state.got_offloaded_bytes(len(data))
+        self.offloaded += 1
+        log_request(
+            conn.factory, "offloaded",
+            token=conn._state.get_token,
+            bytes=conn._state._total_sent + other._state._total_sent,
+        )
+
+    def release(self, conn, then):
+        """
+        Take the pair that ``conn`` belongs to back from its pump (like
+        when the relay would close it, say for --idle-timeout=): once any
+        data in flight has been written to the transports, ``then`` is
+        called (in the reactor thread) instead of the pair being closed.
+        ``then`` may decide to keep the pair after all, and ``resume``
+        it.
+
+        :returns bool: False if ``conn`` is not being pumped (it never
+            was, or the pair has already been handed back), so its
+            transport may be used right away
+        """
+        owner = self._owners.get(conn)
+        if owner is None:
+            return False
+        key, pump = owner
+        self._releasing[key] = then
+        pump.release_pair(key)
+        return True
+
+    def resume(self, conn, other):
+        """
+        Relay a pair which ``release`` has handed back from the reactor
+        again (it may be offloaded again later, like any other).
+        """
+        for c, buddy in ((conn, other), (other, conn)):
+            c.offload = None
+            buddy.transport.registerProducer(c.transport, True)
+            c.transport.startReading()
+
+    def _report(self, reports):
+        for (key, moved) in reports:
+            for c, n in zip(key, moved):
+                if n:
+                    c._state.got_offloaded_bytes(n)
+
+    def _finished(self, key, closed, leftovers):
+        for c in key:
+            self._owners.pop(c, None)
+        for c, leftover in zip(key, leftovers):
+            if leftover:
+                c.transport.write(leftover)
+        then = self._releasing.pop(key, None)
+        if then is not None:
+            then()
+            return
+        # closing one side takes the other with it, as usual
+        key[0 if closed is None else closed].transport.loseConnection()
+
+
+def _is_idle(transport):
+    return not (
+        transport.dataBuffer
+        or transport._tempDataBuffer
+        or transport.disconnecting
+    )
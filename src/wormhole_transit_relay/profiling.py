@@ -0,0 +1,179 @@
+"""
+Profiling a running relay, on demand.
+
+With --profile-dir=, sending the relay SIGUSR1 (or --profile-signal=)
+profiles the reactor thread for --profile-seconds= and writes the result
+into that directory, without restarting anything. Until the signal
+arrives nothing is profiled, so this costs nothing when it isn't in use.
+twistd rotates its log on SIGUSR1 too, and still does: whatever handler
+the signal had before is called as well.
+
+There are two kinds of profile:
+
+* "sample" (the default): a separate thread looks at the reactor
+  thread's stack every SAMPLE_INTERVAL seconds, and writes the stacks it
+  saw in the "collapsed" format (one line per distinct stack, outermost
+  frame first, then the number of samples), ready for flamegraph.pl or
+  speedscope. The reactor itself does no extra work, so this is cheap
+  enough for a busy production relay.
+* "cprofile": the standard library's deterministic profiler, on the
+  reactor thread only, written as a pstats file. This counts every call,
+  which makes the relay noticeably slower while it runs.
+"""
+
+import cProfile
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from twisted.application.service import Service
+from twisted.python import log
+
+PROFILE_MODES = ("sample", "cprofile")
+# seconds between samples of the reactor thread's stack
+SAMPLE_INTERVAL = 0.005
+# 'SIGUSR1' is unix-only
+PROFILE_SIGNAL = getattr(signal, "SIGUSR1", None)
+
+
+def _frame_name(code):
+    # the last two parts of the path are enough to tell our modules from
+    # Twisted's (and keep the lines short)
+    path = "/".join(code.co_filename.split(os.sep)[-2:])
+    return "{}:{}".format(path, getattr(code, "co_qualname", code.co_name))
+
+
+def collapse(frame):
+    """
+    :returns str: the stack ending at ``frame``, outermost first, as one
+        line of the collapsed format (without the count)
+    """
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class _Sampler(threading.Thread):
+    """
+    Samples the stack of thread ``thread_id`` until ``deadline``, then
+    writes the collapsed stacks to ``path``.
+    """
+
+    def __init__(self, thread_id, deadline, path, done):
+        super(_Sampler, self).__init__(name="relay-profiler", daemon=True)
+        self._thread_id = thread_id
+        self._deadline = deadline
+        self._path = path
+        self._done = done
+        self.stacks = Counter()
+
+    def run(self):
+        while time.monotonic() < self._deadline:
+            time.sleep(SAMPLE_INTERVAL)
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+            # don't keep the reactor's frames alive between samples
+            del frame
+        with open(self._path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        self._done(self._path)
+
+
+class Profiler(object):
+    """
+    I profile the reactor thread for ``seconds`` at a time, writing each
+    profile into ``directory``.
+    """
+
+    def __init__(self, reactor, directory, seconds=30.0, mode="sample"):
+        if mode not in PROFILE_MODES:
+            raise ValueError("mode must be one of: %s" % ", ".join(PROFILE_MODES))
+        self._reactor = reactor
+        self._directory = directory
+        self.seconds = seconds
+        self.mode = mode
+        self.running = False
+
+    def _path(self):
+        name = "profile-{}-{}.{}".format(
+            time.strftime("%Y%m%d-%H%M%S"),
+            os.getpid(),
+            "collapsed" if self.mode == "sample" else "pstats",
+        )
+        return os.path.join(self._directory, name)
+
+    def start(self):
+        """
+        Start profiling (if we aren't already). This must be called from
+        the reactor thread.
+
+        :returns: the file the profile will be written to, or None if one
+            is already running
+        """
+        if self.running:
+            log.msg("already profiling, ignoring the request for another")
+            return None
+        self.running = True
+        path = self._path()
+        log.msg("profiling ({}) for {}s into {}".format(self.mode, self.seconds, path))
+        if self.mode == "sample":
+            sampler = _Sampler(
+                threading.get_ident(),
+                time.monotonic() + self.seconds,
+                path,
+                lambda path: self._reactor.callFromThread(self._finished, path),
+            )
+            sampler.start()
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+            self._reactor.callLater(self.seconds, self._stop_cprofile, profile, path)
+        return path
+
+    def _stop_cprofile(self, profile, path):
+        profile.disable()
+        profile.dump_stats(path)
+        self._finished(path)
+
+    def _finished(self, path):
+        self.running = False
+        log.msg("profile written to {}".format(path))
+
+
+class ProfilerService(Service):
+    """
+    Starts my Profiler whenever the process gets ``signum``.
+    """
+
+    def __init__(self, reactor, profiler, signum=PROFILE_SIGNAL):
+        self._reactor = reactor
+        self.profiler = profiler
+        self._signum = signum
+        self._previous = None
+
+    def startService(self):
+        Service.startService(self)
+        if self._signum is None:
+            log.msg("no profiling signal on this platform, so no profiling")
+            return
+        self._previous = signal.signal(self._signum, self._signalled)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._signum is not None:
+            signal.signal(self._signum, self._previous or signal.SIG_DFL)
+
+    def _signalled(self, signum, frame):
+        # signal handlers run between bytecodes of the main thread, which
+        # may be in the middle of anything: do the work from the reactor
+        self._reactor.callFromThread(self.profiler.start)
+        # (like twistd's log rotation)
+        if callable(self._previous):
+            self._previous(signum, frame)
@@ -0,0 +1,163 @@
+"""
+Structured, sampled logging of per-connection events.
+
+Each noteworthy thing that happens to a connection (a bad handshake, an
+impatient client, a partner hanging up, ...) is an event with a name and
+a few fields. With --request-log-fd= they are written, one JSON object
+per line, to that file descriptor; otherwise they are thrown away at the
+cost of one attribute check.
+
+A RequestLogger keeps only one in every ``1/sample`` events, and at most
+``max_per_second`` of those, so turning it on during an incident can't
+swamp the relay. Field values may be callables, which are only called
+for the events that are kept: nothing is formatted for the events that
+are dropped.
+
+A JSONLinesSink queues the kept events, and every ``interval`` seconds
+hands the whole batch to a thread which encodes and writes it. The
+reactor never waits for the disk, and if the disk can't keep up the
+queue is bounded: further events are dropped (and counted) instead.
+"""
+
+import json
+import time
+
+from twisted.application.service import Service
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+
+
+def log_request(factory, event, **fields):
+    """
+    Log ``event`` through ``factory.log_requests``, if it has a
+    RequestLogger there.
+    """
+    logger = factory.log_requests
+    if logger:
+        logger.event(event, **fields)
+
+
+class RequestLogger(object):
+    """
+    I sample events, and pass those I keep to ``sink.emit(record)``.
+    """
+
+    def __init__(self, sink, sample=1.0, max_per_second=100, clock=time.time):
+        """
+        :param float sample: the fraction of events to keep
+
+        :param int max_per_second: the most events we keep in any one
+            second
+        """
+        if not 0 < sample <= 1:
+            raise ValueError("sample must be more than 0, and at most 1")
+        self._sink = sink
+        self._every = max(1, int(round(1 / sample)))
+        self._countdown = 1
+        self.max_per_second = max_per_second
+        self._clock = clock
+        self._second = None
+        self._this_second = 0
+        # events that were sampled, but over the rate limit
+        self.capped = 0
+
+    def event(self, name, **fields):
+        """
+        Something happened. Callable ``fields`` are called (with no
+        arguments) for their value, if the event is kept.
+        """
+        self._countdown -= 1
+        if self._countdown:
+            return
+        self._countdown = self._every
+        now = self._clock()
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._this_second = 0
+        if self._this_second >= self.max_per_second:
+            self.capped += 1
+            return
+        self._this_second += 1
+        record = {"time": now, "event": name}
+        for key, value in fields.items():
+            record[key] = value() if callable(value) else value
+        self._sink.emit(record)
+
+
+def _write_lines(f, records):
+    f.write("".join(json.dumps(record) + "\n" for record in records))
+    f.flush()
+
+
+class JSONLinesSink(Service):
+    """
+    I write records to file ``f`` as JSON lines, in batches, from a
+    thread.
+    """
+
+    # records queued before we start dropping them
+    MAX_QUEUED = 10000
+
+    def __init__(self, reactor, f, interval=1.0, in_thread=None):
+        """
+        :param in_thread: called like ``in_thread(f, *args)`` to run ``f``
+            in a thread, returning a Deferred (by default, in the
+            reactor's thread pool)
+        """
+        self._reactor = reactor
+        self._file = f
+        self._interval = interval
+        if in_thread is None:
+            def in_thread(f, *args):
+                return deferToThreadPool(reactor, reactor.getThreadPool(), f, *args)
+        self._in_thread = in_thread
+        self._queue = []
+        self._call = None
+        self._write = None # the Deferred for a write in its thread
+        self._stopped = False
+        self.dropped = 0
+
+    def emit(self, record):
+        if len(self._queue) >= self.MAX_QUEUED:
+            self.dropped += 1
+            return
+        self._queue.append(record)
+        self._schedule()
+
+    def _schedule(self):
+        if (self._call is None and self._write is None and self._queue
+                and not self._stopped):
+            self._call = self._reactor.callLater(self._interval, self._flush)
+
+    def _flush(self):
+        self._call = None
+        records, self._queue = self._queue, []
+        d = self._write = self._in_thread(_write_lines, self._file, records)
+        d.addErrback(log.err, "error writing the request log")
+        d.addBoth(self._written)
+
+    def _written(self, _):
+        self._write = None
+        self._schedule()
+
+    def _write_rest(self):
+        records, self._queue = self._queue, []
+        if records:
+            _write_lines(self._file, records)
+
+    def stopService(self):
+        Service.stopService(self)
+        self._stopped = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._write is None:
+            self._write_rest()
+            return succeed(None)
+        # the rest has to wait for the write in its thread, rather than
+        # going into the same file alongside it
+        d = self._write
+        d.addCallback(lambda _: self._write_rest())
+        return d
@@ -0,0 +1,333 @@
+"""
+Retention of the ``usage`` table.
+
+Rows older than the retention period are first folded into per-day
+``usage_rollups`` (so long-term totals survive) and then deleted. This
+happens a small batch at a time, each batch in its own short
+transaction, from a worker thread with its own database connection:
+the DatabaseUsageRecorder on the reactor thread only ever waits for a
+single batch to commit. Pages freed by the deletes are handed back to
+the filesystem with ``PRAGMA incremental_vacuum``, also in small steps.
+
+For a time-partitioned database (--usage-db-partition), whole partitions
+that are past the retention period are summarized and then simply
+deleted (except those still being written to, see prune_partitions).
+
+The ``stats_history`` snapshots can be downsampled in the same way
+(--stats-history-downsample): those older than a given age are averaged
+into one row per HOUR.
+"""
+
+import os
+import time
+from contextlib import nullcontext
+
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+
+from .database import open_existing_db, partition_bounds, PartitionedDB
+
+HOUR = 60*60
+DAY = 24*HOUR
+
+# rows folded and deleted per transaction
+BATCH_SIZE = 500
+# pages given back to the filesystem per incremental_vacuum step
+VACUUM_PAGES = 256
+# seconds to sleep between batches, so other writers can get the lock
+PAUSE = 0.01
+
+# The oldest `batch_size` rows (in `started`-index order, so this is
+# deterministic and needs no sort) that are older than the cutoff. Both
+# statements of a batch use the same selection, inside one transaction.
+_BATCH = (
+    "SELECT `rowid` FROM `usage` WHERE `started` < ?"
+    " ORDER BY `started`, `rowid` LIMIT ?"
+)
+
+
+# the rollup columns for a group of usage rows: sampled rows (see
+# --usage-sample) stand for `weight` connections each
+_SUMS = (
+    "SUM(`weight`), SUM(`total_bytes` * `weight`),"
+    " SUM(`total_time_ms` * `weight`),"
+    " COALESCE(SUM(`waiting_time_ms` * `weight`), 0)"
+)
+
+_MERGE_ROLLUP = (
+    " ON CONFLICT (`day`, `mood`) DO UPDATE SET"
+    "  `connections` = `connections` + excluded.`connections`,"
+    "  `total_bytes` = `total_bytes` + excluded.`total_bytes`,"
+    "  `total_time_ms` = `total_time_ms` + excluded.`total_time_ms`,"
+    "  `waiting_time_ms` = `waiting_time_ms` + excluded.`waiting_time_ms`"
+)
+
+
+def prune_usage_batch(db, cutoff, batch_size=BATCH_SIZE):
+    """
+    Fold up to ``batch_size`` usage rows which started before ``cutoff``
+    into the rollups and delete them, as a single transaction.
+
+    :returns int: the number of rows deleted
+    """
+    with db:
+        db.execute(
+            ("INSERT INTO `usage_rollups`"
+             " (`day`, `mood`, `connections`, `total_bytes`,"
+             "  `total_time_ms`, `waiting_time_ms`)"
+             " SELECT `started` / %d * %d, `mood`, %s"
+             " FROM `usage` WHERE `rowid` IN (%s)"
+             " GROUP BY 1, 2" % (DAY, DAY, _SUMS, _BATCH)) + _MERGE_ROLLUP,
+            (cutoff, batch_size)
+        )
+        cursor = db.execute(
+            "DELETE FROM `usage` WHERE `rowid` IN (%s)" % _BATCH,
+            (cutoff, batch_size)
+        )
+    return cursor.rowcount
+
+
+def incremental_vacuum(db, pages=VACUUM_PAGES, pause=PAUSE):
+    """
+    Return the free pages of ``db`` to the filesystem, ``pages`` at a
+    time. This only does anything for databases created with
+    ``auto_vacuum = INCREMENTAL`` (all of ours since retention was
+    added); older files need a one-time ``VACUUM`` to switch modes.
+
+    :returns int: the number of free pages that were released
+    """
+    released = 0
+    while True:
+        free = db.execute("PRAGMA freelist_count").fetchone()["freelist_count"]
+        if not free:
+            return released
+        # the pragma only does its work as the result rows are stepped
+        db.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+        remaining = db.execute("PRAGMA freelist_count").fetchone()["freelist_count"]
+        if remaining >= free:
+            # auto_vacuum is off, so nothing can be released
+            return released
+        released += free - remaining
+        time.sleep(pause)
+
+
+def prune_usage(db, cutoff, batch_size=BATCH_SIZE, pause=PAUSE):
+    """
+    Fold every usage row which started before ``cutoff`` into the
+    rollups, delete them, and release the freed pages. This blocks, and
+    should only be run from a worker thread (or a migration tool).
+
+    :returns int: the number of rows deleted
+    """
+    total = 0
+    while True:
+        deleted = prune_usage_batch(db, cutoff, batch_size)
+        total += deleted
+        if deleted < batch_size:
+            break
+        time.sleep(pause)
+    if total:
+        incremental_vacuum(db, pause=pause)
+    return total
+
+
+def downsample_history(db, cutoff, resolution=HOUR):
+    """
+    Replace the ``stats_history`` rows from before ``cutoff`` (rounded
+    down to a whole ``resolution``) with one row per ``resolution``
+    seconds, averaging them. Doing this again to the same rows changes
+    nothing.
+
+    :returns int: the number of rows removed
+    """
+    cutoff = cutoff // resolution * resolution
+    with db:
+        buckets = db.execute(
+            "SELECT `updated` / ? * ? AS `bucket`, SUM(`points`) AS `points`,"
+            " SUM(`connected` * `points`) AS `connected`,"
+            " SUM(`waiting` * `points`) AS `waiting`,"
+            " SUM(`incomplete_bytes` * `points`) AS `incomplete_bytes`,"
+            " COUNT() AS `rows`"
+            " FROM `stats_history` WHERE `updated` < ?"
+            " GROUP BY 1"
+            # (a bucket already downsampled is one row, at its start)
+            " HAVING `rows` > 1 OR MIN(`updated`) != `bucket`",
+            (resolution, resolution, cutoff)
+        ).fetchall()
+        removed = 0
+        for b in buckets:
+            db.execute(
+                "DELETE FROM `stats_history` WHERE `updated` >= ? AND `updated` < ?",
+                (b["bucket"], b["bucket"] + resolution)
+            )
+            db.execute(
+                "INSERT INTO `stats_history`"
+                " (`updated`, `points`, `connected`, `waiting`, `incomplete_bytes`)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (b["bucket"], b["points"],
+                 int(round(b["connected"] / b["points"])),
+                 int(round(b["waiting"] / b["points"])),
+                 int(round(b["incomplete_bytes"] / b["points"])))
+            )
+            removed += b["rows"] - 1
+    return removed
+
+
+def drop_partition(index_db, start, path):
+    """
+    Fold everything in one partition file into the rollups of the index
+    database, forget about the partition, and delete its file. Reading a
+    whole (closed) partition once is much cheaper than deleting its rows,
+    and the write to the index database is a handful of rows.
+    """
+    rows = []
+    if os.path.exists(path):
+        part = open_existing_db(path)
+        try:
+            rows = part.execute(
+                "SELECT `started` / %d * %d, `mood`, %s"
+                " FROM `usage` GROUP BY 1, 2"
+                " UNION ALL"
+                " SELECT `day`, `mood`, `connections`, `total_bytes`,"
+                "  `total_time_ms`, `waiting_time_ms` FROM `usage_rollups`"
+                % (DAY, DAY, _SUMS)
+            ).fetchall()
+        finally:
+            part.close()
+    with index_db:
+        index_db.executemany(
+            "INSERT INTO `usage_rollups`"
+            " (`day`, `mood`, `connections`, `total_bytes`,"
+            "  `total_time_ms`, `waiting_time_ms`)"
+            " VALUES (?,?,?,?,?,?)" + _MERGE_ROLLUP,
+            [tuple(row.values()) for row in rows]
+        )
+        index_db.execute("DELETE FROM `partitions` WHERE `start`=?", (start,))
+    for suffix in ("", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def prune_partitions(partitioned_db, cutoff, batch_size=BATCH_SIZE, pause=PAUSE,
+                     now=None, recorder=None):
+    """
+    Apply the retention policy to a PartitionedDB: partitions which end
+    before ``cutoff`` are dropped whole, and the one that spans it is
+    pruned row by row (into its own rollups, which are merged into the
+    index when it is eventually dropped).
+
+    The partitions for the period containing ``now`` (by default, the
+    current time) and the one before it are never dropped, since usage
+    records are still being written to them: they are only pruned row
+    by row. Neither is one that ``recorder`` (None, or the relay's
+    usage.PartitionedDatabaseUsageRecorder) has open; it is asked to
+    close it, so it can be dropped next time. ``partitioned_db`` closes
+    its own before they are dropped.
+
+    :returns int: the number of partitions dropped
+    """
+    current, _ = partition_bounds(time.time() if now is None else now,
+                                  partitioned_db.period)
+    previous, _ = partition_bounds(current - 1, partitioned_db.period)
+    dropped = 0
+    for (start, end, path) in partitioned_db.partitions(end=cutoff):
+        if end <= cutoff and start not in (current, previous):
+            # (while we hold the recorder's lock, it opens no partitions)
+            with recorder.lock if recorder is not None else nullcontext():
+                if recorder is None or recorder.release_partition(start):
+                    partitioned_db.close_partition(start)
+                    drop_partition(partitioned_db.index, start, path)
+                    dropped += 1
+        elif os.path.exists(path):
+            part = open_existing_db(path)
+            try:
+                prune_usage(part, cutoff, batch_size, pause)
+            finally:
+                part.close()
+    return dropped
+
+
+class UsagePruner(object):
+    """
+    Periodically applies the retention policy to a usage database file,
+    in a thread from the reactor's threadpool.
+    """
+
+    def __init__(self, reactor, dbfile, retention, get_timestamp,
+                 batch_size=BATCH_SIZE, partition=None, history_age=None,
+                 recorder=None):
+        """
+        :param reactor: the reactor whose threadpool we use
+
+        :param str dbfile: path of the usage database; the worker thread
+            opens its own connection to it
+
+        :param float retention: seconds of detailed usage rows to keep,
+            or None to keep them all
+
+        :param get_timestamp: callable returning the current time
+
+        :param partition: None, or the period (see --usage-db-partition)
+            if ``dbfile`` is the index of a PartitionedDB
+
+        :param float history_age: None, or seconds after which the
+            ``stats_history`` snapshots are downsampled
+
+        :param recorder: None, or the PartitionedDatabaseUsageRecorder
+            writing to a partitioned ``dbfile`` (see prune_partitions)
+        """
+        self._reactor = reactor
+        self._dbfile = dbfile
+        self._retention = retention
+        self._timestamp = get_timestamp
+        self._batch_size = batch_size
+        self._partition = partition
+        self._history_age = history_age
+        self._recorder = recorder
+
+    def prune(self):
+        """
+        Prune in the background.
+
+        :returns Deferred: fires with the number of rows (or, for a
+            partitioned database, partitions) deleted, or None if pruning
+            failed (which is logged)
+        """
+        now = self._timestamp()
+        cutoff = now - self._retention if self._retention is not None else None
+        d = deferToThreadPool(
+            self._reactor,
+            self._reactor.getThreadPool(),
+            self._prune_in_thread,
+            now,
+            cutoff,
+            now - self._history_age if self._history_age is not None else None,
+        )
+
+        def done(deleted):
+            if deleted:
+                log.msg("pruned %d usage %s older than %d" % (
+                    deleted,
+                    "partitions" if self._partition else "records",
+                    cutoff,
+                ))
+            return deleted
+        d.addCallback(done)
+        d.addErrback(log.err, "error while pruning usage database")
+        return d
+
+    def _prune_in_thread(self, now, cutoff, history_cutoff):
+        db = open_existing_db(self._dbfile)
+        try:
+            if history_cutoff is not None:
+                # (in the index, if partitioned)
+                downsample_history(db, history_cutoff)
+            if cutoff is None:
+                return 0
+            if self._partition is not None:
+                partitioned = PartitionedDB(self._dbfile, self._partition, db)
+                return prune_partitions(partitioned, cutoff, self._batch_size,
+                                        now=now, recorder=self._recorder)
+            return prune_usage(db, cutoff, self._batch_size)
+        finally:
+            db.close()
@@ -1,12 +1,16 @@
-from collections import defaultdict
+import math
+import time
+from collections import defaultdict, OrderedDict
+from itertools import count
 
 import automat
-from twisted.python import log
 from zope.interface import (
     Interface,
     Attribute,
 )
 
+from .requestlog import log_request
+
 
 class ITransitClient(Interface):
     """
@@ -15,6 +19,7 @@ class ITransitClient(Interface):
     """
 
     started_time = Attribute("timestamp when the connection was established")
+    kind = Attribute("the kind of transport: 'tcp' or 'websocket'")
 
     def send(data):
         """
@@ -38,34 +43,172 @@ class ITransitClient(Interface):
         """
 
 
+class Session(object):
+    """
+    A pair of connections that have been glued together.
+
+    Everything about the pair as a whole is here (or a step away, on
+    one of the two sides), so nothing needs to look through all the
+    connections to find it.
+    """
+    __slots__ = ("id", "sides", "paired_time", "total_bytes", "_active",
+                 "_rate", "_rate_bytes", "_rate_updated")
+
+    # time constant of the throughput average, in seconds
+    RATE_WINDOW = 10.0
+
+    def __init__(self, id, side0, side1, paired_time, active=None):
+        """
+        :param int id: unique among our ActiveConnections' sessions
+
+        :param TransitServerState side0: the side that was waiting
+
+        :param TransitServerState side1: the side that completed the pair
+
+        :param float paired_time: when the pair was completed
+
+        :param active: None, or the ActiveConnections that registered
+            us, whose totals count the bytes we relay
+        """
+        self.id = id
+        self.sides = (side0, side1)
+        self.paired_time = paired_time
+        # the bytes relayed so far, in both directions (including any
+        # early data sent before the pair was completed)
+        self.total_bytes = side0._total_sent + side1._total_sent
+        self._active = active
+        # the moving average of bytes/second (both directions), when it
+        # was last brought up to date, and the bytes relayed since then
+        self._rate = 0.0
+        self._rate_updated = None
+        self._rate_bytes = 0
+
+    def _decay_rate(self, now):
+        if self._rate_updated is None:
+            self._rate_updated = now
+            return
+        elapsed = now - self._rate_updated
+        if elapsed > 0:
+            weight = 1.0 - math.exp(-elapsed / self.RATE_WINDOW)
+            self._rate += weight * (self._rate_bytes / elapsed - self._rate)
+            self._rate_bytes = 0
+            self._rate_updated = now
+
+    def count_bytes(self, count):
+        """
+        ``count`` more bytes were relayed (by either side).
+        """
+        self.total_bytes += count
+        if self._active is not None:
+            self._active.incomplete_bytes += count
+
+    def note_bytes(self, count, now):
+        """
+        ``count`` more bytes were relayed (by either side). This runs for
+        every chunk, so the average is only brought up to date when
+        ``now`` (a TimerWheel's clock) has moved on.
+        """
+        if now != self._rate_updated:
+            self._decay_rate(now)
+        self._rate_bytes += count
+
+    def get_rate(self, now):
+        """
+        :returns float: a moving average of the bytes/second relayed,
+            over about RATE_WINDOW seconds up to ``now`` (so it falls
+            while the pair is silent)
+        """
+        self._decay_rate(now)
+        return self._rate
+
+    def partner_of(self, side):
+        """
+        :returns TransitServerState: the side that isn't ``side``
+        """
+        return self.sides[1] if side is self.sides[0] else self.sides[0]
+
+    @property
+    def started_time(self):
+        """
+        When the first of the two connections was established.
+        """
+        return min(side._client.started_time for side in self.sides)
+
+    @property
+    def kinds(self):
+        """
+        The kinds of transport of the two sides, like ("tcp", "websocket").
+        """
+        return tuple(side._client.kind for side in self.sides)
+
+
 class ActiveConnections(object):
     """
     Tracks active connections.
 
     A connection is 'active' when both sides have shown up and they
     are glued together (and thus could be passing data back and forth
-    if any is flowing).
+    if any is flowing). Each pair is a Session, indexed by its id,
+    until both of its sides have become inactive.
+
+    ``incomplete_bytes`` is the bytes sent so far by all of the active
+    sides. It is kept up to date as they come and go (and as their
+    Sessions relay more), so it never needs adding up.
     """
     def __init__(self):
         self._connections = set()
+        self._sessions = {} # id -> Session
+        self._ids = count(1)
+        self.incomplete_bytes = 0
+
+    def __len__(self):
+        """
+        :returns int: how many sides are active
+        """
+        return len(self._connections)
 
     def register(self, side0, side1):
         """
         A connection has become active so register both its sides
 
-        :param TransitConnection side0: one side of the connection
-        :param TransitConnection side1: one side of the connection
+        :param TransitServerState side0: the side that was waiting
+        :param TransitServerState side1: the side that completed the pair
+
+        :returns Session: the new pair
         """
+        session = Session(next(self._ids), side0, side1, time.time(), self)
+        self._sessions[session.id] = session
         self._connections.add(side0)
         self._connections.add(side1)
+        self.incomplete_bytes += session.total_bytes
+        side0._session = side1._session = session
+        return session
 
     def unregister(self, side):
         """
         One side of a connection has become inactive.
 
-        :param TransitConnection side: an inactive side of a connection
+        :param TransitServerState side: an inactive side of a connection
         """
-        self._connections.discard(side)
+        if side not in self._connections:
+            return
+        self._connections.remove(side)
+        self.incomplete_bytes -= side._total_sent
+        session = side._session
+        if session is not None and session.partner_of(side) not in self._connections:
+            self._sessions.pop(session.id, None)
+
+    def get_session(self, id):
+        """
+        :returns: the Session with this ``id``, or None if it has ended
+        """
+        return self._sessions.get(id)
+
+    def sessions(self):
+        """
+        :returns list: every current Session, oldest first
+        """
+        return list(self._sessions.values())
 
 
 class PendingRequests(object):
@@ -77,15 +220,47 @@ class PendingRequests(object):
     correct partner connection. At this point, the connection becomes
     "active" is and is thus no longer "pending" and so will no longer
     be in this collection.
+
+    We also account for the early data (see TransitServerState) held by
+    all of the waiting connections together, which may not exceed
+    EARLY_DATA_TOTAL bytes.
+
+    The waiting connections are also kept in the order they registered,
+    so that when we are short of file descriptors the ones that have
+    waited longest can be evicted (see fdpressure.py) without a scan.
     """
 
+    EARLY_DATA_TOTAL = 16*1000*1000
+
     def __init__(self, active_connections):
         """
         :param active_connections: an instance of ActiveConnections where
             connections are put when both sides arrive.
         """
         self._requests = defaultdict(set) # token -> set((side, TransitConnection))
+        self._lonely = OrderedDict() # TransitConnection -> (token, side), oldest first
         self._active = active_connections
+        self.early_data_bytes = 0
+        # connections closed for not finishing their handshake in time
+        self.handshake_timeouts = 0
+
+    def reserve_early_data(self, count):
+        """
+        A waiting connection wants to hold ``count`` more bytes of early
+        data.
+
+        :returns bool: False if that would exceed the overall limit
+        """
+        if self.early_data_bytes + count > self.EARLY_DATA_TOTAL:
+            return False
+        self.early_data_bytes += count
+        return True
+
+    def release_early_data(self, count):
+        """
+        ``count`` bytes of early data have been sent on, or dropped.
+        """
+        self.early_data_bytes -= count
 
     def unregister(self, token, side, tc):
         """
@@ -97,8 +272,27 @@ class PendingRequests(object):
             if not self._requests[token]:
                 # no more sides; token is dead
                 del self._requests[token]
+        self._lonely.pop(tc, None)
         self._active.unregister(tc)
 
+    def evict_oldest(self, count):
+        """
+        We need to close some connections: evict up to ``count`` of those
+        that have waited longest for their partner.
+
+        :returns list: the TransitServerStates we evicted
+        """
+        evicted = []
+        while self._lonely and len(evicted) < count:
+            tc, (token, side) = self._lonely.popitem(last=False)
+            if token in self._requests:
+                self._requests[token].discard((side, tc))
+                if not self._requests[token]:
+                    del self._requests[token]
+            tc.evicted()
+            evicted.append(tc)
+        return evicted
+
     def register(self, token, new_side, new_tc):
         """
         A client has connected and successfully offered a token (and
@@ -125,7 +319,9 @@ class PendingRequests(object):
 
                 # drop and stop tracking the rest
                 potentials.remove(old)
+                del self._lonely[old_tc]
                 for (_, leftover_tc) in potentials.copy():
+                    self._lonely.pop(leftover_tc, None)
                     # Don't record this as errory. It's just a spare connection
                     # from the same side as a connection that got used. This
                     # can happen if the connection hint contains multiple
@@ -135,12 +331,13 @@ class PendingRequests(object):
                 self._requests.pop(token, None)
 
                 # glue the two ends together
-                self._active.register(new_tc, old_tc)
+                self._active.register(old_tc, new_tc)
                 new_tc.got_partner(old_tc)
                 old_tc.got_partner(new_tc)
                 return False
 
         potentials.add((new_side, new_tc))
+        self._lonely[new_tc] = (token, new_side)
         return True
         # TODO: timer
 
@@ -163,10 +360,43 @@ class TransitServerState(object):
     _first = None
     _mood = "empty"
     _total_sent = 0
+    # None, or chunks received before "ok\n" (if the client asked for
+    # early data)
+    _early_data = None
+    _early_size = 0
+    # activity (with a TimerWheel): when our client last sent anything
+    _last_activity = None
+    # the pending idle check (see _watch_idle)
+    _idle_check = None
+    # True while in the "relaying" state
+    _relaying = False
+    # the pending handshake deadline (see _start_handshake_deadline)
+    _handshake_deadline = None
+    _paired_at = None
+    # our Session, once we have a partner (see ActiveConnections)
+    _session = None
+
+    # how much early data one connection may send
+    EARLY_DATA_MAX = 64*1024
+
+    def __init__(self, pending_requests, usage_recorder, timers=None, idle_timeout=None,
+                 handshake_timeout=None):
+        """
+        :param timers: a TimerWheel, for timeouts and as our clock (or
+            None, to track no activity and never time out)
+
+        :param idle_timeout: None, or seconds after which a relaying
+            pair where neither side has sent anything is disconnected
 
-    def __init__(self, pending_requests, usage_recorder):
+        :param handshake_timeout: None, or seconds after which a
+            connection that hasn't sent a complete handshake is
+            disconnected
+        """
         self._pending_requests = pending_requests
         self._usage = usage_recorder
+        self._timers = timers
+        self._idle_timeout = idle_timeout
+        self._handshake_timeout = handshake_timeout
 
     def get_token(self):
         """
@@ -185,6 +415,104 @@ class TransitServerState(object):
                 d += "-<unsided>"
         return d
 
+    def get_mood(self):
+        """
+        :returns str: our mood (see database.MOODS) so far
+        """
+        return self._mood
+
+    def get_rate(self):
+        """
+        :returns float: a moving average of the bytes/second our pair
+            has relayed (see Session.get_rate), or 0.0 when activity is
+            not tracked or we have no partner
+        """
+        if self._timers is None or self._session is None:
+            return 0.0
+        return self._session.get_rate(self._timers.now)
+
+    def _note_activity(self, count):
+        """
+        Our client sent ``count`` bytes. This runs for every chunk of
+        relayed data, so it only reads the wheel's clock.
+        """
+        if self._timers is None:
+            return
+        now = self._last_activity = self._timers.now
+        if self._session is not None:
+            self._session.note_bytes(count, now)
+
+    def _check_idle(self):
+        """
+        Our idle check is due: close the pair if neither side has sent
+        anything for idle_timeout seconds, or check again when they
+        would have.
+        """
+        self._idle_check = None
+        # (an offloaded pair's activity arrives through
+        # got_offloaded_bytes, every offload.REPORT_INTERVAL seconds)
+        if self._check_idle_later():
+            return
+        if getattr(self._client, "offload", None):
+            # a relay thread owns the sockets: it must give them back
+            # before they can be closed
+            offloader = self._client.factory.transit.offloader
+            if offloader.release(self._client, self._released_idle):
+                return
+        self._close_idle()
+
+    def _check_idle_later(self):
+        """
+        :returns bool: True if either side has sent something in the
+            last idle_timeout seconds, in which case the next check has
+            been scheduled
+        """
+        last = max(
+            t for t in (self._last_activity, self._buddy._last_activity, self._paired_at)
+            if t is not None
+        )
+        remaining = last + self._idle_timeout - self._timers.now
+        if remaining <= 0:
+            return False
+        self._idle_check = self._timers.schedule(remaining, self._check_idle)
+        return True
+
+    def _released_idle(self):
+        """
+        A relay thread has handed back our pair, which was idle when we
+        asked for it.
+        """
+        if not (self._relaying and self._buddy._relaying):
+            # one side closed meanwhile, which takes the other with it
+            return
+        if self._check_idle_later():
+            # the last bytes it reported were new: relay them again
+            self._client.factory.transit.offloader.resume(
+                self._client, self._buddy._client)
+            return
+        self._close_idle()
+
+    def _close_idle(self):
+        log_request(self._client.factory, "idle", token=self.get_token)
+        buddy = self._buddy
+        self.idle_timeout()
+        buddy.idle_timeout()
+
+    def take_early_data(self):
+        """
+        Our partner has just sent "ok\n" to its client, which may now
+        receive whatever our client sent before its own "ok\n".
+
+        :returns bytes: our early data (which we forget)
+        """
+        if not self._early_size:
+            return b""
+        data = b"".join(self._early_data)
+        self._pending_requests.release_early_data(self._early_size)
+        self._early_data = []
+        self._early_size = 0
+        return data
+
     @_machine.input()
     def connection_made(self, client):
         """
@@ -210,6 +538,20 @@ class TransitServerState(object):
         second version of the protocol).
         """
 
+    @_machine.input()
+    def please_relay_for_side_with_early_data(self, token, side):
+        """
+        A 'please relay X for side Y with early-data' message has been
+        received: the client may send (a limited amount of) data before
+        our "ok\n", which we hold until its partner arrives.
+        """
+
+    @_machine.input()
+    def early_data_exceeded(self):
+        """
+        Our client sent more early data than we are willing to hold.
+        """
+
     @_machine.input()
     def bad_token(self):
         """
@@ -240,6 +582,42 @@ class TransitServerState(object):
         Some bytes have arrived (that aren't part of the handshake)
         """
 
+    @_machine.input()
+    def refused(self):
+        """
+        We won't serve this connection (its address already has as many
+        connections as it may, or the reactor is overloaded), so it is
+        closed without being recorded.
+        """
+
+    @_machine.input()
+    def evicted(self):
+        """
+        We are short of file descriptors, and have waited for our partner
+        longer than anyone else (PendingRequests has already forgotten
+        us).
+        """
+
+    @_machine.input()
+    def handshake_timeout(self):
+        """
+        Our client hasn't finished its handshake in time.
+        """
+
+    @_machine.input()
+    def idle_timeout(self):
+        """
+        Neither our client nor our partner has sent anything for too
+        long.
+        """
+
+    @_machine.input()
+    def got_offloaded_bytes(self, count):
+        """
+        A relay thread has moved ``count`` more bytes from our client to
+        our partner (see offload.py)
+        """
+
     @_machine.output()
     def _remember_client(self, client):
         self._client = client
@@ -267,8 +645,7 @@ class TransitServerState(object):
     def _send_bad(self):
         self._mood = "errory"
         self._client.send(b"bad handshake\n")
-        if self._client.factory.log_requests:
-            log.msg("transit handshake failure")
+        log_request(self._client.factory, "bad_handshake")
 
     @_machine.output()
     def _send_ok(self):
@@ -277,12 +654,87 @@ class TransitServerState(object):
     @_machine.output()
     def _send_impatient(self):
         self._client.send(b"impatient\n")
-        if self._client.factory.log_requests:
-            log.msg("transit impatience failure")
+        log_request(self._client.factory, "impatient")
 
     @_machine.output()
     def _count_bytes(self, data):
-        self._total_sent += len(data)
+        self._count(len(data))
+
+    @_machine.output()
+    def _count_offloaded_bytes(self, count):
+        self._count(count)
+
+    def _count(self, count):
+        self._total_sent += count
+        if self._session is not None:
+            # (we only count bytes with a Session while relaying, and so
+            # while registered with its ActiveConnections)
+            self._session.count_bytes(count)
+        self._note_activity(count)
+
+    @_machine.output()
+    def _start_handshake_deadline(self, client):
+        if self._timers is None or self._handshake_timeout is None:
+            return
+        self._handshake_deadline = self._timers.schedule(
+            self._handshake_timeout, self.handshake_timeout)
+
+    @_machine.output()
+    def _cancel_handshake_deadline(self):
+        if self._handshake_deadline is not None:
+            self._handshake_deadline.cancel()
+            self._handshake_deadline = None
+
+    @_machine.output()
+    def _count_handshake_timeout(self):
+        self._handshake_deadline = None
+        self._pending_requests.handshake_timeouts += 1
+        log_request(self._client.factory, "handshake_timeout")
+
+    @_machine.output()
+    def _watch_idle(self, client):
+        # (this and _stop_watching_idle happen on the way into and out of
+        # the "relaying" state)
+        self._relaying = True
+        # one check per pair is enough: the side that arrived first keeps it
+        if self._timers is None or self._idle_timeout is None or not self._first:
+            return
+        self._paired_at = self._timers.now
+        self._idle_check = self._timers.schedule(self._idle_timeout, self._check_idle)
+
+    @_machine.output()
+    def _stop_watching_idle(self):
+        self._relaying = False
+        if self._idle_check is not None:
+            self._idle_check.cancel()
+            self._idle_check = None
+
+    @_machine.output()
+    def _accept_early_data(self):
+        self._early_data = []
+
+    @_machine.output()
+    def _buffer_early_data(self, data):
+        if (self._early_size + len(data) > self.EARLY_DATA_MAX
+            or not self._pending_requests.reserve_early_data(len(data))):
+            # the transition has already happened, so this is processed
+            # from the wait_partner_early state
+            self.early_data_exceeded()
+            return
+        self._early_data.append(data)
+        self._early_size += len(data)
+
+    @_machine.output()
+    def _drop_early_data(self):
+        self._pending_requests.release_early_data(self._early_size)
+        self._early_data = None
+        self._early_size = 0
+
+    @_machine.output()
+    def _send_partner_early_data(self, client):
+        data = client.take_early_data()
+        if data:
+            self._client.send(data)
 
     @_machine.output()
     def _send_to_partner(self, data):
@@ -302,17 +754,44 @@ class TransitServerState(object):
         self._client.disconnect_partner()
 
     # some outputs to record "usage" information ..
+    def _buddy_records_usage(self):
+        """
+        Both sides of a pair end up 'done', but the pair is recorded
+        only once.
+
+        :returns bool: True if our partner records it, not us
+        """
+        if self._buddy is None:
+            return False
+        if self._mood == "jilted":
+            # we hung up first, and our partner will be "happy"
+            return self._buddy._mood == "happy"
+        if self._mood == "idle":
+            # both sides were closed together: the first one records
+            return not self._first
+        return False
+
     @_machine.output()
     def _record_usage(self):
-        if self._mood == "jilted":
-            if self._buddy and self._buddy._mood == "happy":
-                return
+        if self._buddy_records_usage():
+            return
+        session = self._session
+        if session is None:
+            self._usage.record(
+                started=self._client.started_time,
+                buddy_started=None,
+                result=self._mood,
+                bytes_sent=self._total_sent,
+                buddy_bytes=None,
+            )
+            return
+        partner = session.partner_of(self)
         self._usage.record(
             started=self._client.started_time,
-            buddy_started=self._buddy._client.started_time if self._buddy is not None else None,
+            buddy_started=partner._client.started_time,
             result=self._mood,
             bytes_sent=self._total_sent,
-            buddy_bytes=self._buddy._total_sent if self._buddy is not None else None
+            buddy_bytes=partner._total_sent,
         )
 
     # some outputs to record the "mood" ..
@@ -336,6 +815,15 @@ class TransitServerState(object):
     def _mood_errory(self):
         self._mood = "errory"
 
+    @_machine.output()
+    def _mood_idle(self):
+        self._mood = "idle"
+
+    @_machine.output()
+    def _mood_evicted(self):
+        self._mood = "evicted"
+        log_request(self._client.factory, "evicted", token=self.get_token)
+
     @_machine.output()
     def _mood_happy_if_first(self):
         """
@@ -381,6 +869,12 @@ class TransitServerState(object):
         Waiting for our partner to connect
         """
 
+    @_machine.state()
+    def wait_partner_early(self):
+        """
+        Waiting for our partner to connect, holding any early data
+        """
+
     @_machine.state()
     def relaying(self):
         """
@@ -396,44 +890,59 @@ class TransitServerState(object):
     listening.upon(
         connection_made,
         enter=wait_relay,
-        outputs=[_remember_client],
+        outputs=[_remember_client, _start_handshake_deadline],
     )
     listening.upon(
         connection_lost,
         enter=done,
         outputs=[_mood_errory],
     )
+    listening.upon(
+        refused,
+        enter=done,
+        outputs=[_mood_errory],
+    )
 
     wait_relay.upon(
         please_relay,
         enter=wait_partner,
-        outputs=[_mood_lonely, _register_token],
+        outputs=[_cancel_handshake_deadline, _mood_lonely, _register_token],
     )
     wait_relay.upon(
         please_relay_for_side,
         enter=wait_partner,
-        outputs=[_mood_lonely, _register_token_for_side],
+        outputs=[_cancel_handshake_deadline, _mood_lonely, _register_token_for_side],
+    )
+    wait_relay.upon(
+        please_relay_for_side_with_early_data,
+        enter=wait_partner_early,
+        outputs=[_cancel_handshake_deadline, _mood_lonely, _accept_early_data, _register_token_for_side],
     )
     wait_relay.upon(
         bad_token,
         enter=done,
-        outputs=[_mood_errory, _send_bad, _disconnect, _record_usage],
+        outputs=[_cancel_handshake_deadline, _mood_errory, _send_bad, _disconnect, _record_usage],
     )
     wait_relay.upon(
         got_bytes,
         enter=done,
-        outputs=[_count_bytes, _mood_errory, _disconnect, _record_usage],
+        outputs=[_cancel_handshake_deadline, _count_bytes, _mood_errory, _disconnect, _record_usage],
     )
     wait_relay.upon(
         connection_lost,
         enter=done,
-        outputs=[_disconnect, _record_usage],
+        outputs=[_cancel_handshake_deadline, _disconnect, _record_usage],
+    )
+    wait_relay.upon(
+        handshake_timeout,
+        enter=done,
+        outputs=[_count_handshake_timeout, _mood_errory, _disconnect, _record_usage],
     )
 
     wait_partner.upon(
         got_partner,
         enter=relaying,
-        outputs=[_mood_happy, _send_ok, _connect_partner],
+        outputs=[_mood_happy, _send_ok, _send_partner_early_data, _connect_partner, _watch_idle],
     )
     wait_partner.upon(
         connection_lost,
@@ -450,16 +959,62 @@ class TransitServerState(object):
         enter=done,
         outputs=[_mood_redundant, _disconnect, _record_usage],
     )
+    wait_partner.upon(
+        evicted,
+        enter=done,
+        outputs=[_mood_evicted, _disconnect, _record_usage],
+    )
+
+    wait_partner_early.upon(
+        got_partner,
+        enter=relaying,
+        outputs=[_mood_happy, _send_ok, _send_partner_early_data, _connect_partner, _watch_idle],
+    )
+    wait_partner_early.upon(
+        got_bytes,
+        enter=wait_partner_early,
+        outputs=[_count_bytes, _buffer_early_data],
+    )
+    wait_partner_early.upon(
+        early_data_exceeded,
+        enter=done,
+        outputs=[_mood_impatient, _send_impatient, _disconnect, _unregister, _drop_early_data, _record_usage],
+    )
+    wait_partner_early.upon(
+        connection_lost,
+        enter=done,
+        outputs=[_mood_lonely, _unregister, _drop_early_data, _record_usage],
+    )
+    wait_partner_early.upon(
+        partner_connection_lost,
+        enter=done,
+        outputs=[_mood_redundant, _disconnect, _drop_early_data, _record_usage],
+    )
+    wait_partner_early.upon(
+        evicted,
+        enter=done,
+        outputs=[_mood_evicted, _disconnect, _drop_early_data, _record_usage],
+    )
 
     relaying.upon(
         got_bytes,
         enter=relaying,
         outputs=[_count_bytes, _send_to_partner],
     )
+    relaying.upon(
+        got_offloaded_bytes,
+        enter=relaying,
+        outputs=[_count_offloaded_bytes],
+    )
     relaying.upon(
         connection_lost,
         enter=done,
-        outputs=[_mood_happy_if_first, _disconnect_partner, _unregister, _record_usage],
+        outputs=[_mood_happy_if_first, _stop_watching_idle, _disconnect_partner, _unregister, _record_usage],
+    )
+    relaying.upon(
+        idle_timeout,
+        enter=done,
+        outputs=[_mood_idle, _stop_watching_idle, _disconnect, _unregister, _record_usage],
     )
 
     done.upon(
@@ -472,6 +1027,11 @@ class TransitServerState(object):
         enter=done,
         outputs=[],
     )
+    done.upon(
+        idle_timeout,
+        enter=done,
+        outputs=[],
+    )
 
-    # uncomment to turn on state-machine tracing
-    # set_trace_function = _machine._setTrace
+    # tracer(old_state, input, new_state), see tracing.py
+    set_trace_function = _machine._setTrace
@@ -1,6 +1,8 @@
+import ipaddress
 import os
+import signal
 from twisted.internet import reactor
-from twisted.python import usage
+from twisted.python import usage, log
 from twisted.application.service import MultiService
 from twisted.application.internet import (TimerService,
                                           StreamServerEndpointService)
@@ -10,9 +12,31 @@ from twisted.internet import protocol
 from autobahn.twisted.websocket import WebSocketServerFactory
 
 from . import transit_server
-from .usage import create_usage_tracker
+from .usage import (
+    create_usage_tracker,
+    UsageSampler,
+    UsageFlushService,
+    PartitionedDatabaseUsageRecorder,
+)
+from .usagehelper import UsageHelper
 from .increase_rlimits import increase_rlimits
-from .database import get_db
+from .database import get_db, get_partitioned_db, PERIODS, MOODS
+from .retention import UsagePruner, DAY
+from .statsd import parse_address, create_statsd_service, StatsdUsageRecorder
+from .offload import Offloader, OFFLOAD_WINDOW
+from . import uring
+from .sockopts import socket_options_from_config
+from .fastpath import RelayReader, VectoredWriter
+from .timers import TimerWheel
+from .limits import ConnectionLimiter
+from .fdpressure import FdMonitor, fd_limit
+from .lag import LagMonitor
+from .profiling import Profiler, ProfilerService, PROFILE_MODES, PROFILE_SIGNAL
+from .tracing import TraceBuffer, TraceService
+from .requestlog import RequestLogger, JSONLinesSink
+from .shmstats import StatsSegment, StatsSegmentReporter
+
+RELAY_BACKENDS = ("reactor", "io_uring")
 
 LONGDESC = """\
 This plugin sets up a 'Transit Relay' server for magic-wormhole. This service
@@ -30,12 +54,234 @@ class Options(usage.Options):
         ("websocket-url", "u", None, "WebSocket URL (derived from endpoint if not provided)"),
         ("blur-usage", None, None, "blur timestamps and data sizes in logs"),
         ("log-fd", None, None, "write JSON usage logs to this file descriptor"),
+        ("request-log-fd", None, None, "write JSON logs of connection events (bad handshakes, refusals, ..) to this file descriptor"),
+        ("request-log-sample", None, 1.0, "the fraction of connection events to log"),
+        ("request-log-rate", None, 100, "log at most this many connection events per second"),
         ("usage-db", None, None, "record usage data (SQLite)"),
+        ("usage-retention", None, None, "summarize and delete usage records older than this many days"),
+        ("usage-db-partition", None, None, "split --usage-db into one file per: day, week, month"),
+        ("stats-history-downsample", None, None, "average --usage-db stats_history rows older than this many days into one per hour"),
+        ("usage-sample", None, None, "only record 1 in this many connections in full (exact totals are kept)"),
+        ("usage-sample-moods", None, None, "per-mood --usage-sample rates, like: happy:100,lonely:10,errory:1"),
+        ("statsd", None, None, "send metrics to a statsd aggregator at this IP:PORT (UDP)"),
+        ("statsd-prefix", None, "wormhole.transit", "prefix for statsd metric names"),
+        ("statsd-interval", None, 10.0, "seconds between statsd reports"),
+        ("stats-shm", None, None, "publish live statistics in this memory-mapped file (e.g. under /dev/shm)"),
+        ("stats-shm-interval", None, 1.0, "seconds between --stats-shm updates"),
+        ("offload-threads", None, 0, "relay the busiest TCP pairs from this many threads"),
+        ("offload-threshold", None, 10000000,
+         "bytes a pair must relay within %d seconds to be offloaded" % OFFLOAD_WINDOW),
+        ("relay-backend", None, "reactor", "how to relay TCP pairs: %s" % ", ".join(RELAY_BACKENDS)),
+        ("relay-read-size", None, None, "read paired TCP connections into a reusable buffer of this many bytes"),
+        ("idle-timeout", None, None, "disconnect relaying pairs that have sent nothing for this many seconds"),
+        ("handshake-timeout", None, 60.0, "disconnect connections that haven't sent a handshake within this many seconds (0: never)"),
+        ("profile-dir", None, None, "on SIGUSR1, profile the relay and write the result into this directory"),
+        ("profile-signal", None, None, "profile on this signal instead of SIGUSR1 (like: USR2, WINCH)"),
+        ("profile-mode", None, "sample", "how to profile: %s" % ", ".join(PROFILE_MODES)),
+        ("profile-seconds", None, 30.0, "how long each profile runs"),
+        ("trace-dir", None, None, "record a sample of state-machine transitions, dumped into this directory on SIGUSR2"),
+        ("trace-sample", None, 0.01, "the fraction of connections to trace"),
+        ("trace-size", None, 4096, "how many transitions to keep"),
+        ("trace-anomalies", None, None, "also dump the trace when a connection ends with one of these moods, like: impatient,evicted"),
+        ("lag-interval", None, 0.1, "seconds between probes of the reactor's lag (0: don't measure it)"),
+        ("shed-lag", None, None, "refuse new connections while the reactor is this many milliseconds behind"),
+        ("fd-high-water", None, 90.0, "evict the oldest lonely connections once this percent of RLIMIT_NOFILE is open (0: never)"),
+        ("max-connections-per-ip", None, None, "connections one IP address (or IPv6 network) may have at once"),
+        ("ipv6-prefix", None, 64, "IPv6 addresses count against their network of this many bits"),
+        ("limit-exempt", None, None, "networks exempt from --max-connections-per-ip, like: 10.0.0.0/8,::1"),
+        ("sndbuf", None, None, "SO_SNDBUF for each connection, in bytes"),
+        ("rcvbuf", None, None, "SO_RCVBUF for each connection, in bytes"),
+        ("notsent-lowat", None, None, "TCP_NOTSENT_LOWAT for each connection, in bytes"),
+        ("keepalive-idle", None, None, "seconds of silence before the first TCP keepalive probe"),
+        ("keepalive-interval", None, None, "seconds between TCP keepalive probes"),
+        ("keepalive-count", None, None, "unanswered TCP keepalive probes before dropping a connection"),
+        ("user-timeout", None, None, "milliseconds sent data may stay unacknowledged before dropping a connection"),
+        ]
+
+    optFlags = [
+        ("tcp-nodelay", None, "set TCP_NODELAY on each connection"),
+        ("relay-writev", None, "write queued data of paired TCP connections with one sendmsg"),
+        ("usage-helper", None, "write --usage-db and --log-fd from a separate process"),
         ]
 
     def opt_blur_usage(self, arg):
         self["blur-usage"] = int(arg)
 
+    def opt_request_log_sample(self, arg):
+        sample = float(arg)
+        if not 0 < sample <= 1:
+            raise usage.UsageError("--request-log-sample must be more than 0, and at most 1")
+        self["request-log-sample"] = sample
+
+    def opt_request_log_rate(self, arg):
+        self["request-log-rate"] = int(arg)
+
+    def opt_usage_retention(self, arg):
+        self["usage-retention"] = int(arg)
+
+    def opt_stats_history_downsample(self, arg):
+        self["stats-history-downsample"] = int(arg)
+
+    def opt_usage_db_partition(self, arg):
+        if arg not in PERIODS:
+            raise usage.UsageError(
+                "--usage-db-partition must be one of: %s" % ", ".join(PERIODS))
+        self["usage-db-partition"] = arg
+
+    def opt_usage_sample(self, arg):
+        self["usage-sample"] = int(arg)
+
+    def opt_usage_sample_moods(self, arg):
+        rates = {}
+        for item in arg.split(","):
+            try:
+                mood, rate = item.split(":")
+                rates[mood.strip()] = int(rate)
+            except ValueError:
+                raise usage.UsageError(
+                    "--usage-sample-moods wants MOOD:RATE[,MOOD:RATE..], not %r" % (arg,))
+        self["usage-sample-moods"] = rates
+
+    def opt_statsd(self, arg):
+        try:
+            parse_address(arg)
+        except ValueError:
+            raise usage.UsageError("--statsd wants IP:PORT, not %r" % (arg,))
+        self["statsd"] = arg
+
+    def opt_statsd_interval(self, arg):
+        self["statsd-interval"] = float(arg)
+
+    def opt_stats_shm_interval(self, arg):
+        self["stats-shm-interval"] = float(arg)
+
+    def opt_offload_threads(self, arg):
+        self["offload-threads"] = int(arg)
+
+    def opt_offload_threshold(self, arg):
+        self["offload-threshold"] = int(arg)
+
+    def opt_relay_backend(self, arg):
+        if arg not in RELAY_BACKENDS:
+            raise usage.UsageError(
+                "--relay-backend must be one of: %s" % ", ".join(RELAY_BACKENDS))
+        self["relay-backend"] = arg
+
+    def opt_relay_read_size(self, arg):
+        self["relay-read-size"] = int(arg)
+
+    def opt_idle_timeout(self, arg):
+        self["idle-timeout"] = float(arg)
+
+    def opt_handshake_timeout(self, arg):
+        self["handshake-timeout"] = float(arg)
+
+    def opt_profile_dir(self, arg):
+        if not os.path.isdir(arg):
+            raise usage.UsageError("--profile-dir: %r is not a directory" % (arg,))
+        self["profile-dir"] = arg
+
+    def opt_profile_mode(self, arg):
+        if arg not in PROFILE_MODES:
+            raise usage.UsageError(
+                "--profile-mode must be one of: %s" % ", ".join(PROFILE_MODES))
+        self["profile-mode"] = arg
+
+    def opt_profile_seconds(self, arg):
+        self["profile-seconds"] = float(arg)
+
+    def opt_profile_signal(self, arg):
+        name = arg.upper()
+        if not name.startswith("SIG"):
+            name = "SIG" + name
+        if not isinstance(getattr(signal, name, None), signal.Signals):
+            raise usage.UsageError("--profile-signal: %r is not a signal" % (arg,))
+        self["profile-signal"] = name
+
+    def opt_trace_dir(self, arg):
+        if not os.path.isdir(arg):
+            raise usage.UsageError("--trace-dir: %r is not a directory" % (arg,))
+        self["trace-dir"] = arg
+
+    def opt_trace_sample(self, arg):
+        sample = float(arg)
+        if not 0 < sample <= 1:
+            raise usage.UsageError("--trace-sample must be more than 0, and at most 1")
+        self["trace-sample"] = sample
+
+    def opt_trace_size(self, arg):
+        self["trace-size"] = int(arg)
+
+    def opt_trace_anomalies(self, arg):
+        moods = [mood.strip() for mood in arg.split(",") if mood.strip()]
+        for mood in moods:
+            if mood not in MOODS:
+                raise usage.UsageError("--trace-anomalies: %r is not a mood" % (mood,))
+        self["trace-anomalies"] = moods
+
+    def opt_lag_interval(self, arg):
+        self["lag-interval"] = float(arg)
+
+    def opt_shed_lag(self, arg):
+        self["shed-lag"] = float(arg)
+
+    def opt_fd_high_water(self, arg):
+        percent = float(arg)
+        if not 0 <= percent <= 100:
+            raise usage.UsageError("--fd-high-water must be between 0 and 100")
+        self["fd-high-water"] = percent
+
+    def opt_max_connections_per_ip(self, arg):
+        self["max-connections-per-ip"] = int(arg)
+
+    def opt_ipv6_prefix(self, arg):
+        prefix = int(arg)
+        if not 32 < prefix <= 128:
+            raise usage.UsageError("--ipv6-prefix must be between 33 and 128")
+        self["ipv6-prefix"] = prefix
+
+    def opt_limit_exempt(self, arg):
+        networks = [n.strip() for n in arg.split(",") if n.strip()]
+        for network in networks:
+            try:
+                ipaddress.ip_network(network, strict=False)
+            except ValueError:
+                raise usage.UsageError("--limit-exempt: %r is not a network" % (network,))
+        self["limit-exempt"] = networks
+
+    def opt_sndbuf(self, arg):
+        self["sndbuf"] = int(arg)
+
+    def opt_rcvbuf(self, arg):
+        self["rcvbuf"] = int(arg)
+
+    def opt_notsent_lowat(self, arg):
+        self["notsent-lowat"] = int(arg)
+
+    def opt_keepalive_idle(self, arg):
+        self["keepalive-idle"] = int(arg)
+
+    def opt_keepalive_interval(self, arg):
+        self["keepalive-interval"] = int(arg)
+
+    def opt_keepalive_count(self, arg):
+        self["keepalive-count"] = int(arg)
+
+    def opt_user_timeout(self, arg):
+        self["user-timeout"] = int(arg)
+
+    def postOptions(self):
+        if self["usage-retention"] is not None and self["usage-db"] is None:
+            raise usage.UsageError("--usage-retention requires --usage-db")
+        if self["stats-history-downsample"] is not None and self["usage-db"] is None:
+            raise usage.UsageError("--stats-history-downsample requires --usage-db")
+        if self["usage-db-partition"] is not None and self["usage-db"] is None:
+            raise usage.UsageError("--usage-db-partition requires --usage-db")
+        if self["shed-lag"] is not None and not self["lag-interval"]:
+            raise usage.UsageError("--shed-lag requires --lag-interval")
+        if self["usage-helper"] and self["usage-db"] is None and self["log-fd"] is None:
+            raise usage.UsageError("--usage-helper requires --usage-db or --log-fd")
+
 
 def makeService(config, reactor=reactor):
     increase_rlimits()
@@ -45,21 +291,62 @@ def makeService(config, reactor=reactor):
         if config["websocket"] is not None
         else None
     )
+    helper = None
+    if config["usage-helper"]:
+        helper_args = []
+        child_fds = []
+        if config["usage-db"] is not None:
+            # create (or upgrade) it now, like we would without a helper
+            get_db(config["usage-db"]).close()
+            helper_args += ["--usage-db", config["usage-db"]]
+            if config["usage-db-partition"] is not None:
+                helper_args += ["--usage-db-partition", config["usage-db-partition"]]
+        if config["log-fd"] is not None:
+            helper_args += ["--log-fd", config["log-fd"]]
+            child_fds.append(int(config["log-fd"]))
+        helper = UsageHelper(reactor, helper_args, child_fds)
     log_file = (
         os.fdopen(int(config["log-fd"]), "w")
-        if config["log-fd"] is not None
+        if config["log-fd"] is not None and helper is None
         else None
     )
-    db = None if config["usage-db"] is None else get_db(config["usage-db"])
+    if config["usage-db"] is None or helper is not None:
+        db = None
+    elif config["usage-db-partition"] is not None:
+        db = get_partitioned_db(config["usage-db"], config["usage-db-partition"])
+    else:
+        db = get_db(config["usage-db"])
+    sampler = None
+    if config["usage-sample"] is not None or config["usage-sample-moods"] is not None:
+        sampler = UsageSampler(
+            config["usage-sample"] or 1,
+            config["usage-sample-moods"],
+        )
     usage = create_usage_tracker(
         blur_usage=config["blur-usage"],
         log_file=log_file,
         usage_db=db,
+        sampler=sampler,
+        reactor=reactor,
     )
     transit = transit_server.Transit(usage, reactor.seconds)
+    request_log = None
+    request_log_sink = None
+    if config["request-log-fd"] is not None:
+        request_log_sink = JSONLinesSink(
+            reactor,
+            os.fdopen(int(config["request-log-fd"]), "w"),
+        )
+        request_log = RequestLogger(
+            request_log_sink,
+            config["request-log-sample"],
+            config["request-log-rate"],
+        )
     tcp_factory = protocol.ServerFactory()
     tcp_factory.protocol = transit_server.TransitConnection
-    tcp_factory.log_requests = False
+    tcp_factory.log_requests = request_log
+    socket_options = socket_options_from_config(config)
+    tcp_factory.socket_options = socket_options
 
     if ws_ep is not None:
         ws_url = config["websocket-url"]
@@ -72,12 +359,117 @@ def makeService(config, reactor=reactor):
         ws_factory = WebSocketServerFactory(ws_url)
         ws_factory.protocol = transit_server.WebSocketTransitConnection
         ws_factory.transit = transit
-        ws_factory.log_requests = False
+        ws_factory.log_requests = request_log
+        ws_factory.socket_options = socket_options
 
     tcp_factory.transit = transit
+    if config["relay-read-size"]:
+        transit.relay_reader = RelayReader(config["relay-read-size"])
+    if config["relay-writev"]:
+        transit.relay_writer = VectoredWriter()
+    transit.timers = TimerWheel(reactor)
+    transit.idle_timeout = config["idle-timeout"]
+    transit.handshake_timeout = config["handshake-timeout"] or None
+    if config["max-connections-per-ip"] is not None:
+        transit.limiter = ConnectionLimiter(
+            config["max-connections-per-ip"],
+            config["ipv6-prefix"],
+            config["limit-exempt"] or (),
+        )
+    limit = fd_limit()
+    if config["fd-high-water"] and limit is not None:
+        high_water = config["fd-high-water"] / 100.0
+        # evict a tenth of the limit at a time, so we don't have to
+        # do it again on the very next connection
+        transit.fd_monitor = FdMonitor(limit, high_water, max(high_water - 0.1, high_water / 2))
     parent = MultiService()
+    if config["relay-backend"] == "io_uring":
+        if uring.available():
+            # every TCP pair, from one ring per thread
+            transit.offloader = Offloader(
+                reactor,
+                config["offload-threads"] or 1,
+                0,
+                pump=uring.UringPump,
+            )
+        else:
+            log.msg("io_uring is not available, not using --relay-backend=io_uring")
+    if transit.offloader is None and config["offload-threads"]:
+        transit.offloader = Offloader(
+            reactor,
+            config["offload-threads"],
+            config["offload-threshold"],
+        )
+    if transit.offloader is not None:
+        transit.offloader.setServiceParent(parent)
     StreamServerEndpointService(tcp_ep, tcp_factory).setServiceParent(parent)
     if ws_ep is not None:
         StreamServerEndpointService(ws_ep, ws_factory).setServiceParent(parent)
     TimerService(5*60.0, transit.update_stats).setServiceParent(parent)
+    if helper is not None:
+        usage.add_backend(helper)
+        # (before the UsageFlushService, so we stop after it)
+        helper.setServiceParent(parent)
+    UsageFlushService(usage).setServiceParent(parent)
+    if request_log_sink is not None:
+        request_log_sink.setServiceParent(parent)
+    if config["lag-interval"]:
+        transit.lag_monitor = LagMonitor(
+            reactor,
+            config["lag-interval"],
+            config["shed-lag"] / 1000.0 if config["shed-lag"] is not None else None,
+        )
+        transit.lag_monitor.setServiceParent(parent)
+    if config["profile-dir"] is not None:
+        profiler = Profiler(
+            reactor,
+            config["profile-dir"],
+            config["profile-seconds"],
+            config["profile-mode"],
+        )
+        signum = PROFILE_SIGNAL
+        if config["profile-signal"] is not None:
+            signum = getattr(signal, config["profile-signal"])
+        ProfilerService(reactor, profiler, signum).setServiceParent(parent)
+    if config["trace-dir"] is not None:
+        transit.trace = TraceBuffer(
+            config["trace-dir"],
+            config["trace-size"],
+            config["trace-sample"],
+            config["trace-anomalies"] or (),
+        )
+        TraceService(reactor, transit.trace).setServiceParent(parent)
+    if config["usage-retention"] is not None or config["stats-history-downsample"] is not None:
+        pruner = UsagePruner(
+            reactor,
+            config["usage-db"],
+            config["usage-retention"] * DAY if config["usage-retention"] is not None else None,
+            reactor.seconds,
+            partition=config["usage-db-partition"],
+            history_age=(config["stats-history-downsample"] * DAY
+                         if config["stats-history-downsample"] is not None else None),
+            # (so it never drops a partition the recorder has open)
+            recorder=usage.get_backend(PartitionedDatabaseUsageRecorder),
+        )
+        TimerService(60*60.0, pruner.prune).setServiceParent(parent)
+    if config["statsd"] is not None:
+        statsd, client = create_statsd_service(
+            reactor,
+            config["statsd"],
+            transit,
+            config["statsd-prefix"],
+            config["statsd-interval"],
+        )
+        usage.add_backend(StatsdUsageRecorder(client))
+        statsd.setServiceParent(parent)
+    if config["stats-shm"] is not None:
+        reporter = StatsSegmentReporter(
+            StatsSegment(config["stats-shm"]),
+            transit,
+            reactor.seconds,
+        )
+        usage.add_backend(reporter)
+        timer = TimerService(config["stats-shm-interval"], reporter.report)
+        timer.clock = reactor
+        timer.setServiceParent(parent)
     return parent
@@ -0,0 +1,185 @@
+"""
+Publishing the relay's live statistics in a memory-mapped file.
+
+With --stats-shm=PATH, the relay keeps its gauges and counters (the same
+ones it sends to statsd, plus the connections and bytes per mood) in a
+small file of fixed layout, and rewrites the numbers in place every
+--stats-shm-interval= seconds. A monitoring tool (like the munin plugins
+in misc/munin) reads them with read_stats(), without touching the usage
+database or waiting for its next update. Put the file on a tmpfs (like
+/dev/shm) and the "file" never leaves memory.
+
+The layout is a header (MAGIC, VERSION, the number of slots, and a
+sequence number), then one signed 64-bit little-endian integer per slot,
+then the slot names (ASCII, one per line). The names are written once,
+when the file is created; only the numbers change after that. The writer
+makes the sequence number odd before it changes the numbers, and even
+again afterwards, so a reader that sees the same even sequence number
+before and after copying the numbers knows it got a consistent set (a
+"seqlock": readers never block the relay, they just try again).
+"""
+
+import mmap
+import os
+import struct
+import time
+
+from .database import MOODS
+from .lag import LAG_BUCKETS
+
+MAGIC = b"WTRSTATS"
+VERSION = 1
+
+# magic, version, number of slots, sequence number
+_HEADER = struct.Struct("<8sIIQ")
+_SEQUENCE_OFFSET = 16
+_SEQUENCE = struct.Struct("<Q")
+_VALUE = struct.Struct("<q")
+
+SLOTS = (
+    # seconds since epoch of the last update
+    "updated",
+    # like Transit.get_stats()
+    "connected",
+    "waiting",
+    "incomplete_bytes",
+    # the smoothed reactor lag (see --lag-interval=), in microseconds
+    "reactor_lag_us",
+    # like Transit.get_counters()
+    "handshake_timeouts",
+    "over_limit",
+    "evicted",
+    "shed",
+    "usage_dropped",
+    "usage_failed",
+) + tuple(
+    "reactor_lag.le_%dms" % bound for bound in LAG_BUCKETS
+) + (
+    "reactor_lag.over_%dms" % LAG_BUCKETS[-1],
+    # from the usage records, since the relay started
+    "bytes",
+) + tuple(
+    "connections.%s" % mood for mood in MOODS
+)
+
+
+class StatsSegmentError(Exception):
+    pass
+
+
+class StatsSegment(object):
+    """
+    I am the writer of a statistics file (see the module docstring).
+    """
+
+    def __init__(self, path, slots=SLOTS):
+        self._index = dict((name, i) for (i, name) in enumerate(slots))
+        self._offset = _HEADER.size
+        names = "".join(name + "\n" for name in slots).encode("ascii")
+        size = _HEADER.size + _VALUE.size * len(slots) + len(names)
+        # build the new file to one side, so a reader never sees half
+        # of one (a reader that still has the old file open keeps
+        # seeing its last numbers, and "updated" says how old they are)
+        tmp = path + ".tmp"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION, len(slots), 0)
+        self._map[size - len(names):] = names
+        os.replace(tmp, path)
+        self._sequence = 0
+
+    def publish(self, values):
+        """
+        Replace the numbers with ``values``, a dict of slot name ->
+        integer. Slots that aren't in it are set to 0, and names that
+        aren't slots are ignored.
+        """
+        numbers = [0] * len(self._index)
+        for name, value in values.items():
+            i = self._index.get(name)
+            if i is not None:
+                numbers[i] = int(value)
+        self._sequence += 1 # odd: changing
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+        struct.pack_into("<%dq" % len(numbers), self._map, self._offset, *numbers)
+        self._sequence += 1 # even: done
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+
+    def close(self):
+        self._map.close()
+
+
+def read_stats(path, retries=1000):
+    """
+    Read a statistics file written by a StatsSegment.
+
+    :param int retries: how many times to try again when the relay was
+        in the middle of an update (each takes it a few microseconds)
+
+    :returns dict: slot name -> integer
+
+    :raises StatsSegmentError: if the file isn't one, or never held
+        still for long enough
+    """
+    with open(path, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise StatsSegmentError("%s is empty" % (path,))
+    try:
+        if len(m) < _HEADER.size:
+            raise StatsSegmentError("%s is too short" % (path,))
+        (magic, version, count, _) = _HEADER.unpack_from(m, 0)
+        if magic != MAGIC or version != VERSION:
+            raise StatsSegmentError("%s is not a version %d stats file" % (path, VERSION))
+        values_end = _HEADER.size + _VALUE.size * count
+        names = m[values_end:].decode("ascii").splitlines()
+        if len(names) != count:
+            raise StatsSegmentError("%s is damaged" % (path,))
+        layout = struct.Struct("<%dq" % count)
+        for attempt in range(retries + 1):
+            (before,) = _SEQUENCE.unpack_from(m, _SEQUENCE_OFFSET)
+            if before % 2 == 0:
+                numbers = layout.unpack_from(m, _HEADER.size)
+                (after,) = _SEQUENCE.unpack_from(m, _SEQUENCE_OFFSET)
+                if after == before:
+                    return dict(zip(names, numbers))
+            time.sleep(0.0001)
+        raise StatsSegmentError("%s kept changing" % (path,))
+    finally:
+        m.close()
+
+
+class StatsSegmentReporter(object):
+    """
+    Counts usage records (by mood, and their bytes) like an IUsageWriter,
+    and publishes them along with the Transit's gauges and counters.
+    """
+
+    def __init__(self, segment, transit, get_timestamp):
+        self._segment = segment
+        self._transit = transit
+        self._timestamp = get_timestamp
+        self._counters = {}
+
+    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
+        """
+        IUsageWriter.
+        """
+        name = "connections.%s" % mood
+        self._counters[name] = self._counters.get(name, 0) + weight
+        self._counters["bytes"] = self._counters.get("bytes", 0) + (total_bytes or 0) * weight
+
+    def report(self):
+        values = dict(self._counters)
+        values.update(self._transit.get_stats())
+        values.update(self._transit.get_counters())
+        values["updated"] = self._timestamp()
+        lag_monitor = self._transit.lag_monitor
+        if lag_monitor is not None:
+            values["reactor_lag_us"] = lag_monitor.lag * 1e6
+        self._segment.publish(values)
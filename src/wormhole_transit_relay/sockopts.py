@@ -0,0 +1,98 @@
+"""
+Per-listener socket options for relayed connections.
+
+By default every connection only gets SO_KEEPALIVE, with the kernel's
+keepalive timers: on Linux that means a peer which silently goes away
+holds its file descriptor (and its partner's) for over two hours. The
+options here let an operator shorten that (TCP_KEEPIDLE, TCP_KEEPINTVL,
+TCP_KEEPCNT, TCP_USER_TIMEOUT), bound how much unsent data the kernel
+holds per socket (SO_SNDBUF, SO_RCVBUF, TCP_NOTSENT_LOWAT), and turn off
+Nagle's algorithm (TCP_NODELAY).
+
+Options the platform doesn't know about are skipped, with one log
+message per option name.
+"""
+
+import socket
+
+from twisted.python import log
+
+# (attribute, level, socket-module constant name)
+_SOCKET_OPTIONS = [
+    ("sndbuf", socket.SOL_SOCKET, "SO_SNDBUF"),
+    ("rcvbuf", socket.SOL_SOCKET, "SO_RCVBUF"),
+    ("notsent_lowat", socket.IPPROTO_TCP, "TCP_NOTSENT_LOWAT"),
+    ("keepalive_idle", socket.IPPROTO_TCP, "TCP_KEEPIDLE"),
+    ("keepalive_interval", socket.IPPROTO_TCP, "TCP_KEEPINTVL"),
+    ("keepalive_count", socket.IPPROTO_TCP, "TCP_KEEPCNT"),
+    ("user_timeout", socket.IPPROTO_TCP, "TCP_USER_TIMEOUT"),
+]
+
+_unsupported = set()
+
+
+class SocketOptions(object):
+    """
+    I hold the socket options to apply to each accepted connection.
+    Anything left as None keeps the operating system's default.
+
+    ``user_timeout`` is in milliseconds, the keepalive times in seconds,
+    and the buffer sizes in bytes.
+    """
+
+    def __init__(self, nodelay=False, sndbuf=None, rcvbuf=None,
+                 notsent_lowat=None, keepalive_idle=None,
+                 keepalive_interval=None, keepalive_count=None,
+                 user_timeout=None):
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.notsent_lowat = notsent_lowat
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.user_timeout = user_timeout
+
+    def apply(self, transport):
+        """
+        Set my options on a connected transport. Transports without a
+        real socket (like the in-memory ones the tests use) only get
+        the keepalive and nodelay flags.
+        """
+        transport.setTcpKeepAlive(True)
+        if self.nodelay:
+            transport.setTcpNoDelay(True)
+        get_handle = getattr(transport, "getHandle", None)
+        if get_handle is None:
+            return
+        sock = get_handle()
+        for attribute, level, name in _SOCKET_OPTIONS:
+            value = getattr(self, attribute)
+            if value is None:
+                continue
+            option = getattr(socket, name, None)
+            if option is None:
+                if name not in _unsupported:
+                    _unsupported.add(name)
+                    log.msg("{} is not supported here, ignoring it".format(name))
+                continue
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                log.msg("unable to set {}={}: {}".format(name, value, e))
+
+
+def socket_options_from_config(config):
+    """
+    Build a SocketOptions from the command-line options.
+    """
+    return SocketOptions(
+        nodelay=bool(config["tcp-nodelay"]),
+        sndbuf=config["sndbuf"],
+        rcvbuf=config["rcvbuf"],
+        notsent_lowat=config["notsent-lowat"],
+        keepalive_idle=config["keepalive-idle"],
+        keepalive_interval=config["keepalive-interval"],
+        keepalive_count=config["keepalive-count"],
+        user_timeout=config["user-timeout"],
+    )
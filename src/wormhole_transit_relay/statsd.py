@@ -0,0 +1,186 @@
+"""
+Reporting to a statsd-compatible aggregator, over UDP.
+
+Counters are summed in memory and only a single line per counter is
+sent each interval; timings are queued (up to a limit) because the
+aggregator computes percentiles from the individual values. Everything
+due is packed into as few datagrams as possible. Nothing here ever
+waits for the aggregator: if it is absent, or the socket buffer is
+full, the datagram is dropped and counted.
+"""
+
+from twisted.application.internet import UDPServer, TimerService
+from twisted.application.service import MultiService
+from twisted.internet.abstract import isIPv6Address
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import log
+from zope.interface import implementer
+
+from .usage import IUsageWriter
+
+
+def parse_address(arg):
+    """
+    :param str arg: like "127.0.0.1:8125" or "[::1]:8125"
+
+    :returns: (host, port)
+    """
+    host, sep, port = arg.rpartition(":")
+    if not sep or not host:
+        raise ValueError("statsd address must be HOST:PORT")
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    return host, int(port)
+
+
+class StatsdClient(DatagramProtocol):
+    """
+    Batches metrics and sends them to one statsd aggregator.
+    """
+
+    # keep datagrams inside a typical Ethernet MTU (1500 - IPv6 and UDP
+    # headers)
+    MAX_DATAGRAM = 1432
+    # timing samples held between flushes; further ones are dropped
+    MAX_QUEUED = 4096
+
+    def __init__(self, host, port, prefix="wormhole.transit"):
+        self._address = (host, port)
+        self._prefix = prefix + "." if prefix else ""
+        self._counters = {}
+        self._gauges = {}
+        self._timings = []
+        self.sent = 0 # datagrams
+        self.dropped = 0 # metric lines we gave up on
+
+    def startProtocol(self):
+        self.transport.connect(*self._address)
+
+    def connectionRefused(self):
+        # nothing is listening (we learn this from the ICMP error that a
+        # previous datagram caused); the data is gone, which is fine
+        pass
+
+    def increment(self, name, value=1):
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self._gauges[name] = value
+
+    def timing(self, name, milliseconds):
+        if len(self._timings) >= self.MAX_QUEUED:
+            self.dropped += 1
+            return
+        self._timings.append((name, milliseconds))
+
+    def _lines(self):
+        p = self._prefix
+        for name, value in self._counters.items():
+            yield "%s%s:%d|c" % (p, name, value)
+        for name, value in self._gauges.items():
+            yield "%s%s:%d|g" % (p, name, value)
+        for name, value in self._timings:
+            yield "%s%s:%d|ms" % (p, name, value)
+
+    def flush(self):
+        """
+        Send everything accumulated since the last flush.
+        """
+        lines = list(self._lines())
+        self._counters = {}
+        self._gauges = {}
+        self._timings = []
+        if self.transport is None:
+            self.dropped += len(lines)
+            return
+        batch = []
+        size = 0
+        for line in lines:
+            encoded = line.encode("ascii")
+            if batch and size + 1 + len(encoded) > self.MAX_DATAGRAM:
+                self._send(batch)
+                batch = []
+                size = 0
+            batch.append(encoded)
+            size += len(encoded) + (1 if size else 0)
+        if batch:
+            self._send(batch)
+
+    def _send(self, lines):
+        try:
+            sent = self.transport.write(b"\n".join(lines))
+        except OSError:
+            # EAGAIN: the socket buffer is full. Don't wait for it.
+            sent = None
+        if sent is None:
+            self.dropped += len(lines)
+        else:
+            self.sent += 1
+
+
+@implementer(IUsageWriter)
+class StatsdUsageRecorder:
+    """
+    Counts usage records (by mood), and their bytes and durations, in
+    statsd.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
+        """
+        IUsageWriter.
+        """
+        self._client.increment("connections.%s" % mood, weight)
+        self._client.increment("bytes", (total_bytes or 0) * weight)
+        if total_time is not None:
+            self._client.timing("total_time", total_time * 1000)
+        if waiting_time is not None:
+            self._client.timing("waiting_time", waiting_time * 1000)
+
+
+class StatsdReporter(object):
+    """
+    Sends gauges of the relay's current state every interval, along with
+    how much its counters went up since the last time, and flushes
+    everything else at the same time.
+    """
+
+    def __init__(self, client, transit):
+        self._client = client
+        self._transit = transit
+        self._counters = {}
+
+    def report(self):
+        for name, value in self._transit.get_stats().items():
+            self._client.gauge(name, value)
+        for name, value in self._transit.get_counters().items():
+            delta = value - self._counters.get(name, 0)
+            self._counters[name] = value
+            if delta:
+                self._client.increment(name, delta)
+        self._client.gauge("statsd_dropped", self._client.dropped)
+        self._client.flush()
+
+
+def create_statsd_service(reactor, address, transit, prefix, interval):
+    """
+    :param str address: HOST:PORT of the aggregator; HOST must be an IP
+        address
+
+    :returns: (service, client). The service sends a UDP datagram
+        batch every ``interval`` seconds; the client can be used to
+        record metrics.
+    """
+    host, port = parse_address(address)
+    client = StatsdClient(host, port, prefix)
+    service = MultiService()
+    udp = UDPServer(0, client, interface="::" if isIPv6Address(host) else "",
+                    reactor=reactor)
+    udp.setServiceParent(service)
+    timer = TimerService(interval, StatsdReporter(client, transit).report)
+    timer.clock = reactor
+    timer.setServiceParent(service)
+    log.msg("reporting to statsd at %s:%d every %ss" % (host, port, interval))
+    return service, client
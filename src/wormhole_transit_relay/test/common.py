@@ -14,6 +14,7 @@ from ..transit_server import (
 )
 from twisted.internet.protocol import ServerFactory
 from ..usage import create_usage_tracker
+from ..requestlog import RequestLogger
 
 
 class IRelayTestClient(Interface):
@@ -46,6 +47,18 @@ class IRelayTestClient(Interface):
         """
 
 
+class RecordingSink(object):
+    """
+    A request-log sink that keeps every record in memory.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
 class ServerBase:
     log_requests = False
 
@@ -54,8 +67,10 @@ class ServerBase:
         self._lp = None
         if self.log_requests:
             blur_usage = None
+            self._request_log = RequestLogger(RecordingSink())
         else:
             blur_usage = 60.0
+            self._request_log = None
         self._setup_relay(blur_usage=blur_usage)
 
     def flush(self):
@@ -88,7 +103,7 @@ class ServerBase:
         server_factory = ServerFactory()
         server_factory.protocol = TransitConnection
         server_factory.transit = self._transit_server
-        server_factory.log_requests = self.log_requests
+        server_factory.log_requests = self._request_log
         server_protocol = server_factory.buildProtocol(('127.0.0.1', 0))
 
         @implementer(IRelayTestClient)
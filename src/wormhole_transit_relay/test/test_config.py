@@ -1,36 +1,253 @@
+import os
 from twisted.trial import unittest
+from twisted.python.usage import UsageError
 from .. import server_tap
 
 PORT = r"tcp:4001:interface=\:\:"
 
+DEFAULTS = {"blur-usage": None, "log-fd": None,
+            "request-log-fd": None, "request-log-sample": 1.0,
+            "request-log-rate": 100,
+            "usage-db": None, "port": PORT,
+            "websocket": None, "websocket-url": None,
+            "usage-retention": None, "usage-db-partition": None,
+            "stats-history-downsample": None,
+            "usage-sample": None, "usage-sample-moods": None,
+            "statsd": None, "statsd-prefix": "wormhole.transit",
+            "statsd-interval": 10.0,
+            "stats-shm": None, "stats-shm-interval": 1.0,
+            "offload-threads": 0, "offload-threshold": 10000000,
+            "relay-backend": "reactor", "relay-read-size": None,
+            "idle-timeout": None, "handshake-timeout": 60.0,
+            "fd-high-water": 90.0, "lag-interval": 0.1, "shed-lag": None,
+            "profile-dir": None, "profile-mode": "sample", "profile-seconds": 30.0,
+            "profile-signal": None,
+            "trace-dir": None, "trace-sample": 0.01, "trace-size": 4096,
+            "trace-anomalies": None,
+            "max-connections-per-ip": None, "ipv6-prefix": 64,
+            "limit-exempt": None,
+            "tcp-nodelay": 0, "relay-writev": 0, "usage-helper": 0, "sndbuf": None, "rcvbuf": None,
+            "notsent-lowat": None, "keepalive-idle": None,
+            "keepalive-interval": None, "keepalive-count": None,
+            "user-timeout": None}
+
 class Config(unittest.TestCase):
     def test_defaults(self):
         o = server_tap.Options()
         o.parseOptions([])
-        self.assertEqual(o, {"blur-usage": None, "log-fd": None,
-                             "usage-db": None, "port": PORT,
-                             "websocket": None, "websocket-url": None})
+        self.assertEqual(o, DEFAULTS)
     def test_blur(self):
         o = server_tap.Options()
         o.parseOptions(["--blur-usage=60"])
-        self.assertEqual(o, {"blur-usage": 60, "log-fd": None,
-                             "usage-db": None, "port": PORT,
-                             "websocket": None, "websocket-url": None})
+        self.assertEqual(o, dict(DEFAULTS, **{"blur-usage": 60}))
 
     def test_websocket(self):
         o = server_tap.Options()
         o.parseOptions(["--websocket=tcp:4004"])
-        self.assertEqual(o, {"blur-usage": None, "log-fd": None,
-                             "usage-db": None, "port": PORT,
-                             "websocket": "tcp:4004", "websocket-url": None})
+        self.assertEqual(o, dict(DEFAULTS, websocket="tcp:4004"))
 
     def test_websocket_url(self):
         o = server_tap.Options()
         o.parseOptions(["--websocket=tcp:4004", "--websocket-url=ws://example.com/"])
-        self.assertEqual(o, {"blur-usage": None, "log-fd": None,
-                             "usage-db": None, "port": PORT,
-                             "websocket": "tcp:4004",
-                             "websocket-url": "ws://example.com/"})
+        self.assertEqual(o, dict(DEFAULTS, **{"websocket": "tcp:4004",
+                                              "websocket-url": "ws://example.com/"}))
+
+    def test_usage_retention(self):
+        o = server_tap.Options()
+        o.parseOptions(["--usage-db=usage.sqlite", "--usage-retention=90"])
+        self.assertEqual(o, dict(DEFAULTS, **{"usage-db": "usage.sqlite",
+                                              "usage-retention": 90}))
+
+    def test_usage_retention_needs_db(self):
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--usage-retention=90"])
+
+    def test_stats_history_downsample(self):
+        o = server_tap.Options()
+        o.parseOptions(["--usage-db=usage.sqlite", "--stats-history-downsample=7"])
+        self.assertEqual(o, dict(DEFAULTS, **{"usage-db": "usage.sqlite",
+                                              "stats-history-downsample": 7}))
+
+    def test_stats_history_downsample_needs_db(self):
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--stats-history-downsample=7"])
+
+    def test_usage_db_partition(self):
+        o = server_tap.Options()
+        o.parseOptions(["--usage-db=usage.sqlite", "--usage-db-partition=week"])
+        self.assertEqual(o, dict(DEFAULTS, **{"usage-db": "usage.sqlite",
+                                              "usage-db-partition": "week"}))
+
+    def test_usage_db_partition_bad(self):
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--usage-db=usage.sqlite", "--usage-db-partition=year"])
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--usage-db-partition=day"])
+
+    def test_usage_sample(self):
+        o = server_tap.Options()
+        o.parseOptions(["--usage-sample=100",
+                        "--usage-sample-moods=lonely:10, errory:1"])
+        self.assertEqual(o, dict(DEFAULTS, **{"usage-sample": 100,
+                                              "usage-sample-moods": {"lonely": 10,
+                                                                     "errory": 1}}))
+
+    def test_usage_sample_moods_bad(self):
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--usage-sample-moods=lonely"])
+
+    def test_statsd(self):
+        o = server_tap.Options()
+        o.parseOptions(["--statsd=[::1]:8125", "--statsd-interval=2.5"])
+        self.assertEqual(o, dict(DEFAULTS, **{"statsd": "[::1]:8125",
+                                              "statsd-interval": 2.5}))
+
+    def test_statsd_bad(self):
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--statsd=localhost"])
+
+    def test_stats_shm(self):
+        o = server_tap.Options()
+        o.parseOptions(["--stats-shm=/dev/shm/transit", "--stats-shm-interval=0.5"])
+        self.assertEqual(o, dict(DEFAULTS, **{"stats-shm": "/dev/shm/transit",
+                                              "stats-shm-interval": 0.5}))
+
+    def test_offload(self):
+        o = server_tap.Options()
+        o.parseOptions(["--offload-threads=2", "--offload-threshold=1000"])
+        self.assertEqual(o, dict(DEFAULTS, **{"offload-threads": 2,
+                                              "offload-threshold": 1000}))
+
+    def test_relay_backend(self):
+        o = server_tap.Options()
+        o.parseOptions(["--relay-backend=io_uring"])
+        self.assertEqual(o, dict(DEFAULTS, **{"relay-backend": "io_uring"}))
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--relay-backend=kqueue"])
+
+    def test_relay_read_size(self):
+        o = server_tap.Options()
+        o.parseOptions(["--relay-read-size=1048576"])
+        self.assertEqual(o, dict(DEFAULTS, **{"relay-read-size": 1048576}))
+
+    def test_relay_writev(self):
+        o = server_tap.Options()
+        o.parseOptions(["--relay-writev"])
+        self.assertEqual(o, dict(DEFAULTS, **{"relay-writev": 1}))
+
+    def test_idle_timeout(self):
+        o = server_tap.Options()
+        o.parseOptions(["--idle-timeout=600"])
+        self.assertEqual(o, dict(DEFAULTS, **{"idle-timeout": 600.0}))
+
+    def test_handshake_timeout(self):
+        o = server_tap.Options()
+        o.parseOptions(["--handshake-timeout=10"])
+        self.assertEqual(o, dict(DEFAULTS, **{"handshake-timeout": 10.0}))
+
+    def test_profile(self):
+        o = server_tap.Options()
+        directory = self.mktemp()
+        os.mkdir(directory)
+        o.parseOptions(["--profile-dir", directory, "--profile-mode=cprofile",
+                        "--profile-seconds=5"])
+        self.assertEqual(o, dict(DEFAULTS, **{"profile-dir": directory,
+                                              "profile-mode": "cprofile",
+                                              "profile-seconds": 5.0}))
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--profile-dir", directory + "-missing"])
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--profile-mode=perf"])
+
+    def test_profile_signal(self):
+        for arg in ("USR2", "sigwinch"):
+            o = server_tap.Options()
+            o.parseOptions(["--profile-signal", arg])
+            self.assertIn(o["profile-signal"], ("SIGUSR2", "SIGWINCH"))
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--profile-signal=SIG_IGN"])
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--profile-signal=NOPE"])
+
+    def test_trace(self):
+        o = server_tap.Options()
+        directory = self.mktemp()
+        os.mkdir(directory)
+        o.parseOptions(["--trace-dir", directory, "--trace-sample=0.5", "--trace-size=100",
+                        "--trace-anomalies=impatient, evicted"])
+        self.assertEqual(o, dict(DEFAULTS, **{"trace-dir": directory,
+                                              "trace-sample": 0.5,
+                                              "trace-size": 100,
+                                              "trace-anomalies": ["impatient", "evicted"]}))
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--trace-sample=0"])
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--trace-anomalies=grumpy"])
+
+    def test_request_log(self):
+        o = server_tap.Options()
+        o.parseOptions(["--request-log-fd=3", "--request-log-sample=0.25",
+                        "--request-log-rate=10"])
+        self.assertEqual(o, dict(DEFAULTS, **{"request-log-fd": "3",
+                                              "request-log-sample": 0.25,
+                                              "request-log-rate": 10}))
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--request-log-sample=2"])
+
+    def test_usage_helper(self):
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--usage-helper"])
+        o = server_tap.Options()
+        o.parseOptions(["--usage-helper", "--log-fd=3"])
+        self.assertEqual(o, dict(DEFAULTS, **{"usage-helper": 1, "log-fd": "3"}))
+
+    def test_lag(self):
+        o = server_tap.Options()
+        o.parseOptions(["--lag-interval=0.5", "--shed-lag=250"])
+        self.assertEqual(o, dict(DEFAULTS, **{"lag-interval": 0.5, "shed-lag": 250.0}))
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--lag-interval=0", "--shed-lag=250"])
+
+    def test_fd_high_water(self):
+        o = server_tap.Options()
+        o.parseOptions(["--fd-high-water=75"])
+        self.assertEqual(o, dict(DEFAULTS, **{"fd-high-water": 75.0}))
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--fd-high-water=150"])
+
+    def test_connection_limits(self):
+        o = server_tap.Options()
+        o.parseOptions(["--max-connections-per-ip=50", "--ipv6-prefix=56",
+                        "--limit-exempt=10.0.0.0/8, ::1"])
+        self.assertEqual(o, dict(DEFAULTS, **{"max-connections-per-ip": 50,
+                                              "ipv6-prefix": 56,
+                                              "limit-exempt": ["10.0.0.0/8", "::1"]}))
+
+    def test_connection_limits_bad(self):
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--ipv6-prefix=16"])
+        with self.assertRaises(UsageError):
+            server_tap.Options().parseOptions(["--limit-exempt=10.0.0.0/8,bogus"])
+
+    def test_socket_options(self):
+        o = server_tap.Options()
+        o.parseOptions(["--tcp-nodelay", "--sndbuf=65536", "--notsent-lowat=16384",
+                        "--keepalive-idle=60", "--keepalive-interval=10",
+                        "--keepalive-count=3", "--user-timeout=30000"])
+        self.assertEqual(o, dict(DEFAULTS, **{"tcp-nodelay": 1,
+                                              "sndbuf": 65536,
+                                              "notsent-lowat": 16384,
+                                              "keepalive-idle": 60,
+                                              "keepalive-interval": 10,
+                                              "keepalive-count": 3,
+                                              "user-timeout": 30000}))
 
     def test_string(self):
         o = server_tap.Options()
@@ -38,4 +255,3 @@ class Config(unittest.TestCase):
         self.assertIn("This plugin sets up a 'Transit Relay'", s)
         self.assertIn("--blur-usage=", s)
         self.assertIn("blur timestamps and data sizes in logs", s)
-
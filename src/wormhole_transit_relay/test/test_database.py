@@ -54,17 +54,18 @@ class Get(unittest.TestCase):
         patch.restore()
         get_db(dbfile.path)
 
-    def OFF_test_upgrade(self): # disabled until we add a v2 schema
+    def test_upgrade(self):
         basedir = self.mktemp()
         os.mkdir(basedir)
         fn = os.path.join(basedir, "upgrade.db")
-        self.assertNotEqual(TARGET_VERSION, 2)
+        self.assertNotEqual(TARGET_VERSION, 1)
 
         # create an old-version DB in a file
-        db = get_db(fn, 2)
+        db = get_db(fn, 1)
         rows = db.execute("SELECT * FROM version").fetchall()
         self.assertEqual(len(rows), 1)
-        self.assertEqual(rows[0]["version"], 2)
+        self.assertEqual(rows[0]["version"], 1)
+        self._populate_v1(db)
         del db
 
         # then upgrade the file to the latest version
@@ -78,21 +79,120 @@ class Get(unittest.TestCase):
         # make sure the upgrades got committed to disk
         dbB = get_db(fn, TARGET_VERSION)
         dbB_text = dump_db(dbB)
-        del dbB
         self.assertEqual(dbA_text, dbB_text)
+        self._check_upgraded(dbB)
 
-        # The upgraded schema should be equivalent to that of a new DB.
-        # However a text dump will differ because ALTER TABLE always appends
-        # the new column to the end of a table, whereas our schema puts it
-        # somewhere in the middle (wherever it fits naturally). Also ALTER
-        # TABLE doesn't include comments.
-        if False:
-            latest_db = get_db(":memory:", TARGET_VERSION)
-            latest_text = dump_db(latest_db)
-            with open("up.sql","w") as f: f.write(dbA_text)
-            with open("new.sql","w") as f: f.write(latest_text)
-            # check with "diff -u _trial_temp/up.sql _trial_temp/new.sql"
-            self.assertEqual(dbA_text, latest_text)
+        # The upgraded schema should be equivalent to that of a new DB. A
+        # text dump will differ (renamed tables keep their old comments and
+        # quoting), so compare the structure instead.
+        latest_db = get_db(":memory:", TARGET_VERSION)
+        self.assertEqual(_structure(dbB), _structure(latest_db))
+
+    def test_upgrade_interrupted(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        db = get_db(fn, 1)
+        self._populate_v1(db)
+
+        # copy only some of the rows, as if we'd crashed part-way through
+        # the upgrade: the database is still v1
+        db.executescript(database.get_upgrader_script(2))
+        db.execute("INSERT INTO `usage_v2`"
+                   " (`rowid`, `started`, `total_time_ms`, `waiting_time_ms`,"
+                   "  `total_bytes`, `mood`)"
+                   " VALUES (1, 100, 10500, 2250, 1000, 1)")
+        db.commit()
+        self.assertEqual(db.execute("SELECT * FROM version").fetchone()["version"], 1)
+        del db
+
+        db = get_db(fn, TARGET_VERSION)
+        self._check_upgraded(db)
+
+    def test_upgrade_in_batches(self):
+        db = get_db(":memory:", 1)
+        for i in range(25):
+            db.execute("INSERT INTO `usage`"
+                       " (`started`, `total_time`, `waiting_time`,"
+                       "  `total_bytes`, `result`) VALUES (?,?,?,?,?)",
+                       (i, 1.0, None, i, "happy"))
+        db.commit()
+        database._upgrade_to_v2(db, batch_size=10)
+        rows = db.execute("SELECT `started` FROM `usage` ORDER BY `rowid`").fetchall()
+        self.assertEqual([r["started"] for r in rows], list(range(25)))
+        self.assertEqual(db.execute("SELECT * FROM version").fetchone()["version"], 2)
+
+    def test_upgrade_rollups(self):
+        # --usage-retention kept its rollups in a v1-shaped table before
+        # the v2 schema existed
+        db = get_db(":memory:", 1)
+        db.execute("CREATE TABLE `usage_rollups`"
+                   " (`day` INTEGER, `result` VARCHAR, `connections` INTEGER,"
+                   "  `total_bytes` INTEGER, `total_time` REAL,"
+                   "  `waiting_time` REAL, PRIMARY KEY (`day`, `result`))")
+        db.execute("INSERT INTO `usage_rollups` VALUES (86400, 'happy', 3, 30, 1.5, 0.25)")
+        db.commit()
+        database._upgrade_to_v2(db)
+        self.assertEqual(db.execute("SELECT * FROM `usage_rollups`").fetchall(),
+                         [dict(day=86400, mood=database.mood_code("happy"),
+                               connections=3, total_bytes=30,
+                               total_time_ms=1500, waiting_time_ms=250)])
+
+    def test_no_upgrader(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        get_db(fn)
+        with self.assertRaises(DBError) as e:
+            get_db(fn, TARGET_VERSION + 1)
+        self.assertIn("Unable to upgrade", str(e.exception))
+
+    def _populate_v1(self, db):
+        rows = [
+            (100.25, 10.5, 2.25, 1000, "happy"),
+            (200, 3, None, 0, "lonely"),
+            (300.9, 0.001, None, 0, "errory"),
+            (400, 1, 0.5, None, "something new"),
+        ]
+        db.executemany("INSERT INTO `usage`"
+                       " (`started`, `total_time`, `waiting_time`,"
+                       "  `total_bytes`, `result`) VALUES (?,?,?,?,?)",
+                       rows)
+        db.execute("INSERT INTO `current` VALUES (1, 2, 3, 4, 5)")
+        db.commit()
+
+    def _check_upgraded(self, db):
+        moods = dict((r["name"], r["mood"])
+                     for r in db.execute("SELECT * FROM `moods`").fetchall())
+        self.assertEqual(moods, database.MOOD_CODES)
+        self.assertEqual(
+            db.execute("SELECT * FROM `usage` ORDER BY `started`").fetchall(),
+            [dict(started=100, total_time_ms=10500, waiting_time_ms=2250,
+                  total_bytes=1000, mood=moods["happy"], weight=1),
+             dict(started=200, total_time_ms=3000, waiting_time_ms=None,
+                  total_bytes=0, mood=moods["lonely"], weight=1),
+             dict(started=300, total_time_ms=1, waiting_time_ms=None,
+                  total_bytes=0, mood=moods["errory"], weight=1),
+             dict(started=400, total_time_ms=1000, waiting_time_ms=500,
+                  total_bytes=0, mood=moods["unknown"], weight=1),
+             ])
+        self.assertEqual(db.execute("SELECT * FROM `current`").fetchone(),
+                         dict(rebooted=1, updated=2, connected=3, waiting=4,
+                              incomplete_bytes=5))
+
+
+def _structure(db):
+    tables = {}
+    for t in db.execute("SELECT `type`, `name`, `tbl_name` FROM `sqlite_master`"
+                        " ORDER BY `name`").fetchall():
+        if t["type"] == "table":
+            cols = db.execute("PRAGMA table_info(`%s`)" % t["name"]).fetchall()
+            tables[t["name"]] = [(c["name"], c["type"], c["notnull"], c["pk"])
+                                 for c in cols]
+        else:
+            cols = db.execute("PRAGMA index_info(`%s`)" % t["name"]).fetchall()
+            tables[t["name"]] = (t["tbl_name"], [c["name"] for c in cols])
+    return tables
 
 class Create(unittest.TestCase):
     def test_memory(self):
@@ -136,3 +236,80 @@ class Open(unittest.TestCase):
             database.open_existing_db(fn)
 
 
+
+class Partitioned(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        self.basedir = basedir
+        self.dbfile = os.path.join(basedir, "usage.sqlite")
+
+    def test_bounds(self):
+        # 2024-11-06T12:34:56Z, a Wednesday
+        t = 1730896496
+        self.assertEqual(database.partition_bounds(t, "day"),
+                         (1730851200, 1730851200 + 86400))
+        self.assertEqual(database.partition_bounds(t, "week"),
+                         (1730678400, 1730678400 + 7*86400)) # Monday 4th
+        self.assertEqual(database.partition_bounds(t, "month"),
+                         (1730419200, 1733011200)) # Nov 1st, Dec 1st
+        # December rolls over into the next year
+        self.assertEqual(database.partition_bounds(1734000000, "month"),
+                         (1733011200, 1735689600))
+        with self.assertRaises(ValueError):
+            database.partition_bounds(t, "fortnight")
+
+    def test_filenames(self):
+        start = 1730419200
+        self.assertEqual(database.partition_filename(self.dbfile, start, "month"),
+                         "usage.2024-11.sqlite")
+        self.assertEqual(database.partition_filename(self.dbfile, start, "day"),
+                         "usage.2024-11-01.sqlite")
+        self.assertEqual(database.partition_filename(self.dbfile, start, "week"),
+                         "usage.2024-W44.sqlite")
+
+    def test_partitions(self):
+        pdb = database.get_partitioned_db(self.dbfile, "month")
+        nov = 1730896496
+        dec = 1734000000
+        a = pdb.partition_for(nov)
+        self.assertIs(pdb.partition_for(nov + 60), a)
+        b = pdb.partition_for(dec)
+        self.assertIsNot(a, b)
+        for db, started in [(a, nov), (b, dec)]:
+            db.execute("INSERT INTO `usage`"
+                       " (`started`, `total_time_ms`, `total_bytes`, `mood`)"
+                       " VALUES (?, 0, 0, 1)", (started,))
+            db.commit()
+        self.assertEqual(sorted(os.listdir(self.basedir)),
+                         ["usage.2024-11.sqlite", "usage.2024-12.sqlite",
+                          "usage.sqlite"])
+
+        self.assertEqual([p[0] for p in pdb.partitions()],
+                         [1730419200, 1733011200])
+        self.assertEqual([p[0] for p in pdb.partitions(start=dec)],
+                         [1733011200])
+        self.assertEqual([p[0] for p in pdb.partitions(end=nov)],
+                         [1730419200])
+        self.assertEqual(pdb.partitions(start=0, end=1000), [])
+
+        rows = list(pdb.execute("SELECT `started` FROM `usage`"))
+        self.assertEqual(rows, [{"started": nov}, {"started": dec}])
+        rows = list(pdb.execute("SELECT `started` FROM `usage`", start=dec))
+        self.assertEqual(rows, [{"started": dec}])
+        pdb.close()
+
+        # partitions are found again after a restart, and ones that aren't
+        # open for writing are read from their files
+        pdb = database.get_partitioned_db(self.dbfile, "month")
+        pdb.MAX_OPEN = 1
+        pdb.partition_for(dec)
+        rows = list(pdb.execute("SELECT `started` FROM `usage`"))
+        self.assertEqual(rows, [{"started": nov}, {"started": dec}])
+        pdb.partition_for(nov)
+        pdb.close()
+        self.assertEqual(len(os.listdir(self.basedir)), 3)
+
+    def test_bad_period(self):
+        with self.assertRaises(ValueError):
+            database.PartitionedDB(self.dbfile, "year", None)
@@ -0,0 +1,265 @@
+import fcntl
+import os
+import socket
+import struct
+import termios
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.protocol import ClientFactory, ServerFactory
+from ..transit_server import Transit, TransitConnection
+from ..usage import UsageTracker, MemoryUsageRecorder
+from ..fastpath import RelayReader, VectoredWriter
+from .. import fastpath
+from .test_offload import Client, RelayMixin, _wait_for
+
+
+class FakeTransport(object):
+    connected = True
+    disconnecting = False
+
+    def __init__(self, sock=None):
+        self.socket = sock
+        self.dataBuffer = b""
+        self._tempDataBuffer = []
+
+
+class SendView(unittest.TestCase):
+    def setUp(self):
+        self.reader = RelayReader(16)
+        self.ours, self.theirs = socket.socketpair()
+        self.ours.setblocking(False)
+        for s in (self.ours, self.theirs):
+            self.addCleanup(s.close)
+
+    def test_direct(self):
+        transport = FakeTransport(self.ours)
+        rest = self.reader.send_view(transport, memoryview(b"hello"))
+        self.assertEqual(rest, b"")
+        self.assertEqual(self.theirs.recv(5), b"hello")
+        self.assertEqual((self.reader.direct_bytes, self.reader.copied_bytes), (5, 0))
+
+    def test_queued(self):
+        transport = FakeTransport(self.ours)
+        transport._tempDataBuffer.append(b"first")
+        rest = self.reader.send_view(transport, memoryview(b"hello"))
+        self.assertEqual(rest, b"hello")
+        self.assertIsInstance(rest, bytes)
+        self.assertEqual((self.reader.direct_bytes, self.reader.copied_bytes), (0, 5))
+
+    def test_socket_full(self):
+        transport = FakeTransport(self.ours)
+        chunk = memoryview(b"x" * 65536)
+        rest = b""
+        while not rest:
+            rest = self.reader.send_view(transport, chunk)
+        # whatever the kernel didn't take is copied, in order
+        self.assertEqual(self.reader.copied_bytes, len(rest))
+        self.assertEqual(rest, bytes(chunk[len(chunk) - len(rest):]))
+
+    def test_no_socket(self):
+        rest = self.reader.send_view(FakeTransport(), memoryview(b"hello"))
+        self.assertEqual(rest, b"hello")
+
+
+class WritingTransport(object):
+    disconnecting = False
+    _writeDisconnecting = False
+    producer = None
+    streamingProducer = True
+    producerPaused = False
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.dataBuffer = b""
+        self.offset = 0
+        self._tempDataBuffer = []
+        self._tempDataLen = 0
+        self.writing = True
+
+    def write(self, data):
+        self._tempDataBuffer.append(data)
+        self._tempDataLen += len(data)
+
+    def stopWriting(self):
+        self.writing = False
+
+
+class FakeProducer(object):
+    resumed = False
+
+    def resumeProducing(self):
+        self.resumed = True
+
+
+class Vectored(unittest.TestCase):
+    def setUp(self):
+        self.writer = VectoredWriter()
+        self.ours, self.theirs = socket.socketpair()
+        self.ours.setblocking(False)
+        self.theirs.settimeout(5)
+        for s in (self.ours, self.theirs):
+            self.addCleanup(s.close)
+        self.transport = WritingTransport(self.ours)
+
+    def test_one_call(self):
+        producer = self.transport.producer = FakeProducer()
+        self.transport.producerPaused = True
+        self.transport.dataBuffer = b"..abc"
+        self.transport.offset = 2
+        for i in range(10):
+            self.transport.write(b"%d" % i)
+        self.assertIsNone(self.writer._write(self.transport))
+        self.assertEqual((self.writer.calls, self.writer.chunks), (1, 11))
+        self.assertEqual(self.theirs.recv(100), b"abc0123456789")
+        # everything went, so writing stops and the producer resumes
+        self.assertEqual((self.transport.dataBuffer, self.transport.offset), (b"", 0))
+        self.assertEqual((self.transport._tempDataBuffer, self.transport._tempDataLen), ([], 0))
+        self.assertFalse(self.transport.writing)
+        self.assertTrue(producer.resumed)
+
+    def test_iov_max(self):
+        self.patch(fastpath, "IOV_MAX", 4)
+        for i in range(10):
+            self.transport.write(b"%d" % i)
+        self.writer._write(self.transport)
+        self.assertEqual(self.theirs.recv(100), b"0123")
+        self.assertEqual(self.transport._tempDataBuffer, [b"%d" % i for i in range(4, 10)])
+        self.assertEqual(self.transport._tempDataLen, 6)
+        self.assertTrue(self.transport.writing)
+
+    def test_partial(self):
+        payload = os.urandom(4 * 1000 * 1000)
+        for i in range(0, len(payload), 1000):
+            self.transport.write(payload[i:i + 1000])
+        received = b""
+        while self.transport.writing:
+            self.writer._write(self.transport)
+            # each partly-written chunk is kept with its offset
+            self.assertEqual(
+                len(self.transport.dataBuffer) - self.transport.offset
+                + self.transport._tempDataLen + len(received)
+                + self._pending(),
+                len(payload),
+            )
+            received += self.theirs.recv(1000 * 1000)
+        while len(received) < len(payload):
+            received += self.theirs.recv(1000 * 1000)
+        self.assertEqual(received, payload)
+        self.assertGreater(self.writer.chunks, self.writer.calls)
+
+    def _pending(self):
+        # bytes in the socket, not yet received
+        return struct.unpack("i", fcntl.ioctl(self.theirs, termios.FIONREAD, b"\0" * 4))[0]
+
+    def test_error(self):
+        self.theirs.close()
+        self.transport.write(b"hello")
+        self.assertIsInstance(self.writer._write(self.transport), Exception)
+
+    def test_disconnecting(self):
+        self.transport.disconnecting = True
+        lost = []
+        self.transport._postLoseConnection = lambda: lost.append(True) or "lost"
+        self.transport.write(b"hello")
+        self.assertEqual(self.writer._write(self.transport), "lost")
+        self.assertEqual(lost, [True])
+
+
+class Relay(unittest.TestCase):
+    def setUp(self):
+        self.recorder = MemoryUsageRecorder()
+        usage = UsageTracker(blur_usage=None)
+        usage.add_backend(self.recorder)
+        self.transit = Transit(usage, reactor.seconds)
+        self.reader = RelayReader(64 * 1024)
+        self.transit.relay_reader = self.reader
+
+        factory = ServerFactory()
+        factory.protocol = TransitConnection
+        factory.transit = self.transit
+        factory.log_requests = False
+        self.port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+
+    _connect = RelayMixin._connect
+
+    @inlineCallbacks
+    def test_slow_receiver(self):
+        writer = self.transit.relay_writer = VectoredWriter()
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.received = b.received = b""
+
+        b.transport.pauseProducing()
+        payload = os.urandom(2 * 1000 * 1000)
+        for i in range(0, len(payload), 1000):
+            a.transport.write(payload[i:i + 1000])
+        yield _wait_for(lambda: writer.calls > 0)
+        b.transport.resumeProducing()
+        yield _wait_for(lambda: len(b.received) == len(payload))
+        self.assertEqual(b.received, payload)
+        a.transport.loseConnection()
+        yield _wait_for(lambda: not b.connected)
+        yield _wait_for(lambda: self.recorder.events)
+        self.assertEqual(self.recorder.events[0]["total_bytes"], len(payload))
+
+    @inlineCallbacks
+    def test_relay(self):
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.received = b.received = b""
+
+        payload = os.urandom(2 * 1000 * 1000)
+        a.transport.write(payload)
+        b.transport.write(b"reply")
+        yield _wait_for(lambda: len(b.received) == len(payload) and a.received == b"reply")
+        self.assertEqual(b.received, payload)
+        self.assertGreater(self.reader.reads, 1)
+        self.assertEqual(self.reader.direct_bytes + self.reader.copied_bytes,
+                         len(payload) + len(b"reply"))
+
+        a.transport.loseConnection()
+        yield _wait_for(lambda: not b.connected)
+        yield _wait_for(lambda: self.recorder.events)
+        [event] = self.recorder.events
+        self.assertEqual(event["mood"], "happy")
+        self.assertEqual(event["total_bytes"], len(payload) + len(b"reply"))
+
+    @inlineCallbacks
+    def test_data_with_handshake(self):
+        # bytes that arrive along with the handshake line still go
+        # through LineReceiver
+        a = yield self._connect(b"1" * 16)
+        token = b"a" * 64
+        b = Client(b"please relay " + token + b" for side " + b"2" * 16 + b"\nhello")
+        factory = ClientFactory()
+        factory.protocol = lambda: b
+        reactor.connectTCP("127.0.0.1", self.port.getHost().port, factory)
+        yield _wait_for(lambda: a.received == b"ok\nhello")
+        a.transport.write(b"reply")
+        yield _wait_for(lambda: b.received == b"ok\nreply")
+        b.transport.loseConnection()
+        yield _wait_for(lambda: not a.connected)
+
+
+class Offloaded(RelayMixin, unittest.TestCase):
+    def setUp(self):
+        super(Offloaded, self).setUp()
+        self.transit.relay_reader = RelayReader(64 * 1024)
+
+    @inlineCallbacks
+    def test_elephant(self):
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.received = b.received = b""
+        payload = os.urandom(1000 * 1000)
+        a.transport.write(payload)
+        yield _wait_for(lambda: len(b.received) == len(payload))
+        self.assertEqual(b.received, payload)
+        self.assertEqual(self.offloader.offloaded, 1)
+        a.transport.loseConnection()
+        yield _wait_for(lambda: not b.connected)
@@ -0,0 +1,100 @@
+from twisted.trial import unittest
+from ..fdpressure import FdMonitor, count_open_fds, fd_limit
+
+
+class FakePendingRequests(object):
+    def __init__(self, lonely):
+        self.lonely = list(lonely)
+        self.asked = []
+
+    def evict_oldest(self, count):
+        self.asked.append(count)
+        evicted, self.lonely = self.lonely[:count], self.lonely[count:]
+        return evicted
+
+
+class Monitor(unittest.TestCase):
+    def setUp(self):
+        self.fds = 10
+        self.counted = 0
+
+    def _count(self):
+        self.counted += 1
+        return self.fds
+
+    def test_count_open_fds(self):
+        count = count_open_fds()
+        if count is None:
+            raise unittest.SkipTest("can't count file descriptors here")
+        self.assertGreater(count, 2)
+        self.assertIsInstance(fd_limit(), (int, type(None)))
+
+    def test_bad_marks(self):
+        with self.assertRaises(ValueError):
+            FdMonitor(100, 0.5, 0.8, count_fds=self._count)
+
+    def test_under(self):
+        monitor = FdMonitor(100, 0.9, 0.8, count_fds=self._count)
+        pending = FakePendingRequests([])
+        for _ in range(79):
+            monitor.connection_made(pending)
+        self.assertEqual(monitor.estimate(), 89)
+        # only measured once, at the start
+        self.assertEqual(self.counted, 1)
+        self.assertEqual(pending.asked, [])
+
+    def test_evict(self):
+        monitor = FdMonitor(100, 0.9, 0.8, count_fds=self._count)
+        pending = FakePendingRequests(range(50))
+        for _ in range(80):
+            self.fds += 1
+            monitor.connection_made(pending)
+        # the 80th took us to 90: evict down to 80
+        self.assertEqual(pending.asked, [10])
+        self.assertEqual(monitor.evicted, 10)
+        self.assertEqual(monitor.estimate(), 80)
+        # the evicted ones are still open, but don't count twice
+        self.fds += 1
+        monitor.connection_made(pending)
+        self.assertEqual(pending.asked, [10])
+        for state in range(10):
+            self.fds -= 1
+            monitor.connection_lost(state)
+        self.assertEqual(monitor.estimate(), 81)
+
+    def test_baseline(self):
+        monitor = FdMonitor(100, 0.9, 0.8, count_fds=self._count)
+        pending = FakePendingRequests(range(50))
+        for _ in range(79):
+            self.fds += 1
+            monitor.connection_made(pending)
+        # the estimate says 90, but something else closed 5 files
+        self.fds += 1 - 5
+        monitor.connection_made(pending)
+        self.assertEqual(pending.asked, [])
+        self.assertEqual(monitor.estimate(), 85)
+
+    def test_nothing_to_evict(self):
+        monitor = FdMonitor(100, 0.9, 0.8, count_fds=self._count)
+        pending = FakePendingRequests([])
+        for _ in range(80):
+            self.fds += 1
+            monitor.connection_made(pending)
+        self.assertEqual(monitor.evicted, 0)
+        counted = self.counted
+        # while there is nothing to evict, we measure less often
+        for _ in range(FdMonitor.RECOUNT - 1):
+            self.fds += 1
+            monitor.connection_made(pending)
+        self.assertEqual(self.counted, counted)
+        self.fds += 1
+        monitor.connection_made(pending)
+        self.assertEqual(self.counted, counted + 1)
+
+    def test_cannot_count(self):
+        monitor = FdMonitor(10, 0.5, 0.3, count_fds=lambda: None)
+        pending = FakePendingRequests(range(5))
+        for _ in range(5):
+            monitor.connection_made(pending)
+        self.assertEqual(pending.asked, [2])
+        self.assertEqual(monitor.estimate(), 3)
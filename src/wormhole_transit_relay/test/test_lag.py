@@ -0,0 +1,54 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from ..lag import LagMonitor, LAG_BUCKETS
+
+
+class Monitor(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_probe(self):
+        monitor = LagMonitor(self.clock, interval=0.1)
+        monitor.startService()
+        self.clock.advance(0.1)
+        # a turn of the reactor that took 30ms too long
+        self.clock.advance(0.13)
+        self.clock.advance(0.1)
+        counters = monitor.get_counters()
+        self.assertEqual(counters["reactor_lag.le_1ms"], 2)
+        self.assertEqual(counters["reactor_lag.le_50ms"], 1)
+        self.assertEqual(sum(monitor.histogram), 3)
+        monitor.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_buckets(self):
+        monitor = LagMonitor(self.clock)
+        for lag in (0.0, 0.002, 0.0021, 5.0, 60.0):
+            monitor.record(lag)
+        counters = monitor.get_counters()
+        self.assertEqual(counters["reactor_lag.le_1ms"], 1)
+        self.assertEqual(counters["reactor_lag.le_2ms"], 1)
+        self.assertEqual(counters["reactor_lag.le_5ms"], 1)
+        self.assertEqual(counters["reactor_lag.le_5000ms"], 1)
+        self.assertEqual(counters["reactor_lag.over_5000ms"], 1)
+        self.assertEqual(len(counters), len(LAG_BUCKETS) + 2)
+
+    def test_no_shedding(self):
+        monitor = LagMonitor(self.clock)
+        monitor.record(10.0)
+        self.assertFalse(monitor.refuse())
+
+    def test_shedding(self):
+        monitor = LagMonitor(self.clock, threshold=0.2)
+        # one slow turn isn't enough
+        monitor.record(0.5)
+        self.assertFalse(monitor.refuse())
+        monitor.record(1.0)
+        self.assertTrue(monitor.shedding)
+        self.assertTrue(monitor.refuse())
+        self.assertTrue(monitor.refuse())
+        self.assertEqual(monitor.get_counters()["shed"], 2)
+        while monitor.shedding:
+            monitor.record(0.0)
+        self.assertFalse(monitor.refuse())
+        self.assertLess(monitor.lag, 0.2)
@@ -0,0 +1,141 @@
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.error import ConnectionDone
+from twisted.internet.protocol import ClientFactory, ServerFactory
+from twisted.internet.testing import StringTransport
+from twisted.python.failure import Failure
+from autobahn.twisted.websocket import WebSocketServerFactory
+from ..transit_server import Transit, TransitConnection, WebSocketTransitConnection
+from ..usage import UsageTracker, MemoryUsageRecorder
+from ..limits import ConnectionLimiter
+from .test_offload import Client, _wait_for
+
+
+class Limiter(unittest.TestCase):
+    def test_keys(self):
+        limiter = ConnectionLimiter(2, ipv6_prefix=64)
+        self.assertEqual(limiter.key_for("1.2.3.4"), b"\x01\x02\x03\x04")
+        # IPv4 clients of a dual-stack listener count as IPv4
+        self.assertEqual(limiter.key_for("::ffff:1.2.3.4"), b"\x01\x02\x03\x04")
+        # IPv6 addresses in the same /64 share a key
+        self.assertEqual(limiter.key_for("2001:db8:1:2::1"),
+                         limiter.key_for("2001:db8:1:2:ffff::9"))
+        self.assertNotEqual(limiter.key_for("2001:db8:1:2::1"),
+                            limiter.key_for("2001:db8:1:3::1"))
+        self.assertEqual(len(limiter.key_for("2001:db8:1:2::1")), 8)
+        self.assertIs(limiter.key_for("not an address"), None)
+        self.assertIs(limiter.key_for(None), None)
+
+    def test_odd_prefix(self):
+        limiter = ConnectionLimiter(2, ipv6_prefix=60)
+        self.assertEqual(limiter.key_for("2001:db8:1:20::1"),
+                         limiter.key_for("2001:db8:1:2f::1"))
+        self.assertNotEqual(limiter.key_for("2001:db8:1:20::1"),
+                            limiter.key_for("2001:db8:1:30::1"))
+
+    def test_bad_prefix(self):
+        with self.assertRaises(ValueError):
+            ConnectionLimiter(2, ipv6_prefix=32)
+
+    def test_exempt(self):
+        limiter = ConnectionLimiter(2, exempt=["10.0.0.0/8", "2001:db8::1"])
+        self.assertIs(limiter.key_for("10.9.8.7"), None)
+        self.assertIs(limiter.key_for("::ffff:10.9.8.7"), None)
+        self.assertIs(limiter.key_for("2001:db8::1"), None)
+        # only that one address, not its /64
+        self.assertIsNot(limiter.key_for("2001:db8::2"), None)
+
+    def test_acquire_release(self):
+        limiter = ConnectionLimiter(2)
+        key = limiter.key_for("1.2.3.4")
+        self.assertTrue(limiter.acquire(key))
+        self.assertTrue(limiter.acquire(key))
+        self.assertFalse(limiter.acquire(key))
+        self.assertEqual(limiter.refused, 1)
+        self.assertTrue(limiter.acquire(limiter.key_for("1.2.3.5")))
+        self.assertEqual(len(limiter), 2)
+        limiter.release(key)
+        self.assertTrue(limiter.acquire(key))
+        for _ in range(2):
+            limiter.release(key)
+        limiter.release(limiter.key_for("1.2.3.5"))
+        # nothing is kept for sources that have gone
+        self.assertEqual(len(limiter), 0)
+
+
+class TCPStringTransport(StringTransport):
+    def setTcpKeepAlive(self, enabled):
+        pass
+
+    def unregisterProducer(self):
+        # like a real TCP transport, don't mind if there is none
+        self.producer = None
+
+
+class Connections(unittest.TestCase):
+    def setUp(self):
+        self.recorder = MemoryUsageRecorder()
+        usage = UsageTracker(blur_usage=None)
+        usage.add_backend(self.recorder)
+        self.transit = Transit(usage, reactor.seconds)
+        self.transit.limiter = ConnectionLimiter(2)
+
+    @inlineCallbacks
+    def test_tcp(self):
+        factory = ServerFactory()
+        factory.protocol = TransitConnection
+        factory.transit = self.transit
+        factory.log_requests = False
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        clients = []
+        for _ in range(3):
+            client = Client(b"")
+            clients.append(client)
+            cf = ClientFactory()
+            cf.protocol = lambda client=client: client
+            reactor.connectTCP("127.0.0.1", port.getHost().port, cf)
+        a, b, c = clients
+        yield _wait_for(lambda: a.connected and b.connected)
+        # the third is closed straight away, and not recorded
+        yield _wait_for(lambda: self.transit.get_counters()["over_limit"] == 1)
+        yield _wait_for(lambda: not c.connected)
+        self.assertTrue(a.connected and b.connected)
+        self.assertEqual(self.recorder.events, [])
+
+        # once one has gone, there is room again
+        a.transport.loseConnection()
+        yield _wait_for(lambda: len(self.recorder.events) == 1)
+        d = Client(b"")
+        cf = ClientFactory()
+        cf.protocol = lambda: d
+        reactor.connectTCP("127.0.0.1", port.getHost().port, cf)
+        yield _wait_for(lambda: d.connected)
+        b.transport.loseConnection()
+        d.transport.loseConnection()
+        yield _wait_for(lambda: len(self.transit.limiter) == 0)
+        self.assertEqual(self.transit.get_counters()["over_limit"], 1)
+
+    def test_websocket(self):
+        factory = WebSocketServerFactory("ws://localhost:4002")
+        factory.setProtocolOptions(openHandshakeTimeout=0)
+        factory.protocol = WebSocketTransitConnection
+        factory.transit = self.transit
+        factory.log_requests = False
+        peer = IPv4Address("TCP", "192.0.2.1", 12345)
+
+        protocols = []
+        for _ in range(3):
+            p = factory.buildProtocol(peer)
+            p.makeConnection(TCPStringTransport(peerAddress=peer))
+            protocols.append(p)
+        self.assertFalse(protocols[0].transport.disconnecting)
+        self.assertTrue(protocols[2].transport.disconnecting)
+        self.assertEqual(self.transit.get_counters()["over_limit"], 1)
+
+        for p in protocols:
+            p.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(len(self.transit.limiter), 0)
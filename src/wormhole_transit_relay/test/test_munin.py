@@ -0,0 +1,265 @@
+import io
+import os
+import time
+from unittest import mock
+from twisted.trial import unittest
+from .. import database, retention, munin
+from ..shmstats import StatsSegment
+
+DAY = retention.DAY
+
+HAPPY = database.mood_code("happy")
+LONELY = database.mood_code("lonely")
+
+
+def _insert(db, started, total_bytes, mood, weight=1):
+    db.execute("INSERT INTO `usage`"
+               " (`started`, `total_time_ms`, `waiting_time_ms`,"
+               "  `total_bytes`, `mood`, `weight`)"
+               " VALUES (?,?,?,?,?,?)",
+               (started, 1000, None, total_bytes, mood, weight))
+
+
+def _current(db, rebooted, updated, connected=2, waiting=1, incomplete_bytes=50):
+    db.execute("DELETE FROM `current`")
+    db.execute("INSERT INTO `current` VALUES (?,?,?,?,?)",
+               (rebooted, updated, connected, waiting, incomplete_bytes))
+
+
+class ReadUsageDB(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        dbfile = os.path.join(basedir, "usage.sqlite")
+        self.db = database.get_db(dbfile)
+        self.addCleanup(self.db.close)
+        # (the plugin's own connection)
+        self.reader = munin.open_usage_db(dbfile)
+        self.addCleanup(self.reader.close)
+
+    def test_empty(self):
+        self.assertIs(munin.read_usage_db(self.reader, {}), None)
+
+    def test_incremental(self):
+        _current(self.db, 10*DAY, 12*DAY)
+        _insert(self.db, 1*DAY, 100, HAPPY)
+        _insert(self.db, 11*DAY, 10, HAPPY, weight=3)
+        _insert(self.db, 11*DAY, 0, LONELY)
+        self.db.commit()
+        cache = {}
+        reading = munin.read_usage_db(self.reader, cache)
+        self.assertEqual(reading["connections"], {"happy": 3, "lonely": 1})
+        self.assertEqual(reading["bytes"], 30)
+        self.assertEqual(reading["all_time_connections"], {"happy": 4, "lonely": 1})
+        self.assertEqual(reading["all_time_bytes"], 130)
+        self.assertEqual((reading["connected"], reading["waiting"],
+                          reading["incomplete_bytes"]), (2, 1, 50))
+        self.assertEqual(cache["sources"][""]["rowid"], 3)
+
+        # only the new rows are read next time
+        _insert(self.db, 11*DAY, 5, HAPPY)
+        self.db.commit()
+        reading = munin.read_usage_db(self.reader, cache)
+        self.assertEqual(reading["connections"], {"happy": 4, "lonely": 1})
+        self.assertEqual(reading["all_time_bytes"], 135)
+        self.assertEqual(cache["sources"][""]["rowid"], 4)
+
+        # rows moved into the rollups are not counted twice
+        retention.prune_usage(self.db, 5*DAY, pause=0)
+        reading = munin.read_usage_db(self.reader, cache)
+        self.assertEqual(reading["all_time_connections"], {"happy": 5, "lonely": 1})
+        self.assertEqual(reading["all_time_bytes"], 135)
+        self.assertEqual(reading["bytes"], 35)
+        # .. which matches starting over
+        self.assertEqual(munin.read_usage_db(self.reader, {}), reading)
+
+    def test_pruned_everything(self):
+        # once every row is gone, SQLite hands out the same rowids again
+        _current(self.db, 10*DAY, 12*DAY)
+        for i in range(5):
+            _insert(self.db, 1*DAY, 10, HAPPY)
+        self.db.commit()
+        cache = {}
+        munin.read_usage_db(self.reader, cache)
+        self.assertEqual(cache["sources"][""]["rowid"], 5)
+        retention.prune_usage(self.db, 5*DAY, pause=0)
+        for i in range(3):
+            _insert(self.db, 11*DAY, 20, HAPPY)
+        self.db.commit()
+        reading = munin.read_usage_db(self.reader, cache)
+        self.assertEqual(reading["all_time_connections"], {"happy": 8})
+        self.assertEqual(reading["all_time_bytes"], 110)
+        self.assertEqual(reading["connections"], {"happy": 3})
+
+        # .. even when there are more of them than before
+        retention.prune_usage(self.db, 20*DAY, pause=0)
+        for i in range(7):
+            _insert(self.db, 11*DAY + 1, 1, HAPPY)
+        self.db.commit()
+        reading = munin.read_usage_db(self.reader, cache)
+        self.assertEqual(reading["all_time_connections"], {"happy": 15})
+        self.assertEqual(reading["all_time_bytes"], 117)
+        self.assertEqual(reading["connections"], {"happy": 7})
+
+    def test_partitions(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        dbfile = os.path.join(basedir, "usage.sqlite")
+        pdb = database.get_partitioned_db(dbfile, "day")
+        self.addCleanup(pdb.close)
+        reader = munin.open_usage_db(dbfile)
+        self.addCleanup(reader.close)
+        _current(pdb.index, 1*DAY, 3*DAY)
+        pdb.index.commit()
+        for started in (0*DAY + 5, 1*DAY + 5, 2*DAY + 5, 2*DAY + 6):
+            part = pdb.partition_for(started)
+            _insert(part, started, 10, HAPPY)
+            part.commit()
+
+        cache = {}
+        reading = munin.read_usage_db(reader, cache, basedir)
+        self.assertEqual(reading["all_time_connections"], {"happy": 4})
+        self.assertEqual(reading["all_time_bytes"], 40)
+        self.assertEqual(reading["connections"], {"happy": 3})
+        # (nothing in the index itself)
+        self.assertEqual(munin.read_usage_db(reader, {})["all_time_connections"], {})
+
+        # a dropped partition is counted once, in the index's rollups
+        self.assertEqual(retention.prune_partitions(pdb, 1*DAY, pause=0), 1)
+        part = pdb.partition_for(2*DAY + 7)
+        _insert(part, 2*DAY + 7, 10, LONELY)
+        part.commit()
+        reading = munin.read_usage_db(reader, cache, basedir)
+        self.assertEqual(reading["all_time_connections"], {"happy": 4, "lonely": 1})
+        self.assertEqual(reading["all_time_bytes"], 50)
+        self.assertEqual(reading["connections"], {"happy": 3, "lonely": 1})
+        self.assertEqual(munin.read_usage_db(reader, {}, basedir), reading)
+
+    def test_reboot(self):
+        _current(self.db, 10*DAY, 12*DAY)
+        _insert(self.db, 11*DAY, 10, HAPPY)
+        self.db.commit()
+        cache = {}
+        munin.read_usage_db(self.reader, cache)
+        _current(self.db, 13*DAY, 13*DAY)
+        _insert(self.db, 13*DAY + 1, 20, HAPPY)
+        self.db.commit()
+        reading = munin.read_usage_db(self.reader, cache)
+        self.assertEqual(reading["connections"], {"happy": 1})
+        self.assertEqual(reading["all_time_connections"], {"happy": 2})
+
+    def test_covering_index(self):
+        # reading everything never touches the table itself
+        plans = []
+        real_execute = self.reader.execute
+
+        def execute(query, args=()):
+            if "FROM `usage`" in query:
+                plans.extend(r[3] for r in
+                             real_execute("EXPLAIN QUERY PLAN " + query, args).fetchall())
+            return real_execute(query, args)
+        _current(self.db, 0, 1)
+        self.db.commit()
+        db = mock.Mock(execute=execute)
+        munin.read_usage_db(db, {})
+        self.assertIn("SCAN usage USING COVERING INDEX usage_started_mood_index", plans)
+
+
+class Plugin(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        self.dbfile = os.path.join(basedir, "usage.sqlite")
+        self.shmfile = os.path.join(basedir, "stats")
+        self.environ = {"MUNIN_PLUGSTATE": basedir, "MUNIN_CAP_MULTIGRAPH": "1"}
+        self.now = time.time()
+        db = database.get_db(self.dbfile)
+        _current(db, self.now - DAY, self.now)
+        _insert(db, self.now - 60, 1000, HAPPY)
+        _insert(db, self.now - 2*DAY, 500, LONELY)
+        db.commit()
+        db.close()
+
+    def _plugin(self, *args, **environ):
+        out = io.StringIO()
+        rc = munin.main(list(args) or ["wormhole_transit"],
+                        dict(self.environ, **environ), out)
+        self.assertEqual(rc, 0)
+        return out.getvalue()
+
+    def test_config(self):
+        out = self._plugin("wormhole_transit", "config", usagedb=self.dbfile)
+        self.assertEqual([line for line in out.splitlines() if line.startswith("multigraph")],
+                         ["multigraph %s" % g for g in munin.GRAPHS])
+        self.assertIn("graph_title Magic-Wormhole Transit Active Channels\n", out)
+
+    def test_autoconf(self):
+        self.assertEqual(self._plugin("wormhole_transit", "autoconf"),
+                         "no (set env.usagedb or env.statsshm)\n")
+        self.assertEqual(self._plugin("wormhole_transit", "autoconf", usagedb=self.dbfile),
+                         "yes\n")
+
+    def test_multigraph(self):
+        out = self._plugin(usagedb=self.dbfile)
+        self.assertIn("multigraph wormhole_transit_active\n"
+                      "waiting.value 1\n"
+                      "connected.value 2\n", out)
+        self.assertIn("multigraph wormhole_transit_bytes\n"
+                      "bytes.value 1000\n"
+                      "incomplete.value 1050\n", out)
+        self.assertIn("multigraph wormhole_transit_bytes_alltime\n"
+                      "bytes.value 1500\n", out)
+        self.assertIn("multigraph wormhole_transit_events_alltime\n"
+                      "happy.value 1\n"
+                      "errory.value 0\n"
+                      "lonely.value 1\n", out)
+
+        # the database isn't read again for a while
+        with mock.patch("wormhole_transit_relay.munin.open_usage_db",
+                        side_effect=AssertionError("read the database")):
+            self.assertEqual(self._plugin(usagedb=self.dbfile), out)
+
+    def test_needs_multigraph(self):
+        environ = dict(self.environ, usagedb=self.dbfile)
+        del environ["MUNIN_CAP_MULTIGRAPH"]
+        self.assertEqual(munin.main(["wormhole_transit"], environ, io.StringIO()), 1)
+
+    def test_one_graph(self):
+        # as the scripts in misc/munin, or a link with a graph's name
+        out = self._plugin("/etc/munin/plugins/wormhole_transit_events", usagedb=self.dbfile)
+        self.assertEqual(out, "happy.value 1\nerrory.value 0\nlonely.value 0\n"
+                              "redundant.value 0\n")
+        config = self._plugin("wormhole_transit_events", "config", usagedb=self.dbfile)
+        self.assertTrue(config.startswith(
+            "graph_title Magic-Wormhole Transit Server Events (since reboot)\n"))
+
+    def test_stale(self):
+        db = database.get_db(self.dbfile)
+        _current(db, self.now - DAY, self.now - munin.STALE - 60)
+        db.commit()
+        db.close()
+        out = self._plugin("wormhole_transit_active", usagedb=self.dbfile)
+        self.assertEqual(out, "waiting.value U\nconnected.value U\n")
+
+    def test_shm(self):
+        segment = StatsSegment(self.shmfile)
+        self.addCleanup(segment.close)
+        segment.publish({"updated": self.now, "connected": 7, "waiting": 3,
+                         "bytes": 99, "connections.happy": 4})
+        with mock.patch("wormhole_transit_relay.munin.open_usage_db",
+                        side_effect=AssertionError("read the database")):
+            out = self._plugin(statsshm=self.shmfile)
+        # no database, so no all-time graphs
+        self.assertEqual(out.count("multigraph"), 3)
+        self.assertIn("multigraph wormhole_transit_active\n"
+                      "waiting.value 3\n"
+                      "connected.value 7\n", out)
+        self.assertIn("multigraph wormhole_transit_events\n"
+                      "happy.value 4\n", out)
+
+        # with both, only the all-time graphs need the database
+        out = self._plugin(statsshm=self.shmfile, usagedb=self.dbfile)
+        self.assertIn("multigraph wormhole_transit_bytes\n"
+                      "bytes.value 99\n", out)
+        self.assertIn("multigraph wormhole_transit_bytes_alltime\n"
+                      "bytes.value 1500\n", out)
@@ -0,0 +1,260 @@
+import os
+import queue
+import socket
+import threading
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.protocol import ClientFactory, Protocol, ServerFactory
+from ..transit_server import Transit, TransitConnection
+from ..timers import TimerWheel
+from ..usage import UsageTracker, MemoryUsageRecorder
+from .. import offload
+
+
+def _recv_exactly(sock, count):
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class PumpMixin(object):
+    """
+    Tests for anything with the RelayPump interface.
+    """
+    flow_type = None
+
+    def make_pump(self, call_from_thread):
+        return offload.RelayPump(call_from_thread, "report", "finished",
+                                 flow_type=self.flow_type)
+
+    def setUp(self):
+        self.calls = queue.Queue()
+        self.pump = self.make_pump(lambda f, *args: self.calls.put((f, args)))
+        self.pump.start()
+        self.addCleanup(self.pump.stop)
+        # client0 <-> server0 ==pump== server1 <-> client1
+        self.client0, server0 = socket.socketpair()
+        self.client1, server1 = socket.socketpair()
+        for s in (self.client0, self.client1):
+            s.settimeout(5)
+            self.addCleanup(s.close)
+        for s in (server0, server1):
+            s.setblocking(False)
+            self.addCleanup(s.close)
+        self.pump.add_pair("key", server0, server1)
+
+    def _next_call(self):
+        return self.calls.get(timeout=5)
+
+    def test_copies_both_ways(self):
+        payload = os.urandom(3 * offload.BUFSIZE + 17)
+        sender = threading.Thread(target=self.client0.sendall, args=(payload,))
+        sender.start()
+        self.addCleanup(sender.join)
+        self.assertEqual(_recv_exactly(self.client1, len(payload)), payload)
+        self.client1.sendall(b"reply")
+        self.assertEqual(_recv_exactly(self.client0, 5), b"reply")
+
+        self.client0.shutdown(socket.SHUT_WR)
+        reported = [0, 0]
+        while True:
+            f, args = self._next_call()
+            if f == "finished":
+                break
+            self.assertEqual(f, "report")
+            for (key, moved) in args[0]:
+                self.assertEqual(key, "key")
+                reported = [a + b for (a, b) in zip(reported, moved)]
+        self.assertEqual(args, ("key", 0, [b"", b""]))
+        self.assertEqual(reported, [len(payload), 5])
+        self.assertEqual(self.pump.load(), 0)
+
+    def test_stop_releases_pairs(self):
+        self.client0.sendall(b"hello")
+        self.assertEqual(_recv_exactly(self.client1, 5), b"hello")
+        self.pump.stop()
+        [(key, closed, leftovers, moved)] = self.pump.remaining
+        self.assertEqual((key, closed, leftovers), ("key", None, [b"", b""]))
+
+    def test_release_pair(self):
+        self.client0.sendall(b"hello")
+        self.assertEqual(_recv_exactly(self.client1, 5), b"hello")
+        self.pump.release_pair("key")
+        self.pump.release_pair("key") # (already gone)
+        calls = [self._next_call()]
+        if calls[0][0] == "report":
+            calls.append(self._next_call())
+        self.assertEqual(calls[-1], ("finished", ("key", None, [b"", b""])))
+        self.assertEqual(self.pump.load(), 0)
+
+
+class BufferPump(PumpMixin, unittest.TestCase):
+    flow_type = offload._BufferFlow
+
+
+class SplicePump(PumpMixin, unittest.TestCase):
+    flow_type = offload._SpliceFlow
+
+    if not hasattr(os, "splice"):
+        skip = "os.splice is not available"
+
+
+class Client(Protocol):
+    def __init__(self, handshake):
+        self.handshake = handshake
+        self.received = b""
+        self.connected = False
+
+    def connectionMade(self):
+        self.connected = True
+        self.transport.write(self.handshake)
+
+    def dataReceived(self, data):
+        self.received += data
+
+    def connectionLost(self, reason):
+        self.connected = False
+
+
+@inlineCallbacks
+def _wait_for(condition, timeout=10.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        yield task.deferLater(reactor, 0.01, lambda: None)
+    raise AssertionError("timed out")
+
+
+class RelayMixin(object):
+    """
+    Run a real relay, on localhost, with an Offloader.
+    """
+
+    def make_offloader(self):
+        return offload.Offloader(reactor, 1, threshold=100 * 1000)
+
+    def setUp(self):
+        self.recorder = MemoryUsageRecorder()
+        usage = UsageTracker(blur_usage=None)
+        usage.add_backend(self.recorder)
+        self.transit = Transit(usage, reactor.seconds)
+        self.offloader = self.make_offloader()
+        self.transit.offloader = self.offloader
+        self.offloader.startService()
+        self.addCleanup(self.offloader.stopService)
+
+        factory = ServerFactory()
+        factory.protocol = TransitConnection
+        factory.transit = self.transit
+        factory.log_requests = False
+        self.port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+
+    @inlineCallbacks
+    def _connect(self, side):
+        token = b"a" * 64
+        client = Client(b"please relay " + token + b" for side " + side + b"\n")
+        factory = ClientFactory()
+        factory.protocol = lambda: client
+        reactor.connectTCP("127.0.0.1", self.port.getHost().port, factory)
+        yield _wait_for(lambda: client.connected)
+        return client
+
+    @inlineCallbacks
+    def _idle_after(self, payload):
+        self.transit.timers = TimerWheel(reactor, tick=0.1)
+        self.addCleanup(self.transit.timers.stop)
+        self.transit.idle_timeout = 1.0
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.transport.write(payload)
+        yield _wait_for(lambda: len(b.received) == 3 + len(payload))
+        self.assertEqual(self.offloader.offloaded, 1)
+        # the pump hands the pair back, and it is closed like any other
+        yield _wait_for(lambda: not a.connected and not b.connected)
+        yield _wait_for(lambda: self.recorder.events)
+        [event] = self.recorder.events
+        self.assertEqual(event["mood"], "idle")
+        self.assertEqual(event["total_bytes"], len(payload))
+        self.assertEqual(self.offloader._owners, {})
+
+
+class Offload(RelayMixin, unittest.TestCase):
+    @inlineCallbacks
+    def test_elephant(self):
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.received = b.received = b""
+
+        payload = os.urandom(1000 * 1000)
+        a.transport.write(payload)
+        yield _wait_for(lambda: len(b.received) == len(payload))
+        self.assertEqual(b.received, payload)
+        self.assertEqual(self.offloader.offloaded, 1)
+
+        # still relaying in both directions from the thread
+        b.transport.write(b"reply")
+        yield _wait_for(lambda: a.received == b"reply")
+
+        a.transport.loseConnection()
+        yield _wait_for(lambda: not b.connected)
+        yield _wait_for(lambda: self.recorder.events)
+        [event] = self.recorder.events
+        self.assertEqual(event["mood"], "happy")
+        self.assertEqual(event["total_bytes"], len(payload) + len(b"reply"))
+        self.assertEqual(self.transit.active_connections._connections, set())
+
+    def test_idle(self):
+        return self._idle_after(b"x" * 200 * 1000)
+
+    @inlineCallbacks
+    def test_resume(self):
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.transport.write(b"x" * 200 * 1000)
+        yield _wait_for(lambda: len(b.received) == 3 + 200 * 1000)
+        conn, other = [side._client for side in self.transit.active_connections._connections]
+        released = []
+        self.assertTrue(self.offloader.release(conn, lambda: released.append(True)))
+        yield _wait_for(lambda: released)
+        self.offloader.resume(conn, other)
+        # it is relayed again (being an elephant, from a thread again)
+        b.transport.write(b"reply")
+        yield _wait_for(lambda: a.received.endswith(b"reply"))
+        a.transport.loseConnection()
+        yield _wait_for(lambda: not b.connected)
+        yield _wait_for(lambda: self.recorder.events)
+        self.assertEqual(self.recorder.events[0]["mood"], "happy")
+
+    @inlineCallbacks
+    def test_mouse(self):
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.transport.write(b"small")
+        yield _wait_for(lambda: b.received == b"ok\nsmall")
+        self.assertEqual(self.offloader.offloaded, 0)
+        a.transport.loseConnection()
+        yield _wait_for(lambda: not b.connected)
+
+    @inlineCallbacks
+    def test_stop_service(self):
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.transport.write(b"x" * 200 * 1000)
+        yield _wait_for(lambda: len(b.received) == 3 + 200 * 1000)
+        self.assertEqual(self.offloader.offloaded, 1)
+        self.offloader.stopService()
+        # the pairs are handed back and closed, and the usage recorded
+        yield _wait_for(lambda: not a.connected and not b.connected)
+        yield _wait_for(lambda: self.recorder.events)
+        self.assertEqual(self.recorder.events[0]["total_bytes"], 200 * 1000)
@@ -0,0 +1,100 @@
+import os
+import pstats
+import signal
+import sys
+import time
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from ..profiling import Profiler, ProfilerService, collapse
+from .. import profiling
+
+
+class FakeReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.from_thread = []
+
+    def callFromThread(self, f, *args):
+        self.from_thread.append((f, args))
+
+
+def _busy_for(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class Profiling(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+
+    def test_collapse(self):
+        def inner():
+            return collapse(sys._getframe())
+        names = inner().split(";")
+        code = inner.__code__
+        self.assertEqual(names[-1], "test/test_profiling.py:" + getattr(code, "co_qualname", code.co_name))
+        self.assertTrue(names[-2].startswith("test/test_profiling.py:"))
+        self.assertGreater(len(names), 2)
+
+    def test_sample(self):
+        self.patch(profiling, "SAMPLE_INTERVAL", 0.001)
+        profiler = Profiler(self.reactor, self.directory, seconds=0.2)
+        path = profiler.start()
+        # only one at a time
+        self.assertIs(profiler.start(), None)
+        _busy_for(0.4)
+        # the sampler reports back through the reactor
+        for _ in range(100):
+            if self.reactor.from_thread:
+                break
+            time.sleep(0.05)
+        [(f, args)] = self.reactor.from_thread
+        f(*args)
+        self.assertFalse(profiler.running)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertIn("_busy_for", stack)
+        self.assertGreater(int(count), 10)
+
+    def test_cprofile(self):
+        profiler = Profiler(self.reactor, self.directory, seconds=10, mode="cprofile")
+        path = profiler.start()
+        self.assertTrue(path.endswith(".pstats"))
+        _busy_for(0.01)
+        self.reactor.advance(10)
+        self.assertFalse(profiler.running)
+        stats = pstats.Stats(path)
+        names = [name for (_, _, name) in stats.stats]
+        self.assertIn("_busy_for", names)
+
+    def test_bad_mode(self):
+        with self.assertRaises(ValueError):
+            Profiler(self.reactor, self.directory, mode="perf")
+
+    def test_signal(self):
+        profiler = Profiler(self.reactor, self.directory)
+        service = ProfilerService(self.reactor, profiler)
+        service.startService()
+        self.addCleanup(lambda: service.running and service.stopService())
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertEqual(self.reactor.from_thread, [(profiler.start, ())])
+        service.stopService()
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), signal.SIG_DFL)
+
+    def test_previous_handler(self):
+        # twistd rotates its logs on SIGUSR1, and still should
+        rotated = []
+        previous = signal.signal(signal.SIGUSR1, lambda signum, frame: rotated.append(signum))
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+        profiler = Profiler(self.reactor, self.directory)
+        service = ProfilerService(self.reactor, profiler)
+        service.startService()
+        self.addCleanup(lambda: service.running and service.stopService())
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertEqual(self.reactor.from_thread, [(profiler.start, ())])
+        self.assertEqual(rotated, [signal.SIGUSR1])
@@ -0,0 +1,121 @@
+import io
+import json
+from twisted.trial import unittest
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from ..requestlog import RequestLogger, JSONLinesSink
+from .common import RecordingSink
+
+
+class Logger(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.sink = RecordingSink()
+
+    def test_record(self):
+        logger = RequestLogger(self.sink, clock=self.clock.seconds)
+        self.clock.advance(5)
+        logger.event("impatient", token="abc")
+        self.assertEqual(self.sink.records, [{"time": 5, "event": "impatient", "token": "abc"}])
+
+    def test_sample(self):
+        logger = RequestLogger(self.sink, sample=0.25, clock=self.clock.seconds)
+        for i in range(9):
+            logger.event("idle", n=i)
+        self.assertEqual([r["n"] for r in self.sink.records], [0, 4, 8])
+
+    def test_deferred_formatting(self):
+        calls = []
+
+        def token():
+            calls.append(None)
+            return "abc"
+        logger = RequestLogger(self.sink, sample=0.5, clock=self.clock.seconds)
+        logger.event("idle", token=token)
+        logger.event("idle", token=token)
+        # only the kept event asked for its token
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.sink.records[0]["token"], "abc")
+
+    def test_rate(self):
+        logger = RequestLogger(self.sink, max_per_second=2, clock=self.clock.seconds)
+        for _ in range(5):
+            logger.event("refused")
+        self.assertEqual((len(self.sink.records), logger.capped), (2, 3))
+        self.clock.advance(1)
+        logger.event("refused")
+        self.assertEqual(len(self.sink.records), 3)
+
+    def test_bad_sample(self):
+        with self.assertRaises(ValueError):
+            RequestLogger(self.sink, sample=0)
+
+
+class Sink(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.f = io.StringIO()
+        self.writes = []
+
+    def _in_thread(self, f, *args):
+        # run "in the thread" only when the test fires the Deferred
+        d = Deferred()
+        d.addCallback(lambda _: f(*args))
+        self.writes.append((d, args[1]))
+        return d
+
+    def _lines(self):
+        return [json.loads(line) for line in self.f.getvalue().splitlines()]
+
+    def test_batch(self):
+        sink = JSONLinesSink(self.clock, self.f, interval=1.0, in_thread=self._in_thread)
+        sink.emit({"event": "a"})
+        sink.emit({"event": "b"})
+        self.assertEqual(self.writes, [])
+        self.clock.advance(1)
+        # one write for the whole batch, and none of it on the reactor
+        [(d, records)] = self.writes
+        self.assertEqual(records, [{"event": "a"}, {"event": "b"}])
+        self.assertEqual(self.f.getvalue(), "")
+
+        # while that write is busy, new records wait for it
+        sink.emit({"event": "c"})
+        self.clock.advance(1)
+        self.assertEqual(len(self.writes), 1)
+        d.callback(None)
+        self.clock.advance(1)
+        self.writes[1][0].callback(None)
+        self.assertEqual(self._lines(), [{"event": "a"}, {"event": "b"}, {"event": "c"}])
+
+    def test_bounded(self):
+        self.patch(JSONLinesSink, "MAX_QUEUED", 2)
+        sink = JSONLinesSink(self.clock, self.f, in_thread=self._in_thread)
+        for name in "abc":
+            sink.emit({"event": name})
+        self.assertEqual(sink.dropped, 1)
+
+    def test_stop(self):
+        sink = JSONLinesSink(self.clock, self.f, in_thread=self._in_thread)
+        sink.startService()
+        sink.emit({"event": "a"})
+        self.successResultOf(sink.stopService())
+        self.assertEqual(self._lines(), [{"event": "a"}])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop_while_writing(self):
+        sink = JSONLinesSink(self.clock, self.f, in_thread=self._in_thread)
+        sink.startService()
+        sink.emit({"event": "a"})
+        self.clock.advance(1)
+        [(d, _)] = self.writes
+        sink.emit({"event": "b"})
+        stopped = sink.stopService()
+        # nothing is written alongside the write in its thread ..
+        self.assertNoResult(stopped)
+        self.assertEqual(self.f.getvalue(), "")
+        # .. the rest goes after it
+        d.callback(None)
+        self.successResultOf(stopped)
+        self.assertEqual(self._lines(), [{"event": "a"}, {"event": "b"}])
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,278 @@
+import os
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from .. import database, retention, usage
+
+DAY = retention.DAY
+
+HAPPY = database.mood_code("happy")
+LONELY = database.mood_code("lonely")
+
+def _insert(db, started, total_bytes, mood, total_time_ms=10000,
+            waiting_time_ms=2000):
+    db.execute("INSERT INTO `usage`"
+               " (`started`, `total_time_ms`, `waiting_time_ms`,"
+               "  `total_bytes`, `mood`)"
+               " VALUES (?,?,?,?,?)",
+               (started, total_time_ms, waiting_time_ms, total_bytes, mood))
+
+class Prune(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        self.dbfile = os.path.join(basedir, "usage.sqlite")
+        self.db = database.get_db(self.dbfile)
+
+    def test_new_db_is_incremental(self):
+        # 2 is INCREMENTAL
+        self.assertEqual(self.db.execute("PRAGMA auto_vacuum").fetchone(),
+                         {"auto_vacuum": 2})
+
+    def test_rollup_and_delete(self):
+        for i in range(7):
+            _insert(self.db, 10*DAY + i, 100, HAPPY)
+        _insert(self.db, 10*DAY + 50, 5, LONELY, waiting_time_ms=None)
+        _insert(self.db, 11*DAY + 1, 1000, HAPPY)
+        _insert(self.db, 20*DAY, 1, HAPPY) # newer than the cutoff
+        self.db.commit()
+
+        deleted = retention.prune_usage(self.db, 15*DAY, batch_size=3, pause=0)
+        self.assertEqual(deleted, 9)
+        self.assertEqual(self.db.execute("SELECT `started` FROM `usage`").fetchall(),
+                         [{"started": 20*DAY}])
+        rollups = self.db.execute("SELECT * FROM `usage_rollups`"
+                                  " ORDER BY `day`, `mood`").fetchall()
+        self.assertEqual(rollups, [
+            dict(day=10*DAY, mood=HAPPY, connections=7, total_bytes=700,
+                 total_time_ms=70000, waiting_time_ms=14000),
+            dict(day=10*DAY, mood=LONELY, connections=1, total_bytes=5,
+                 total_time_ms=10000, waiting_time_ms=0),
+            dict(day=11*DAY, mood=HAPPY, connections=1, total_bytes=1000,
+                 total_time_ms=10000, waiting_time_ms=2000),
+        ])
+
+        # pruning again merges into the existing rollups
+        _insert(self.db, 10*DAY + 3, 1, HAPPY)
+        self.db.commit()
+        self.assertEqual(retention.prune_usage(self.db, 15*DAY, pause=0), 1)
+        row = self.db.execute("SELECT * FROM `usage_rollups`"
+                              " WHERE `day`=? AND `mood`=?",
+                              (10*DAY, HAPPY)).fetchone()
+        self.assertEqual((row["connections"], row["total_bytes"]), (8, 701))
+
+    def test_rollup_weights(self):
+        self.db.execute("INSERT INTO `usage`"
+                        " (`started`, `total_time_ms`, `waiting_time_ms`,"
+                        "  `total_bytes`, `mood`, `weight`)"
+                        " VALUES (?,?,?,?,?,?)",
+                        (DAY, 100, None, 5, HAPPY, 10))
+        self.db.commit()
+        retention.prune_usage(self.db, 2*DAY, pause=0)
+        self.assertEqual(self.db.execute("SELECT * FROM `usage_rollups`").fetchall(),
+                         [dict(day=DAY, mood=HAPPY, connections=10, total_bytes=50,
+                               total_time_ms=1000, waiting_time_ms=0)])
+
+    def test_nothing_to_prune(self):
+        _insert(self.db, 20*DAY, 1, HAPPY)
+        self.db.commit()
+        self.assertEqual(retention.prune_usage(self.db, 15*DAY, pause=0), 0)
+
+    def test_vacuum_releases_pages(self):
+        for i in range(5000):
+            _insert(self.db, i, i, HAPPY)
+        self.db.commit()
+        pages_before = self.db.execute("PRAGMA page_count").fetchone()["page_count"]
+        retention.prune_usage(self.db, 10*DAY, pause=0)
+        self.assertEqual(self.db.execute("PRAGMA freelist_count").fetchone(),
+                         {"freelist_count": 0})
+        pages_after = self.db.execute("PRAGMA page_count").fetchone()["page_count"]
+        self.assertLess(pages_after, pages_before)
+
+    @inlineCallbacks
+    def test_pruner(self):
+        _insert(self.db, 1*DAY, 1, HAPPY)
+        _insert(self.db, 9*DAY, 1, HAPPY)
+        self.db.commit()
+        pruner = retention.UsagePruner(reactor, self.dbfile, 5*DAY,
+                                       lambda: 10*DAY)
+        deleted = yield pruner.prune()
+        self.assertEqual(deleted, 1)
+        self.assertEqual(self.db.execute("SELECT `started` FROM `usage`").fetchall(),
+                         [{"started": 9*DAY}])
+
+    @inlineCallbacks
+    def test_pruner_error(self):
+        pruner = retention.UsagePruner(reactor, self.dbfile + ".missing",
+                                       5*DAY, lambda: 10*DAY)
+        deleted = yield pruner.prune()
+        self.assertIs(deleted, None)
+        self.assertEqual(len(self.flushLoggedErrors(database.DBDoesntExist)), 1)
+
+
+def _snapshot(db, updated, connected, points=1):
+    db.execute("INSERT INTO `stats_history`"
+               " (`updated`, `points`, `connected`, `waiting`, `incomplete_bytes`)"
+               " VALUES (?,?,?,?,?)",
+               (updated, points, connected, 0, connected * 1000))
+
+class DownsampleHistory(unittest.TestCase):
+    def setUp(self):
+        self.db = database.get_db(":memory:")
+
+    def _history(self):
+        return self.db.execute("SELECT `updated`, `points`, `connected`,"
+                               " `incomplete_bytes` FROM `stats_history`"
+                               " ORDER BY `updated`").fetchall()
+
+    def test_downsample(self):
+        H = retention.HOUR
+        for i in range(12):
+            _snapshot(self.db, 10*H + i*300, i)
+        _snapshot(self.db, 11*H + 60, 7)
+        _snapshot(self.db, 12*H + 60, 100)
+        self.db.commit()
+        # (the cutoff is rounded down to 12*H)
+        removed = retention.downsample_history(self.db, 12*H + 1000)
+        self.assertEqual(removed, 11)
+        self.assertEqual(self._history(), [
+            dict(updated=10*H, points=12, connected=6, incomplete_bytes=5500),
+            dict(updated=11*H, points=1, connected=7, incomplete_bytes=7000),
+            dict(updated=12*H + 60, points=1, connected=100, incomplete_bytes=100000),
+        ])
+        # doing it again changes nothing
+        self.assertEqual(retention.downsample_history(self.db, 12*H + 1000), 0)
+        self.assertEqual(len(self._history()), 3)
+
+    def test_weighted(self):
+        H = retention.HOUR
+        # an hour that was downsampled, and then got another snapshot
+        _snapshot(self.db, 10*H, 10, points=3)
+        _snapshot(self.db, 10*H + 1800, 2)
+        self.db.commit()
+        retention.downsample_history(self.db, 11*H)
+        self.assertEqual(self._history(), [
+            dict(updated=10*H, points=4, connected=8, incomplete_bytes=8000),
+        ])
+        self.assertEqual(database.stats_history(self.db, 0, 11*H, step=H),
+                         [dict(updated=10*H, connected=8.0, waiting=0.0,
+                               incomplete_bytes=8000.0)])
+
+    @inlineCallbacks
+    def test_pruner(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        dbfile = os.path.join(basedir, "usage.sqlite")
+        db = database.get_db(dbfile)
+        _insert(db, 1*DAY, 1, HAPPY)
+        _snapshot(db, 1*DAY, 1)
+        _snapshot(db, 1*DAY + 60, 3)
+        db.commit()
+        # no --usage-retention, so the usage rows stay
+        pruner = retention.UsagePruner(reactor, dbfile, None, lambda: 10*DAY,
+                                       history_age=5*DAY)
+        deleted = yield pruner.prune()
+        self.assertEqual(deleted, 0)
+        self.assertEqual(len(db.execute("SELECT * FROM `usage`").fetchall()), 1)
+        self.assertEqual(database.stats_history(db, 0, 10*DAY),
+                         [dict(updated=1*DAY, connected=2, waiting=0,
+                               incomplete_bytes=2000)])
+
+class PrunePartitions(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        self.basedir = basedir
+        self.dbfile = os.path.join(basedir, "usage.sqlite")
+        self.pdb = database.get_partitioned_db(self.dbfile, "day")
+        for started, total_bytes in [(1*DAY + 5, 10), (1*DAY + 6, 20),
+                                     (2*DAY + 5, 30), (2*DAY + 50000, 40),
+                                     (3*DAY, 50)]:
+            db = self.pdb.partition_for(started)
+            _insert(db, started, total_bytes, HAPPY)
+            db.commit()
+        self.addCleanup(self.pdb.close)
+
+    def test_prune_partitions(self):
+        dropped = retention.prune_partitions(self.pdb, 2*DAY + 100, pause=0)
+        self.assertEqual(dropped, 1)
+        self.assertEqual(sorted(os.listdir(self.basedir)),
+                         ["usage.1970-01-03.sqlite", "usage.1970-01-04.sqlite",
+                          "usage.sqlite"])
+        self.assertEqual([p[0] for p in self.pdb.partitions()], [2*DAY, 3*DAY])
+        self.assertEqual(
+            self.pdb.index.execute("SELECT `day`, `connections`, `total_bytes`"
+                                   " FROM `usage_rollups`").fetchall(),
+            [dict(day=1*DAY, connections=2, total_bytes=30)])
+        # the partition spanning the cutoff was pruned row by row
+        self.assertEqual(list(self.pdb.execute("SELECT `started` FROM `usage`")),
+                         [{"started": 2*DAY + 50000}, {"started": 3*DAY}])
+
+        # ... and its rollups move into the index when it is dropped too
+        retention.prune_partitions(self.pdb, 3*DAY, pause=0)
+        self.assertEqual(
+            self.pdb.index.execute("SELECT `day`, `connections`, `total_bytes`"
+                                   " FROM `usage_rollups` ORDER BY `day`").fetchall(),
+            [dict(day=1*DAY, connections=2, total_bytes=30),
+             dict(day=2*DAY, connections=2, total_bytes=70)])
+        self.assertEqual(list(self.pdb.execute("SELECT `started` FROM `usage`")),
+                         [{"started": 3*DAY}])
+
+    def test_keep_current(self):
+        # records for the current period and the one before are still
+        # being written, so those partitions are only pruned row by row
+        dropped = retention.prune_partitions(self.pdb, 4*DAY, pause=0, now=3*DAY + 10)
+        self.assertEqual(dropped, 1)
+        self.assertEqual([p[0] for p in self.pdb.partitions()], [2*DAY, 3*DAY])
+        self.assertEqual(list(self.pdb.execute("SELECT `started` FROM `usage`")), [])
+
+        # a late record for the previous period is kept, in its partition
+        db = self.pdb.partition_for(2*DAY + 60000)
+        _insert(db, 2*DAY + 60000, 60, HAPPY)
+        db.commit()
+        self.assertEqual([p[0] for p in self.pdb.partitions()], [2*DAY, 3*DAY])
+        self.assertEqual(list(self.pdb.execute("SELECT `started` FROM `usage`")),
+                         [{"started": 2*DAY + 60000}])
+
+    def test_recorder(self):
+        # the recorder's writer has a partition open (for a late record):
+        # it isn't dropped until the recorder has closed it
+        # (setUp left this one open)
+        self.pdb.close_partition(2*DAY)
+        recorder = usage.PartitionedDatabaseUsageRecorder(self.pdb)
+        self.addCleanup(recorder.close_writer)
+        recorder.write_batch([{"started": 1*DAY + 7, "total_bytes": 5, "mood": "happy"}])
+        pruner_pdb = database.PartitionedDB(self.dbfile, "day",
+                                            database.open_existing_db(self.dbfile))
+        self.addCleanup(pruner_pdb.close)
+        dropped = retention.prune_partitions(pruner_pdb, 3*DAY, pause=0,
+                                             now=10*DAY, recorder=recorder)
+        self.assertEqual(dropped, 1)
+        self.assertEqual([p[0] for p in self.pdb.partitions()], [1*DAY, 3*DAY])
+
+        # another late record goes into the same partition (rather than
+        # being lost, or making a new one) ..
+        recorder.write_batch([{"started": 1*DAY + 8, "total_bytes": 5, "mood": "happy"}])
+        self.assertEqual(sorted(r["started"] for r in self.pdb.execute(
+            "SELECT `started` FROM `usage` WHERE `started` < ?", (2*DAY,))),
+                         [1*DAY + 5, 1*DAY + 6, 1*DAY + 7, 1*DAY + 8])
+        # .. which the recorder then closed, so now it is dropped, with
+        # every record in the rollups
+        dropped = retention.prune_partitions(pruner_pdb, 3*DAY, pause=0,
+                                             now=10*DAY, recorder=recorder)
+        self.assertEqual(dropped, 1)
+        self.assertEqual([p[0] for p in self.pdb.partitions()], [3*DAY])
+        self.assertEqual(
+            self.pdb.index.execute("SELECT `day`, `connections`, `total_bytes`"
+                                   " FROM `usage_rollups` ORDER BY `day`").fetchall(),
+            [dict(day=1*DAY, connections=4, total_bytes=40),
+             dict(day=2*DAY, connections=2, total_bytes=70)])
+
+    @inlineCallbacks
+    def test_pruner(self):
+        pruner = retention.UsagePruner(reactor, self.dbfile, DAY,
+                                       lambda: 4*DAY, partition="day")
+        dropped = yield pruner.prune()
+        self.assertEqual(dropped, 2)
+        self.assertEqual(sorted(os.listdir(self.basedir)),
+                         ["usage.1970-01-04.sqlite", "usage.sqlite"])
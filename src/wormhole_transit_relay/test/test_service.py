@@ -1,8 +1,27 @@
+import os
+import signal
 from twisted.trial import unittest
 from unittest import mock
 from twisted.application.service import MultiService
+from twisted.application.internet import TimerService
+from twisted.internet import reactor
 from autobahn.twisted.websocket import WebSocketServerFactory
 from .. import server_tap
+from ..database import PartitionedDB
+from ..statsd import StatsdUsageRecorder
+from ..usage import PartitionedDatabaseUsageRecorder
+from ..offload import Offloader
+from ..uring import UringPump
+from ..fastpath import RelayReader, VectoredWriter
+from ..timers import TimerWheel
+from ..limits import ConnectionLimiter
+from ..fdpressure import FdMonitor
+from ..lag import LagMonitor
+from ..profiling import ProfilerService
+from ..tracing import TraceService
+from ..requestlog import RequestLogger, JSONLinesSink
+from ..usagehelper import UsageHelper
+from ..shmstats import StatsSegmentReporter, read_stats
 
 class Service(unittest.TestCase):
     def test_defaults(self):
@@ -12,7 +31,8 @@ class Service(unittest.TestCase):
             s = server_tap.makeService(o)
         self.assertEqual(t.mock_calls,
                          [mock.call(blur_usage=None,
-                                    log_file=None, usage_db=None)])
+                                    log_file=None, usage_db=None,
+                                    sampler=None, reactor=reactor)])
         self.assertIsInstance(s, MultiService)
 
     def test_blur(self):
@@ -22,7 +42,8 @@ class Service(unittest.TestCase):
             server_tap.makeService(o)
         self.assertEqual(t.mock_calls,
                          [mock.call(blur_usage=60,
-                                    log_file=None, usage_db=None)])
+                                    log_file=None, usage_db=None,
+                                    sampler=None, reactor=reactor)])
 
     def test_log_fd(self):
         o = server_tap.Options()
@@ -35,7 +56,55 @@ class Service(unittest.TestCase):
         self.assertEqual(f.mock_calls, [mock.call(99, "w")])
         self.assertEqual(t.mock_calls,
                          [mock.call(blur_usage=None,
-                                    log_file=fd, usage_db=None)])
+                                    log_file=fd, usage_db=None,
+                                    sampler=None, reactor=reactor)])
+
+    def test_request_log(self):
+        o = server_tap.Options()
+        o.parseOptions(["--request-log-fd=99", "--request-log-sample=0.5",
+                        "--websocket=tcp:4002:interface=127.0.0.1",
+                        "--websocket-url=ws://example.com/"])
+        fd = object()
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            with mock.patch("wormhole_transit_relay.server_tap.os.fdopen",
+                            return_value=fd) as f:
+                services = server_tap.makeService(o)
+        self.assertEqual(f.mock_calls, [mock.call(99, "w")])
+        [sink] = [s for s in services if isinstance(s, JSONLinesSink)]
+        self.assertIs(sink._file, fd)
+        tcp_factory = services.services[0].factory
+        ws_factory = services.services[1].factory
+        self.assertIsInstance(tcp_factory.log_requests, RequestLogger)
+        self.assertIs(ws_factory.log_requests, tcp_factory.log_requests)
+        self.assertEqual(tcp_factory.log_requests._every, 2)
+
+    def test_no_request_log(self):
+        o = server_tap.Options()
+        o.parseOptions([])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        self.assertIs(services.services[0].factory.log_requests, None)
+
+    def test_usage_helper(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        dbfile = os.path.join(directory, "usage.sqlite")
+        o = server_tap.Options()
+        o.parseOptions(["--usage-helper", "--usage-db", dbfile, "--log-fd=99"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker") as t:
+            with mock.patch("wormhole_transit_relay.server_tap.os.fdopen") as f:
+                services = server_tap.makeService(o)
+        # the relay opens neither: the helper does
+        self.assertEqual(f.mock_calls, [])
+        self.assertEqual(t.mock_calls[0],
+                         mock.call(blur_usage=None, log_file=None, usage_db=None,
+                                   sampler=None, reactor=reactor))
+        [helper] = [s for s in services if isinstance(s, UsageHelper)]
+        self.assertEqual(helper._args, ["--usage-db", dbfile, "--log-fd", "99"])
+        self.assertEqual(helper._child_fds, (99,))
+        self.assertIn(mock.call().add_backend(helper), t.mock_calls)
+        # (but it was created, as usual)
+        self.assertTrue(os.path.exists(dbfile))
 
     def test_websocket(self):
         """
@@ -68,3 +137,254 @@ class Service(unittest.TestCase):
                 for s in services.services
             )
         )
+
+    def test_usage_retention(self):
+        """
+        --usage-retention adds a periodic pruning service
+        """
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        o = server_tap.Options()
+        o.parseOptions([
+            "--usage-db={}".format(os.path.join(basedir, "usage.sqlite")),
+            "--usage-retention=30",
+        ])
+        services = server_tap.makeService(o)
+        timers = [s for s in services.services if isinstance(s, TimerService)]
+        self.assertEqual(len(timers), 2)
+        self.assertEqual(timers[1].step, 60*60.0)
+
+    def test_usage_retention_partitioned(self):
+        """
+        the pruner knows which partitions the recorder has open
+        """
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        o = server_tap.Options()
+        o.parseOptions([
+            "--usage-db={}".format(os.path.join(basedir, "usage.sqlite")),
+            "--usage-db-partition=day",
+            "--usage-retention=30",
+        ])
+        services = server_tap.makeService(o)
+        timers = [s for s in services.services if isinstance(s, TimerService)]
+        pruner = timers[1].call[0].__self__
+        transit = services.services[0].factory.transit
+        self.assertIs(pruner._recorder,
+                      transit.usage.get_backend(PartitionedDatabaseUsageRecorder))
+        self.assertIsNot(pruner._recorder, None)
+
+    def test_stats_history_downsample(self):
+        """
+        --stats-history-downsample alone also adds the pruning service
+        """
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        o = server_tap.Options()
+        o.parseOptions([
+            "--usage-db={}".format(os.path.join(basedir, "usage.sqlite")),
+            "--stats-history-downsample=7",
+        ])
+        services = server_tap.makeService(o)
+        timers = [s for s in services.services if isinstance(s, TimerService)]
+        self.assertEqual(len(timers), 2)
+        self.assertEqual(timers[1].step, 60*60.0)
+
+    def test_usage_db_partition(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        o = server_tap.Options()
+        o.parseOptions([
+            "--usage-db={}".format(os.path.join(basedir, "usage.sqlite")),
+            "--usage-db-partition=month",
+        ])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker") as t:
+            server_tap.makeService(o)
+        self.assertIsInstance(t.mock_calls[0].kwargs["usage_db"], PartitionedDB)
+
+    def test_usage_sample(self):
+        o = server_tap.Options()
+        o.parseOptions(["--usage-sample=10", "--usage-sample-moods=errory:1"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker") as t:
+            server_tap.makeService(o)
+        sampler = t.mock_calls[0].kwargs["sampler"]
+        self.assertEqual(sampler.weight("happy"), 10)
+        self.assertEqual(sampler.weight("happy"), 0)
+        self.assertEqual(sampler.weight("errory"), 1)
+
+    def test_relay_read_size(self):
+        o = server_tap.Options()
+        o.parseOptions(["--relay-read-size=1048576"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        reader = services.services[0].factory.transit.relay_reader
+        self.assertIsInstance(reader, RelayReader)
+        self.assertEqual(reader.read_size, 1048576)
+        self.assertIs(services.services[0].factory.transit.relay_writer, None)
+
+    def test_relay_writev(self):
+        o = server_tap.Options()
+        o.parseOptions(["--relay-writev"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        writer = services.services[0].factory.transit.relay_writer
+        self.assertIsInstance(writer, VectoredWriter)
+
+    def test_idle_timeout(self):
+        o = server_tap.Options()
+        o.parseOptions(["--idle-timeout=600"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        transit = services.services[0].factory.transit
+        self.assertIsInstance(transit.timers, TimerWheel)
+        self.assertEqual(transit.idle_timeout, 600.0)
+        self.assertEqual(transit.handshake_timeout, 60.0)
+
+    def test_no_handshake_timeout(self):
+        o = server_tap.Options()
+        o.parseOptions(["--handshake-timeout=0"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        self.assertIs(services.services[0].factory.transit.handshake_timeout, None)
+
+    def test_profile(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        o = server_tap.Options()
+        o.parseOptions(["--profile-dir", directory, "--profile-seconds=5"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        [service] = [s for s in services if isinstance(s, ProfilerService)]
+        self.assertEqual((service.profiler.mode, service.profiler.seconds), ("sample", 5.0))
+        self.assertEqual(service._signum, signal.SIGUSR1)
+
+        o = server_tap.Options()
+        o.parseOptions(["--profile-dir", directory, "--profile-signal=WINCH"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        [service] = [s for s in services if isinstance(s, ProfilerService)]
+        self.assertEqual(service._signum, signal.SIGWINCH)
+
+    def test_trace(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        o = server_tap.Options()
+        o.parseOptions(["--trace-dir", directory, "--trace-sample=0.1"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        [service] = [s for s in services if isinstance(s, TraceService)]
+        self.assertIs(service.trace, services.services[0].factory.transit.trace)
+        self.assertEqual(service.trace._every, 10)
+
+    def test_lag(self):
+        o = server_tap.Options()
+        o.parseOptions(["--shed-lag=250"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        monitor = services.services[0].factory.transit.lag_monitor
+        self.assertIsInstance(monitor, LagMonitor)
+        self.assertIn(monitor, list(services))
+        self.assertEqual((monitor.interval, monitor.threshold), (0.1, 0.25))
+
+    def test_no_lag(self):
+        o = server_tap.Options()
+        o.parseOptions(["--lag-interval=0"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        self.assertIs(services.services[0].factory.transit.lag_monitor, None)
+
+    def test_fd_high_water(self):
+        o = server_tap.Options()
+        o.parseOptions(["--fd-high-water=50"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"), \
+             mock.patch("wormhole_transit_relay.server_tap.fd_limit", return_value=1000):
+            services = server_tap.makeService(o)
+        monitor = services.services[0].factory.transit.fd_monitor
+        self.assertIsInstance(monitor, FdMonitor)
+        self.assertEqual((monitor.limit, monitor._high, monitor._low), (1000, 500, 400))
+
+    def test_no_fd_high_water(self):
+        o = server_tap.Options()
+        o.parseOptions(["--fd-high-water=0"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        self.assertIs(services.services[0].factory.transit.fd_monitor, None)
+
+    def test_connection_limits(self):
+        o = server_tap.Options()
+        o.parseOptions(["--max-connections-per-ip=50", "--limit-exempt=10.0.0.0/8"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        limiter = services.services[0].factory.transit.limiter
+        self.assertIsInstance(limiter, ConnectionLimiter)
+        self.assertEqual(limiter.limit, 50)
+        self.assertIs(limiter.key_for("10.1.2.3"), None)
+
+    def test_socket_options(self):
+        o = server_tap.Options()
+        o.parseOptions(["--websocket=tcp:4004", "--keepalive-idle=60", "--tcp-nodelay"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        tcp, ws = services.services[0].factory, services.services[1].factory
+        self.assertIs(tcp.socket_options, ws.socket_options)
+        self.assertEqual(tcp.socket_options.keepalive_idle, 60)
+        self.assertTrue(tcp.socket_options.nodelay)
+
+    def test_statsd(self):
+        o = server_tap.Options()
+        o.parseOptions(["--statsd=127.0.0.1:8125", "--statsd-interval=30"])
+        tracker = mock.Mock()
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker",
+                        return_value=tracker):
+            services = server_tap.makeService(o)
+        statsd = services.services[-1]
+        self.assertIsInstance(statsd, MultiService)
+        timers = [s for s in statsd.services if isinstance(s, TimerService)]
+        self.assertEqual([t.step for t in timers], [30.0])
+        backend = tracker.add_backend.mock_calls[0].args[0]
+        self.assertIsInstance(backend, StatsdUsageRecorder)
+
+    def test_stats_shm(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        path = os.path.join(basedir, "stats")
+        o = server_tap.Options()
+        o.parseOptions(["--stats-shm={}".format(path), "--stats-shm-interval=0.5"])
+        tracker = mock.Mock()
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker",
+                        return_value=tracker):
+            services = server_tap.makeService(o)
+        timer = services.services[-1]
+        self.assertIsInstance(timer, TimerService)
+        self.assertEqual(timer.step, 0.5)
+        backend = tracker.add_backend.mock_calls[-1].args[0]
+        self.assertIsInstance(backend, StatsSegmentReporter)
+        # the file exists (with zeros) before the first report
+        self.assertEqual(read_stats(path)["connected"], 0)
+
+    def test_offload(self):
+        o = server_tap.Options()
+        o.parseOptions(["--offload-threads=2"])
+        with mock.patch("wormhole_transit_relay.server_tap.create_usage_tracker"):
+            services = server_tap.makeService(o)
+        offloaders = [s for s in services.services if isinstance(s, Offloader)]
+        self.assertEqual(len(offloaders), 1)
+        self.assertIs(services.services[1].factory.transit.offloader, offloaders[0])
+
+    def test_relay_backend_io_uring(self):
+        o = server_tap.Options()
+        o.parseOptions(["--relay-backend=io_uring"])
+        with mock.patch("wormhole_transit_relay.server_tap.uring.available",
+                        return_value=True):
+            services = server_tap.makeService(o)
+        offloader = services.services[1].factory.transit.offloader
+        self.assertIsInstance(offloader, Offloader)
+        self.assertIs(offloader._pump, UringPump)
+
+    def test_relay_backend_io_uring_unavailable(self):
+        o = server_tap.Options()
+        o.parseOptions(["--relay-backend=io_uring"])
+        with mock.patch("wormhole_transit_relay.server_tap.uring.available",
+                        return_value=False):
+            services = server_tap.makeService(o)
+        self.assertIs(services.services[0].factory.transit.offloader, None)
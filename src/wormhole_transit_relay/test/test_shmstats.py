@@ -0,0 +1,89 @@
+import os
+from twisted.trial import unittest
+from ..transit_server import Transit
+from ..usage import create_usage_tracker
+from ..lag import LagMonitor
+from .. import shmstats
+from ..shmstats import (
+    StatsSegment,
+    StatsSegmentReporter,
+    StatsSegmentError,
+    read_stats,
+)
+
+
+class Segment(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        self.path = os.path.join(basedir, "stats")
+
+    def test_publish(self):
+        segment = StatsSegment(self.path, ("a", "b", "c"))
+        self.addCleanup(segment.close)
+        self.assertEqual(read_stats(self.path), dict(a=0, b=0, c=0))
+        segment.publish(dict(a=1, c=2**40, other=5))
+        self.assertEqual(read_stats(self.path), dict(a=1, b=0, c=2**40))
+        segment.publish(dict(b=3.7))
+        self.assertEqual(read_stats(self.path), dict(a=0, b=3, c=0))
+
+    def test_default_slots(self):
+        segment = StatsSegment(self.path)
+        self.addCleanup(segment.close)
+        stats = read_stats(self.path)
+        self.assertEqual(list(stats), list(shmstats.SLOTS))
+        self.assertIn("connections.happy", stats)
+
+    def test_replaced(self):
+        # a relay restarting doesn't disturb a reader of the old file
+        old = StatsSegment(self.path, ("a",))
+        self.addCleanup(old.close)
+        old.publish(dict(a=1))
+        with open(self.path, "rb") as f:
+            new = StatsSegment(self.path, ("a", "b"))
+            self.addCleanup(new.close)
+            new.publish(dict(a=2))
+            self.assertEqual(len(f.read()), 8 * 4 + 2)
+        self.assertEqual(read_stats(self.path), dict(a=2, b=0))
+
+    def test_mid_update(self):
+        segment = StatsSegment(self.path, ("a",))
+        self.addCleanup(segment.close)
+        # as though the relay stopped half-way through an update
+        shmstats._SEQUENCE.pack_into(segment._map, shmstats._SEQUENCE_OFFSET, 3)
+        with self.assertRaises(StatsSegmentError):
+            read_stats(self.path, retries=2)
+
+    def test_not_stats(self):
+        with open(self.path, "wb") as f:
+            f.write(b"something else entirely")
+        with self.assertRaises(StatsSegmentError):
+            read_stats(self.path)
+
+
+class Reporter(unittest.TestCase):
+    def test_report(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        path = os.path.join(basedir, "stats")
+        transit = Transit(
+            create_usage_tracker(blur_usage=None, log_file=None, usage_db=None),
+            lambda: 0,
+        )
+        transit.lag_monitor = LagMonitor(None)
+        transit.lag_monitor.record(0.002)
+        segment = StatsSegment(path)
+        self.addCleanup(segment.close)
+        reporter = StatsSegmentReporter(segment, transit, lambda: 1000.5)
+        reporter.record_usage(started=1, total_bytes=100, mood="happy", weight=2)
+        reporter.record_usage(started=1, total_bytes=0, mood="lonely")
+        reporter.report()
+
+        stats = read_stats(path)
+        self.assertEqual(stats["updated"], 1000)
+        self.assertEqual(stats["connections.happy"], 2)
+        self.assertEqual(stats["connections.lonely"], 1)
+        self.assertEqual(stats["bytes"], 200)
+        self.assertEqual(stats["waiting"], 0)
+        self.assertEqual(stats["reactor_lag.le_2ms"], 1)
+        self.assertEqual(stats["reactor_lag_us"], 500)
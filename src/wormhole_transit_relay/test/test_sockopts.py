@@ -0,0 +1,110 @@
+import socket
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.protocol import ClientFactory, Protocol, ServerFactory
+from ..transit_server import Transit, TransitConnection
+from ..usage import UsageTracker
+from ..sockopts import SocketOptions
+from .. import sockopts
+from .test_offload import _wait_for
+
+
+class FakeTransport(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.keepalive = False
+        self.nodelay = False
+
+    def setTcpKeepAlive(self, enabled):
+        self.keepalive = enabled
+
+    def setTcpNoDelay(self, enabled):
+        self.nodelay = enabled
+
+    def getHandle(self):
+        return self.sock
+
+
+class Apply(unittest.TestCase):
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(self.sock.close)
+        self.transport = FakeTransport(self.sock)
+
+    def test_defaults(self):
+        before = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        SocketOptions().apply(self.transport)
+        self.assertTrue(self.transport.keepalive)
+        self.assertFalse(self.transport.nodelay)
+        self.assertEqual(self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), before)
+
+    def test_options(self):
+        options = SocketOptions(
+            nodelay=True,
+            rcvbuf=65536,
+            keepalive_idle=60,
+            keepalive_interval=10,
+            keepalive_count=3,
+        )
+        options.apply(self.transport)
+        self.assertTrue(self.transport.nodelay)
+        # Linux doubles the buffer size it was asked for, others don't
+        self.assertIn(self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                      (65536, 2 * 65536))
+        self.assertEqual(self.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 60)
+        self.assertEqual(self.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL), 10)
+        self.assertEqual(self.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT), 3)
+
+    if not hasattr(socket, "TCP_KEEPIDLE"):
+        test_options.skip = "no TCP_KEEPIDLE here"
+
+    def test_unsupported(self):
+        self.patch(sockopts, "_SOCKET_OPTIONS",
+                   [("sndbuf", socket.SOL_SOCKET, "SO_NOT_A_REAL_OPTION")])
+        self.patch(sockopts, "_unsupported", set())
+        messages = []
+        self.patch(sockopts.log, "msg", messages.append)
+        SocketOptions(sndbuf=1000).apply(self.transport)
+        SocketOptions(sndbuf=1000).apply(self.transport)
+        self.assertEqual(messages, ["SO_NOT_A_REAL_OPTION is not supported here, ignoring it"])
+
+    def test_error(self):
+        messages = []
+        self.patch(sockopts.log, "msg", messages.append)
+        self.sock.close()
+        SocketOptions(sndbuf=1000).apply(self.transport)
+        self.assertEqual(len(messages), 1)
+        self.assertIn("unable to set SO_SNDBUF=1000", messages[0])
+
+
+class Listener(unittest.TestCase):
+    @inlineCallbacks
+    def test_accepted_connections(self):
+        factory = ServerFactory()
+        factory.protocol = TransitConnection
+        factory.transit = Transit(UsageTracker(blur_usage=None), reactor.seconds)
+        factory.log_requests = False
+        factory.socket_options = SocketOptions(nodelay=True, keepalive_count=4)
+        servers = []
+        real_build = factory.buildProtocol
+        def buildProtocol(addr):
+            p = real_build(addr)
+            servers.append(p)
+            return p
+        factory.buildProtocol = buildProtocol
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        client = ClientFactory()
+        client.protocol = Protocol
+        connector = reactor.connectTCP("127.0.0.1", port.getHost().port, client)
+        yield _wait_for(lambda: servers and servers[0].transport.connected)
+        server = servers[0]
+        sock = server.transport.getHandle()
+        self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+        self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT), 4)
+        connector.disconnect()
+        yield _wait_for(lambda: not server.transport.connected)
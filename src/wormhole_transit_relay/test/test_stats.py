@@ -1,9 +1,25 @@
-import os, io, json
+import os, io, json, sqlite3
+from collections import deque
 from unittest import mock
 from twisted.trial import unittest
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 from ..transit_server import Transit
-from ..usage import create_usage_tracker
-from .. import database
+from ..usage import (
+    create_usage_tracker,
+    UsageTracker,
+    UsageSampler,
+    MemoryUsageRecorder,
+    LogFileUsageRecorder,
+    DatabaseUsageRecorder,
+    PartitionedDatabaseUsageRecorder,
+    BackendQueue,
+    UsageFlushService,
+)
+from .. import database, usage
+
+HAPPY = database.mood_code("happy")
+ERRORY = database.mood_code("errory")
 
 class DB(unittest.TestCase):
 
@@ -34,8 +50,9 @@ class DB(unittest.TestCase):
         t.update_stats()
 
         self.assertEqual(db.execute("SELECT * FROM `usage`").fetchall(),
-                         [dict(result="happy", started=123,
-                               total_bytes=100, total_time=10, waiting_time=2),
+                         [dict(mood=HAPPY, started=123, total_bytes=100,
+                               total_time_ms=10000, waiting_time_ms=2000,
+                               weight=1),
                           ])
         self.assertEqual(db.execute("SELECT * FROM `current`").fetchone(),
                          dict(rebooted=T+0, updated=T+1,
@@ -47,10 +64,12 @@ class DB(unittest.TestCase):
                            total_time=11, waiting_time=3)
         t.update_stats()
         self.assertEqual(db.execute("SELECT * FROM `usage`").fetchall(),
-                         [dict(result="happy", started=123,
-                               total_bytes=100, total_time=10, waiting_time=2),
-                          dict(result="errory", started=150,
-                               total_bytes=200, total_time=11, waiting_time=3),
+                         [dict(mood=HAPPY, started=123, total_bytes=100,
+                               total_time_ms=10000, waiting_time_ms=2000,
+                               weight=1),
+                          dict(mood=ERRORY, started=150, total_bytes=200,
+                               total_time_ms=11000, waiting_time_ms=3000,
+                               weight=1),
                           ])
         self.assertEqual(db.execute("SELECT * FROM `current`").fetchone(),
                          dict(rebooted=T+0, updated=T+2,
@@ -63,6 +82,26 @@ class DB(unittest.TestCase):
                          dict(rebooted=T+0, updated=T+3,
                               incomplete_bytes=0,
                               waiting=0, connected=0))
+        # .. and each of those was kept
+        self.assertEqual(
+            database.stats_history(db, T, T + 4),
+            [dict(updated=int(T) + i, connected=0, waiting=0, incomplete_bytes=0)
+             for i in (1, 2, 3)])
+
+    def test_stats_failed(self):
+        # the TimerService calling update_stats() would stop for good if
+        # an error got out
+        db = database.get_db(":memory:")
+        self.addCleanup(db.close)
+        t = Transit(
+            create_usage_tracker(blur_usage=None, log_file=None, usage_db=db),
+            lambda: 0,
+        )
+        [usage] = t.usage._backends
+        self.patch(usage, "_write_stats", mock.Mock(
+            side_effect=sqlite3.OperationalError("database is locked")))
+        t.update_stats()
+        self.assertEqual(len(self.flushLoggedErrors(sqlite3.OperationalError)), 1)
 
     def test_no_db(self):
         t = Transit(
@@ -128,3 +167,377 @@ class LogToStdout(unittest.TestCase):
             bytes_sent=11999,
             buddy_bytes=12,
         )
+
+
+class PartitionedDB(unittest.TestCase):
+
+    def test_record(self):
+        d = self.mktemp()
+        os.mkdir(d)
+        pdb = database.get_partitioned_db(os.path.join(d, "usage.sqlite"), "day")
+        t = Transit(
+            create_usage_tracker(blur_usage=None, log_file=None, usage_db=pdb),
+            lambda: 86400*3 + 5,
+        )
+        usage = list(t.usage._backends)[0]
+        usage.record_usage(started=86400*2 + 123, mood="happy", total_bytes=100,
+                           total_time=10, waiting_time=2)
+        usage.record_usage(started=86400*3 + 1, mood="errory", total_bytes=0,
+                           total_time=1, waiting_time=None)
+        t.update_stats()
+
+        self.assertEqual(len(pdb.partitions()), 2)
+        self.assertEqual(
+            list(pdb.execute("SELECT `started`, `mood` FROM `usage`")),
+            [dict(started=86400*2 + 123, mood=HAPPY),
+             dict(started=86400*3 + 1, mood=ERRORY)])
+        # nothing in the index database except `current`
+        self.assertEqual(pdb.index.execute("SELECT * FROM `usage`").fetchall(), [])
+        self.assertEqual(pdb.index.execute("SELECT `updated` FROM `current`").fetchone(),
+                         dict(updated=86400*3 + 5))
+        pdb.close()
+
+
+class Sampling(unittest.TestCase):
+
+    def test_sampler(self):
+        s = UsageSampler(3, {"errory": 1, "lonely": 2})
+        self.assertEqual([s.weight("happy") for _ in range(7)],
+                         [3, 0, 0, 3, 0, 0, 3])
+        self.assertEqual([s.weight("errory") for _ in range(3)], [1, 1, 1])
+        self.assertEqual([s.weight("lonely") for _ in range(4)], [2, 0, 2, 0])
+        # moods are counted separately
+        self.assertEqual(s.weight("redundant"), 3)
+
+    def _record(self, tracker, n, result, bytes_sent):
+        with mock.patch("time.time", return_value=200):
+            for _ in range(n):
+                tracker.record(started=100, buddy_started=None, result=result,
+                               bytes_sent=bytes_sent, buddy_bytes=None)
+
+    def test_sampled_records(self):
+        tracker = create_usage_tracker(blur_usage=None, log_file=None,
+                                       usage_db=None, sampler=UsageSampler(4))
+        memory = MemoryUsageRecorder()
+        tracker.add_backend(memory)
+        self._record(tracker, 10, "happy", 5)
+        self._record(tracker, 1, "errory", 0)
+        self.assertEqual([(e["mood"], e["weight"]) for e in memory.events],
+                         [("happy", 4), ("happy", 4), ("happy", 4),
+                          ("errory", 4)])
+        # totals are exact regardless
+        self.assertEqual(tracker.get_totals(),
+                         {"happy": (10, 50), "errory": (1, 0)})
+
+    def test_log_weight(self):
+        log_file = io.StringIO()
+        tracker = create_usage_tracker(blur_usage=None, log_file=log_file,
+                                       usage_db=None, sampler=UsageSampler(2))
+        self._record(tracker, 2, "happy", 5)
+        self.assertEqual(json.loads(log_file.getvalue()),
+                         {"started": 100, "total_time": 100,
+                          "waiting_time": None, "total_bytes": 5,
+                          "mood": "happy", "weight": 2})
+
+    def test_totals_flushed(self):
+        db = database.get_db(":memory:")
+        tracker = create_usage_tracker(blur_usage=None, log_file=None,
+                                       usage_db=db, sampler=UsageSampler(100))
+        self._record(tracker, 150, "happy", 1000)
+        self._record(tracker, 3, "lonely", 0)
+        tracker.update_stats(rebooted=0, updated=300, connected=0,
+                             waiting=0, incomplete_bytes=0)
+        self.assertEqual(
+            db.execute("SELECT `mood`, `weight` FROM `usage`").fetchall(),
+            [dict(mood=HAPPY, weight=100), dict(mood=HAPPY, weight=100),
+             dict(mood=database.mood_code("lonely"), weight=100)])
+        self.assertEqual(
+            db.execute("SELECT * FROM `usage_totals` ORDER BY `mood`").fetchall(),
+            [dict(updated=300, mood=HAPPY, connections=150, total_bytes=150000),
+             dict(updated=300, mood=database.mood_code("lonely"),
+                  connections=3, total_bytes=0)])
+        self.assertEqual(tracker.get_totals(), {})
+
+        self._record(tracker, 1, "happy", 1)
+        tracker.update_stats(rebooted=0, updated=600, connected=0,
+                             waiting=0, incomplete_bytes=0)
+        self.assertEqual(
+            db.execute("SELECT * FROM `usage_totals` WHERE `updated`=600").fetchall(),
+            [dict(updated=600, mood=HAPPY, connections=1, total_bytes=1)])
+
+
+class FailingUsageRecorder(object):
+    def record_usage(self, **kwargs):
+        raise ValueError("oops")
+
+
+class Queued(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.tracker = create_usage_tracker(blur_usage=None, log_file=None,
+                                            usage_db=None, reactor=self.clock)
+
+    def _record(self, n, result="happy"):
+        for i in range(n):
+            self.tracker.record(started=100 + i, buddy_started=None, result=result,
+                                bytes_sent=0, buddy_bytes=None)
+
+    def test_later(self):
+        memory = MemoryUsageRecorder()
+        self.tracker.add_backend(memory)
+        self._record(1)
+        # nothing happens while the connection is torn down
+        self.assertEqual(memory.events, [])
+        self.clock.advance(0)
+        self.assertEqual([e["started"] for e in memory.events], [100])
+
+    def test_batches(self):
+        self.patch(BackendQueue, "BATCH", 2)
+        memory = MemoryUsageRecorder()
+        self.tracker.add_backend(memory)
+        self._record(5)
+        # one turn of the reactor at a time (Clock.advance would run the
+        # calls scheduled for "now" by the calls it runs, too)
+        for expected in (2, 4, 5):
+            [call] = self.clock.getDelayedCalls()
+            self.clock.calls.remove(call)
+            call.func()
+            self.assertEqual(len(memory.events), expected)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_isolated(self):
+        self.tracker.add_backend(FailingUsageRecorder())
+        memory = MemoryUsageRecorder()
+        self.tracker.add_backend(memory)
+        self._record(2)
+        self.clock.advance(0)
+        self.assertEqual(len(memory.events), 2)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 2)
+        self.assertEqual(self.tracker.get_counters(),
+                         {"usage_dropped": 0, "usage_failed": 2})
+
+    def test_drop_oldest(self):
+        memory = MemoryUsageRecorder()
+        self.tracker.add_backend(memory)
+        [queue] = self.tracker._queues
+        queue._queue = deque(maxlen=3)
+        self._record(5)
+        self.clock.advance(0)
+        self.assertEqual([e["started"] for e in memory.events], [102, 103, 104])
+        self.assertEqual(self.tracker.get_counters()["usage_dropped"], 2)
+
+    def test_flush(self):
+        memory = MemoryUsageRecorder()
+        self.tracker.add_backend(memory)
+        service = UsageFlushService(self.tracker)
+        service.startService()
+        self._record(3)
+        service.stopService()
+        self.assertEqual(len(memory.events), 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_time_slice(self):
+        # a slow backend gets one record per turn, however many are waiting
+        self.patch(BackendQueue, "TIME_SLICE", 0)
+        memory = MemoryUsageRecorder()
+        self.tracker.add_backend(memory)
+        self._record(3)
+        for expected in (1, 2, 3):
+            [call] = self.clock.getDelayedCalls()
+            self.clock.calls.remove(call)
+            call.func()
+            self.assertEqual(len(memory.events), expected)
+
+
+class Threaded(unittest.TestCase):
+    """
+    Blocking backends are given their records in a thread.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.writes = [] # (Deferred, f, args), in place of the thread pool
+
+        def in_thread(f, *args):
+            d = Deferred()
+            self.writes.append((d, f, args))
+            return d
+        self.tracker = UsageTracker(blur_usage=None, reactor=self.clock,
+                                    in_thread=in_thread)
+
+    def _record(self, n, started=100):
+        for i in range(n):
+            self.tracker.record(started=started + i, buddy_started=None,
+                                result="happy", bytes_sent=0, buddy_bytes=None)
+
+    def _finish_write(self):
+        d, f, args = self.writes.pop(0)
+        try:
+            result = f(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+    def test_batches(self):
+        log_file = io.StringIO()
+        self.tracker.add_backend(LogFileUsageRecorder(log_file))
+        self._record(3)
+        self.assertEqual(self.writes, [])
+        self.clock.advance(0)
+        self.assertEqual(len(self.writes), 1)
+        # the next batch waits for this one
+        self._record(2, started=200)
+        self.clock.advance(0)
+        self.assertEqual(len(self.writes), 1)
+        self._finish_write()
+        self.assertEqual(log_file.getvalue().count("\n"), 3)
+        self.clock.advance(0)
+        self._finish_write()
+        self.assertEqual([json.loads(line)["started"] for line in log_file.getvalue().splitlines()],
+                         [100, 101, 102, 200, 201])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_memory_db(self):
+        # an in-memory database can't be opened again from a thread
+        db = database.get_db(":memory:")
+        self.addCleanup(db.close)
+        self.assertFalse(DatabaseUsageRecorder(db).blocking)
+
+    def test_database(self):
+        d = self.mktemp()
+        os.mkdir(d)
+        db = database.get_db(os.path.join(d, "usage.sqlite"))
+        self.addCleanup(db.close)
+        self.tracker.add_backend(DatabaseUsageRecorder(db))
+        self._record(2)
+        # one that can't be written doesn't stop the others
+        self.tracker._notify_backends({"started": None, "mood": "happy"})
+        self.clock.advance(0)
+        # (written with a connection of its own)
+        self.assertEqual(db.execute("SELECT COUNT(*) AS n FROM `usage`").fetchone()["n"], 0)
+        self._finish_write()
+        self.assertEqual([r["started"] for r in db.execute("SELECT `started` FROM `usage`")],
+                         [100, 101])
+        self.assertEqual(len(self.flushLoggedErrors(TypeError)), 1)
+        self.assertEqual(self.tracker.get_counters()["usage_failed"], 1)
+
+    def test_reuse_connection(self):
+        # the thread opens its connection once, and closes it when flushed
+        d = self.mktemp()
+        os.mkdir(d)
+        db = database.get_db(os.path.join(d, "usage.sqlite"))
+        self.addCleanup(db.close)
+        opened = []
+        real_open = usage.open_existing_db
+
+        def open_existing_db(dbfile):
+            opened.append(real_open(dbfile))
+            return opened[-1]
+        self.patch(usage, "open_existing_db", open_existing_db)
+        self.tracker.add_backend(DatabaseUsageRecorder(db))
+        for started in (100, 200):
+            self._record(1, started=started)
+            self.clock.advance(0)
+            self._finish_write()
+        self.assertEqual(len(opened), 1)
+        self.assertEqual([r["started"] for r in db.execute("SELECT `started` FROM `usage`")],
+                         [100, 200])
+        d = self.tracker.flush()
+        # (nothing left to write, so just the close)
+        self._finish_write()
+        self.successResultOf(d)
+        self.assertEqual(self.writes, [])
+        self.assertRaises(sqlite3.ProgrammingError, opened[0].execute, "SELECT 1")
+        # a batch after that opens a new one
+        self._record(1, started=300)
+        self.clock.advance(0)
+        self._finish_write()
+        self.assertEqual(len(opened), 2)
+        self.addCleanup(opened[1].close)
+
+    def test_stats(self):
+        # the statistics are written in the thread too, with its connection
+        d = self.mktemp()
+        os.mkdir(d)
+        db = database.get_db(os.path.join(d, "usage.sqlite"))
+        self.addCleanup(db.close)
+        recorder = DatabaseUsageRecorder(db)
+        self.tracker.add_backend(recorder)
+        self.tracker.add_backend(LogFileUsageRecorder(io.StringIO()))
+        self.tracker.update_stats(rebooted=0, updated=300, connected=2,
+                                  waiting=1, incomplete_bytes=10)
+        # (only the database keeps them)
+        [(_, f, _)] = self.writes
+        self.assertEqual(f, recorder.write_stats)
+        self.assertEqual(db.execute("SELECT * FROM `current`").fetchall(), [])
+        self._finish_write()
+        self.assertEqual(db.execute("SELECT * FROM `current`").fetchall(),
+                         [dict(rebooted=0, updated=300, connected=2,
+                               waiting=1, incomplete_bytes=10)])
+
+        # an error is logged, and the next update goes ahead
+        write_stats = recorder._write_stats
+        self.patch(recorder, "_write_stats", mock.Mock(
+            side_effect=sqlite3.OperationalError("database is locked")))
+        self.tracker.update_stats(rebooted=0, updated=600, connected=0,
+                                  waiting=0, incomplete_bytes=0)
+        self._finish_write()
+        self.assertEqual(len(self.flushLoggedErrors(sqlite3.OperationalError)), 1)
+        recorder._write_stats = write_stats
+        self.tracker.update_stats(rebooted=0, updated=900, connected=0,
+                                  waiting=0, incomplete_bytes=0)
+        self._finish_write()
+        self.assertEqual([r["updated"] for r in db.execute("SELECT * FROM `stats_history`")],
+                         [300, 900])
+        d = self.tracker.flush()
+        self._finish_write()
+        self.successResultOf(d)
+
+    def test_partitioned(self):
+        d = self.mktemp()
+        os.mkdir(d)
+        pdb = database.get_partitioned_db(os.path.join(d, "usage.sqlite"), "day")
+        self.addCleanup(pdb.close)
+        recorder = PartitionedDatabaseUsageRecorder(pdb)
+        self.addCleanup(recorder.close_writer)
+        # three periods, but only two partitions are kept open at once
+        failures = recorder.write_batch([
+            {"started": 86400*day + 5, "mood": "happy"} for day in (1, 2, 3, 1)
+        ])
+        self.assertEqual(failures, [])
+        self.assertEqual(len(pdb.partitions()), 3)
+        self.assertEqual(sorted(r["started"] for r in pdb.execute("SELECT `started` FROM `usage`")),
+                         [86400 + 5, 86400 + 5, 86400*2 + 5, 86400*3 + 5])
+
+    def test_batch_failed(self):
+        d = self.mktemp()
+        os.mkdir(d)
+        dbfile = os.path.join(d, "usage.sqlite")
+        db = database.get_db(dbfile)
+        self.addCleanup(db.close)
+        self.tracker.add_backend(DatabaseUsageRecorder(db))
+        os.unlink(dbfile)
+        self._record(2)
+        self.clock.advance(0)
+        self._finish_write()
+        self.assertEqual(len(self.flushLoggedErrors(database.DBDoesntExist)), 1)
+        self.assertEqual(self.tracker.get_counters()["usage_failed"], 2)
+
+    def test_flush(self):
+        log_file = io.StringIO()
+        self.tracker.add_backend(LogFileUsageRecorder(log_file))
+        self._record(2)
+        self.clock.advance(0)
+        self._record(1, started=200)
+        # the rest is written after the batch in its thread
+        d = self.tracker.flush()
+        self.assertNoResult(d)
+        self.assertEqual(log_file.getvalue(), "")
+        self._finish_write()
+        self.assertNoResult(d)
+        self._finish_write()
+        self.successResultOf(d)
+        self.assertEqual([json.loads(line)["started"] for line in log_file.getvalue().splitlines()],
+                         [100, 101, 200])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,174 @@
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.protocol import DatagramProtocol
+from .. import statsd
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.datagrams = []
+        self.refuse = False
+        self.error = None
+
+    def write(self, datagram):
+        if self.error is not None:
+            raise self.error
+        if self.refuse:
+            return None
+        self.datagrams.append(datagram)
+        return len(datagram)
+
+
+class FakeTransit(object):
+    def get_stats(self):
+        return {"connected": 4, "waiting": 1, "incomplete_bytes": 1000}
+
+    handshake_timeouts = 0
+
+    def get_counters(self):
+        return {"handshake_timeouts": self.handshake_timeouts}
+
+
+class Client(unittest.TestCase):
+    def setUp(self):
+        self.client = statsd.StatsdClient("127.0.0.1", 8125, "relay")
+        self.transport = FakeTransport()
+        self.client.transport = self.transport
+
+    def test_parse_address(self):
+        self.assertEqual(statsd.parse_address("127.0.0.1:8125"), ("127.0.0.1", 8125))
+        self.assertEqual(statsd.parse_address("[::1]:8125"), ("::1", 8125))
+        with self.assertRaises(ValueError):
+            statsd.parse_address("8125")
+
+    def test_counters_aggregate(self):
+        for _ in range(100):
+            self.client.increment("connections.happy")
+        self.client.increment("bytes", 500)
+        self.client.gauge("connected", 3)
+        self.client.gauge("connected", 4)
+        self.client.timing("total_time", 1500)
+        self.client.flush()
+        self.assertEqual(self.transport.datagrams, [
+            b"relay.connections.happy:100|c\n"
+            b"relay.bytes:500|c\n"
+            b"relay.connected:4|g\n"
+            b"relay.total_time:1500|ms"
+        ])
+        # everything was sent, so the next flush has nothing to do
+        self.client.flush()
+        self.assertEqual(len(self.transport.datagrams), 1)
+
+    def test_batches_fit_datagrams(self):
+        for i in range(500):
+            self.client.timing("total_time", i)
+        self.client.flush()
+        self.assertGreater(len(self.transport.datagrams), 1)
+        lines = []
+        for datagram in self.transport.datagrams:
+            self.assertLessEqual(len(datagram), statsd.StatsdClient.MAX_DATAGRAM)
+            lines.extend(datagram.split(b"\n"))
+        self.assertEqual(lines, [b"relay.total_time:%d|ms" % i for i in range(500)])
+        self.assertEqual(self.client.sent, len(self.transport.datagrams))
+        self.assertEqual(self.client.dropped, 0)
+
+    def test_queue_is_bounded(self):
+        self.patch(statsd.StatsdClient, "MAX_QUEUED", 10)
+        for i in range(15):
+            self.client.timing("total_time", i)
+        self.assertEqual(self.client.dropped, 5)
+        self.client.flush()
+        self.assertEqual(len(self.transport.datagrams[0].split(b"\n")), 10)
+
+    def test_refused_is_dropped(self):
+        self.transport.refuse = True
+        self.client.increment("a")
+        self.client.increment("b")
+        self.client.flush()
+        self.assertEqual(self.client.dropped, 2)
+        self.assertEqual(self.client.sent, 0)
+        # nothing is kept for later
+        self.transport.refuse = False
+        self.client.flush()
+        self.assertEqual(self.transport.datagrams, [])
+
+    def test_full_buffer_is_dropped(self):
+        self.transport.error = BlockingIOError()
+        self.client.increment("a")
+        self.client.flush()
+        self.assertEqual(self.client.dropped, 1)
+
+    def test_not_started(self):
+        self.client.transport = None
+        self.client.increment("a")
+        self.client.flush()
+        self.assertEqual(self.client.dropped, 1)
+
+    def test_usage_recorder(self):
+        recorder = statsd.StatsdUsageRecorder(self.client)
+        recorder.record_usage(started=123, total_time=2.5, waiting_time=None,
+                              total_bytes=100, mood="happy", weight=10)
+        recorder.record_usage(started=123, total_time=1, waiting_time=0.5,
+                              total_bytes=0, mood="lonely")
+        self.client.flush()
+        self.assertEqual(self.transport.datagrams[0].split(b"\n"), [
+            b"relay.connections.happy:10|c",
+            b"relay.bytes:1000|c",
+            b"relay.connections.lonely:1|c",
+            b"relay.total_time:2500|ms",
+            b"relay.total_time:1000|ms",
+            b"relay.waiting_time:500|ms",
+        ])
+
+    def test_reporter(self):
+        statsd.StatsdReporter(self.client, FakeTransit()).report()
+        self.assertEqual(self.transport.datagrams[0].split(b"\n"), [
+            b"relay.connected:4|g",
+            b"relay.waiting:1|g",
+            b"relay.incomplete_bytes:1000|g",
+            b"relay.statsd_dropped:0|g",
+        ])
+
+    def test_reporter_counters(self):
+        transit = FakeTransit()
+        reporter = statsd.StatsdReporter(self.client, transit)
+        transit.handshake_timeouts = 3
+        reporter.report()
+        transit.handshake_timeouts = 5
+        reporter.report()
+        reporter.report()
+        counted = [
+            line
+            for datagram in self.transport.datagrams
+            for line in datagram.split(b"\n")
+            if line.startswith(b"relay.handshake_timeouts")
+        ]
+        self.assertEqual(counted, [b"relay.handshake_timeouts:3|c",
+                                   b"relay.handshake_timeouts:2|c"])
+
+
+class Aggregator(DatagramProtocol):
+    def __init__(self):
+        self.received = Deferred()
+
+    def datagramReceived(self, data, addr):
+        self.received.callback(data)
+
+
+class Network(unittest.TestCase):
+    @inlineCallbacks
+    def test_udp(self):
+        aggregator = Aggregator()
+        port = reactor.listenUDP(0, aggregator, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        address = "127.0.0.1:%d" % port.getHost().port
+        service, client = statsd.create_statsd_service(
+            reactor, address, FakeTransit(), "relay", 60)
+        service.startService()
+        self.addCleanup(service.stopService)
+        # the TimerService reports once as soon as it starts
+        data = yield aggregator.received
+        self.assertIn(b"relay.connected:4|g", data.split(b"\n"))
+        self.assertEqual(client.sent, 1)
@@ -0,0 +1,98 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from ..timers import TimerWheel
+
+
+class Wheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(self.clock, tick=1.0, slots=8)
+        self.fired = []
+
+    def advance(self, seconds):
+        for _ in range(seconds):
+            self.clock.advance(1)
+
+    def test_fires_after_delay(self):
+        self.wheel.schedule(3, self.fired.append, "a")
+        self.wheel.schedule(2.5, self.fired.append, "b")
+        self.advance(2)
+        self.assertEqual(self.fired, [])
+        self.advance(1)
+        self.assertEqual(sorted(self.fired), ["a", "b"])
+        self.assertEqual(len(self.wheel), 0)
+        # nothing scheduled, so nothing is left in the reactor
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_longer_than_wheel(self):
+        # more ticks than slots: the timer waits for its round
+        self.wheel.schedule(20, self.fired.append, "long")
+        self.wheel.schedule(8, self.fired.append, "lap")
+        self.advance(8)
+        self.assertEqual(self.fired, ["lap"])
+        self.advance(11)
+        self.assertEqual(self.fired, ["lap"])
+        self.advance(1)
+        self.assertEqual(self.fired, ["lap", "long"])
+
+    def test_cancel(self):
+        t = self.wheel.schedule(3, self.fired.append, "a")
+        t.cancel()
+        t.cancel()
+        self.assertFalse(t.active)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.advance(5)
+        self.assertEqual(self.fired, [])
+
+    def test_cancel_from_callback(self):
+        # two timers in the same slot, each cancelling the other: only the
+        # one that runs first fires
+        timers = {}
+        def fire(name, other):
+            self.fired.append(name)
+            timers[other].cancel()
+        timers["a"] = self.wheel.schedule(2, fire, "a", "b")
+        timers["b"] = self.wheel.schedule(2, fire, "b", "a")
+        self.advance(2)
+        self.assertEqual(len(self.fired), 1)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_schedule_from_callback(self):
+        def again():
+            self.fired.append(self.clock.seconds())
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, again)
+        self.wheel.schedule(2, again)
+        self.advance(10)
+        self.assertEqual(self.fired, [2.0, 4.0, 6.0])
+
+    def test_catch_up(self):
+        # the reactor was busy for a while: missed ticks still fire
+        self.wheel.schedule(2, self.fired.append, "a")
+        self.wheel.schedule(4, self.fired.append, "b")
+        self.clock.advance(5)
+        self.assertEqual(self.fired, ["a", "b"])
+
+    def test_now(self):
+        self.wheel.schedule(10, lambda: None)
+        self.advance(3)
+        self.assertEqual(self.wheel.now, 3.0)
+        self.clock.advance(0.5)
+        self.assertEqual(self.wheel.now, 3.0)
+
+    def test_error(self):
+        def boom():
+            raise ValueError("boom")
+        self.wheel.schedule(1, boom)
+        self.wheel.schedule(1, self.fired.append, "ok")
+        self.advance(1)
+        self.assertEqual(self.fired, ["ok"])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_stop(self):
+        t = self.wheel.schedule(1, self.fired.append, "a")
+        self.wheel.stop()
+        self.assertFalse(t.active)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.advance(2)
+        self.assertEqual(self.fired, [])
@@ -0,0 +1,100 @@
+import os
+import signal
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from ..tracing import TraceBuffer, TraceService
+
+
+class FakeState(object):
+    tracer = None
+    mood = "happy"
+
+    def set_trace_function(self, tracer):
+        self.tracer = tracer
+
+    def get_mood(self):
+        return self.mood
+
+
+class FakeReactor(object):
+    def __init__(self):
+        self.from_thread = []
+
+    def callFromThread(self, f, *args):
+        self.from_thread.append((f, args))
+
+
+class Trace(unittest.TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.clock = Clock()
+
+    def _trace(self, **kwargs):
+        return TraceBuffer(self.directory, clock=self.clock.seconds, **kwargs)
+
+    def test_sample(self):
+        trace = self._trace(sample=0.25)
+        states = [FakeState() for _ in range(9)]
+        for state in states:
+            trace.maybe_trace(state)
+        self.assertEqual([s.tracer is not None for s in states],
+                         [True, False, False, False, True, False, False, False, True])
+
+    def test_ring(self):
+        trace = self._trace(size=3, sample=1)
+        a, b = FakeState(), FakeState()
+        trace.maybe_trace(a)
+        trace.maybe_trace(b)
+        a.tracer("listening", "connection_made", "wait_relay")
+        self.clock.advance(1)
+        b.tracer("listening", "connection_made", "wait_relay")
+        self.assertEqual(trace.entries(), [
+            (1, "listening", "connection_made", "wait_relay", 0),
+            (2, "listening", "connection_made", "wait_relay", 1),
+        ])
+        a.tracer("wait_relay", "please_relay", "wait_partner")
+        a.tracer("wait_partner", "connection_lost", "done")
+        # the oldest is overwritten
+        self.assertEqual(len(trace), 3)
+        self.assertEqual([(c, i) for (c, _, i, _, _) in trace.entries()],
+                         [(2, "connection_made"), (1, "please_relay"), (1, "connection_lost")])
+
+    def test_dump(self):
+        trace = self._trace(sample=1)
+        state = FakeState()
+        trace.maybe_trace(state)
+        state.tracer("listening", "connection_made", "wait_relay")
+        path = trace.dump("test")
+        self.assertTrue(os.path.basename(path).startswith("trace-"))
+        self.assertTrue(path.endswith("-test.txt"))
+        with open(path) as f:
+            self.assertEqual(f.read(), "0.000000 1 listening --connection_made--> wait_relay\n")
+
+    def test_anomalies(self):
+        trace = self._trace(anomalies=["impatient"])
+        state = FakeState()
+        trace.finished(state)
+        self.assertEqual(os.listdir(self.directory), [])
+        state.mood = "impatient"
+        trace.finished(state)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        # not again for a while
+        self.clock.advance(TraceBuffer.DUMP_INTERVAL - 1)
+        trace.finished(state)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_bad_sample(self):
+        with self.assertRaises(ValueError):
+            self._trace(sample=0)
+
+    def test_signal(self):
+        reactor = FakeReactor()
+        trace = self._trace()
+        service = TraceService(reactor, trace)
+        service.startService()
+        self.addCleanup(lambda: service.running and service.stopService())
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertEqual(reactor.from_thread, [(trace.dump, ("signal",))])
+        service.stopService()
+        self.assertEqual(signal.getsignal(signal.SIGUSR2), signal.SIG_DFL)
@@ -1,7 +1,9 @@
+import os
 from binascii import hexlify
 from twisted.trial import unittest
 from twisted.test import iosim
 from twisted.internet.testing import MemoryReactorClock
+from twisted.internet.task import Clock
 from autobahn.twisted.websocket import (
     WebSocketServerFactory,
     WebSocketClientFactory,
@@ -15,6 +17,7 @@ from zope.interface import implementer
 from .common import (
     ServerBase,
     IRelayTestClient,
+    RecordingSink,
 )
 from ..usage import (
     MemoryUsageRecorder,
@@ -24,12 +27,20 @@ from ..transit_server import (
     WebSocketTransitConnection,
     TransitServerState,
 )
+from ..server_state import Session
+from ..timers import TimerWheel
+from ..fdpressure import FdMonitor
+from ..lag import LagMonitor
+from ..tracing import TraceBuffer
+from ..requestlog import RequestLogger
 
 
-def handshake(token, side=None):
+def handshake(token, side=None, early_data=False):
     hs = b"please relay " + hexlify(token)
     if side is not None:
         hs += b" for side " + hexlify(side)
+    if early_data:
+        hs += b" with early-data"
     hs += b"\n"
     return hs
 
@@ -185,6 +196,83 @@ class _Transit:
         p1.disconnect()
         p2.disconnect()
 
+    def test_session(self):
+        active = self._transit_server.active_connections
+        p1 = self.new_protocol()
+        p2 = self.new_protocol()
+        token1 = b"\x00"*32
+        p1.send(handshake(token1, side=b"\x01"*8))
+        self.flush()
+        self.assertEqual(active.sessions(), [])
+        p2.send(handshake(token1, side=b"\x02"*8))
+        self.flush()
+
+        [session] = active.sessions()
+        self.assertIs(active.get_session(session.id), session)
+        self.assertEqual([side.get_token() for side in session.sides],
+                         ["0000000000000000-0101010101010101",
+                          "0000000000000000-0202020202020202"])
+        self.assertIs(session.partner_of(session.sides[0]), session.sides[1])
+        self.assertIn(session.kinds, [("tcp", "tcp"), ("websocket", "websocket")])
+        p1.send(b"data1")
+        p2.send(b"data22")
+        self.flush()
+        self.assertEqual(session.total_bytes, 11)
+
+        p1.disconnect()
+        self.flush()
+        self.assertIs(active.get_session(session.id), None)
+        p2.disconnect()
+
+    def test_stats(self):
+        # the gauges are kept up to date, rather than added up
+        transit = self._transit_server
+        active = transit.active_connections
+        self.patch(active, "_connections", NoScanSet())
+        token1 = b"\x00"*32
+        p1 = self.new_protocol()
+        p1.send(handshake(token1, side=b"\x01"*8, early_data=True))
+        p1.send(b"early")
+        self.flush()
+        self.assertEqual(transit.get_stats(),
+                         {"connected": 0, "waiting": 1, "incomplete_bytes": 0})
+        p2 = self.new_protocol()
+        p2.send(handshake(token1, side=b"\x02"*8))
+        self.flush()
+        # (the early data counts, from when the pair was completed)
+        self.assertEqual(transit.get_stats(),
+                         {"connected": 2, "waiting": 0, "incomplete_bytes": 5})
+        p1.send(b"data1")
+        p2.send(b"data22")
+        self.flush()
+        self.assertEqual(transit.get_stats(),
+                         {"connected": 2, "waiting": 0, "incomplete_bytes": 16})
+        [session] = active.sessions()
+        self.assertEqual(session.total_bytes, 16)
+
+        p3 = self.new_protocol()
+        p4 = self.new_protocol()
+        token2 = b"\x03"*32
+        p3.send(handshake(token2, side=b"\x01"*8))
+        self.flush()
+        p4.send(handshake(token2, side=b"\x02"*8))
+        self.flush()
+        p3.send(b"more")
+        self.flush()
+        self.assertEqual(transit.get_stats(),
+                         {"connected": 4, "waiting": 0, "incomplete_bytes": 20})
+
+        p1.disconnect()
+        self.flush()
+        self.assertEqual(transit.get_stats(),
+                         {"connected": 2, "waiting": 0, "incomplete_bytes": 4})
+        p3.disconnect()
+        self.flush()
+        self.assertEqual(transit.get_stats(),
+                         {"connected": 0, "waiting": 0, "incomplete_bytes": 0})
+        p2.disconnect()
+        p4.disconnect()
+
     def test_ignore_same_side(self):
         p1 = self.new_protocol()
         p2 = self.new_protocol()
@@ -340,6 +428,96 @@ class _Transit:
 
         p1.disconnect()
 
+    def test_early_data(self):
+        p1 = self.new_protocol()
+        p2 = self.new_protocol()
+
+        token1 = b"\x00"*32
+        side1 = b"\x01"*8
+        side2 = b"\x02"*8
+        # no round trip: the data follows the handshake immediately
+        p1.send(handshake(token1, side=side1, early_data=True))
+        p1.send(b"early")
+        self.flush()
+        p1.send(b" data")
+        self.flush()
+        self.assertEqual(p1.get_received_data(), b"")
+        pending = self._transit_server.pending_requests
+        self.assertEqual(pending.early_data_bytes, 10)
+
+        # a legacy partner just sees it after its "ok\n"
+        p2.send(handshake(token1, side=side2))
+        self.flush()
+        self.assertEqual(p1.get_received_data(), b"ok\n")
+        self.assertEqual(p2.get_received_data(), b"ok\nearly data")
+        self.assertEqual(pending.early_data_bytes, 0)
+
+        p2.send(b"reply")
+        self.flush()
+        self.assertEqual(p1.get_received_data(), b"ok\nreply")
+
+        p1.disconnect()
+        p2.disconnect()
+
+    def test_early_data_both(self):
+        p1 = self.new_protocol()
+        p2 = self.new_protocol()
+
+        token1 = b"\x00"*32
+        side1 = b"\x01"*8
+        side2 = b"\x02"*8
+        p1.send(handshake(token1, side=side1, early_data=True))
+        p1.send(b"from1")
+        self.flush()
+        p2.send(handshake(token1, side=side2, early_data=True))
+        p2.send(b"from2")
+        self.flush()
+        self.assertEqual(p1.get_received_data(), b"ok\nfrom2")
+        self.assertEqual(p2.get_received_data(), b"ok\nfrom1")
+
+        p1.disconnect()
+        p2.disconnect()
+
+    def test_early_data_too_much(self):
+        self.patch(TransitServerState, "EARLY_DATA_MAX", 10)
+        p1 = self.new_protocol()
+
+        token1 = b"\x00"*32
+        side1 = b"\x01"*8
+        p1.send(handshake(token1, side=side1, early_data=True))
+        p1.send(b"0123456789")
+        self.flush()
+        self.assertEqual(p1.get_received_data(), b"")
+        p1.send(b"!")
+        self.flush()
+        self.assertEqual(p1.get_received_data(), b"impatient\n")
+        self.assertEqual(self.count(), 0)
+        self.assertEqual(self._transit_server.pending_requests.early_data_bytes, 0)
+
+        p1.disconnect()
+
+    def test_early_data_total(self):
+        pending = self._transit_server.pending_requests
+        self.patch(pending, "EARLY_DATA_TOTAL", 15)
+        p1 = self.new_protocol()
+        p2 = self.new_protocol()
+
+        side1 = b"\x01"*8
+        p1.send(handshake(b"\x00"*32, side=side1, early_data=True))
+        p1.send(b"0123456789")
+        self.flush()
+        p2.send(handshake(b"\x01"*32, side=side1, early_data=True))
+        p2.send(b"0123456789")
+        self.flush()
+        self.assertEqual(p1.get_received_data(), b"")
+        self.assertEqual(p2.get_received_data(), b"impatient\n")
+        self.assertEqual(pending.early_data_bytes, 10)
+
+        # the memory is released when a waiting connection goes away
+        p1.disconnect()
+        self.flush()
+        self.assertEqual(pending.early_data_bytes, 0)
+
     def test_short_handshake(self):
         p1 = self.new_protocol()
         # hang up before sending a complete handshake
@@ -367,7 +545,7 @@ class TransitWithoutLogs(_Transit, ServerBase, unittest.TestCase):
         return self.new_protocol_tcp()
 
 
-def _new_protocol_ws(transit_server, log_requests):
+def _new_protocol_ws(transit_server, request_log):
     """
     Internal helper for test-suites that need to provide WebSocket
     client/server pairs.
@@ -377,7 +555,7 @@ def _new_protocol_ws(transit_server, log_requests):
     ws_factory = WebSocketServerFactory("ws://localhost:4002")
     ws_factory.protocol = WebSocketTransitConnection
     ws_factory.transit = transit_server
-    ws_factory.log_requests = log_requests
+    ws_factory.log_requests = request_log
     ws_protocol = ws_factory.buildProtocol(('127.0.0.1', 0))
 
     @implementer(IRelayTestClient)
@@ -429,7 +607,7 @@ class TransitWebSockets(_Transit, ServerBase, unittest.TestCase):
         return self.new_protocol_ws()
 
     def new_protocol_ws(self):
-        pump, proto = _new_protocol_ws(self._transit_server, self.log_requests)
+        pump, proto = _new_protocol_ws(self._transit_server, self._request_log)
         self._pumps.append(pump)
         return proto
 
@@ -499,6 +677,28 @@ class TransitWebSockets(_Transit, ServerBase, unittest.TestCase):
             self.flush()
 
 
+class NoScanSet(set):
+    """
+    A set which may not be looked through.
+    """
+
+    def __iter__(self):
+        raise AssertionError("scanned every connection")
+
+
+class FakeOffloader(object):
+    def __init__(self):
+        self.released = []
+        self.resumed = []
+
+    def release(self, conn, then):
+        self.released.append((conn, then))
+        return True
+
+    def resume(self, conn, other):
+        self.resumed.append((conn, other))
+
+
 class Usage(ServerBase, unittest.TestCase):
     log_requests = True
 
@@ -587,6 +787,274 @@ class Usage(ServerBase, unittest.TestCase):
         self.assertEqual(self._usage.events[0]["total_bytes"], 20)
         self.assertNotIdentical(self._usage.events[0]["waiting_time"], None)
 
+    def test_early_data(self):
+        p1 = self.new_protocol()
+        p2 = self.new_protocol()
+
+        token1 = b"\x00"*32
+        side1 = b"\x01"*8
+        side2 = b"\x02"*8
+        p1.send(handshake(token1, side=side1, early_data=True))
+        p1.send(b"\x00" * 13)
+        self.flush()
+        p2.send(handshake(token1, side=side2))
+        self.flush()
+        p2.send(b"\xff" * 7)
+        self.flush()
+
+        p1.disconnect()
+        self.flush()
+
+        # early data counts like any other
+        self.assertEqual(len(self._usage.events), 1, self._usage)
+        self.assertEqual(self._usage.events[0]["mood"], "happy", self._usage)
+        self.assertEqual(self._usage.events[0]["total_bytes"], 20)
+
+    def _idle_pair(self):
+        self._clock = Clock()
+        self._transit_server.timers = TimerWheel(self._clock)
+        self._transit_server.idle_timeout = 60
+        p1 = self.new_protocol()
+        p2 = self.new_protocol()
+        token1 = b"\x00"*32
+        p1.send(handshake(token1, side=b"\x01"*8))
+        self.flush()
+        p2.send(handshake(token1, side=b"\x02"*8))
+        self.flush()
+        return p1, p2
+
+    def _advance(self, seconds):
+        for _ in range(seconds):
+            self._clock.advance(1)
+        self.flush()
+
+    def test_idle(self):
+        p1, p2 = self._idle_pair()
+        p1.send(b"\x00" * 13)
+        self.flush()
+        p2.send(b"\xff" * 7)
+        self.flush()
+
+        self._advance(59)
+        self.assertEqual(self._usage.events, [])
+        self._advance(3)
+
+        # both sides are closed, and the pair recorded once
+        self.assertFalse(p1.connected)
+        self.assertFalse(p2.connected)
+        self.assertEqual(len(self._usage.events), 1, self._usage)
+        self.assertEqual(self._usage.events[0]["mood"], "idle")
+        self.assertEqual(self._usage.events[0]["total_bytes"], 20)
+        self.assertEqual(self._transit_server.active_connections._connections, set())
+        self.assertEqual(len(self._transit_server.timers), 0)
+
+    def test_not_idle(self):
+        p1, p2 = self._idle_pair()
+        # either side talking keeps the pair alive
+        for p in (p1, p2, p1, p2):
+            self._advance(45)
+            p.send(b"\x00" * 10)
+            self.flush()
+        self.assertTrue(p1.connected)
+        self.assertTrue(p2.connected)
+        self._advance(62)
+        self.assertFalse(p1.connected)
+        self.assertEqual(self._usage.events[0]["mood"], "idle")
+
+    def test_closed_before_idle(self):
+        p1, p2 = self._idle_pair()
+        p2.disconnect()
+        self.flush()
+        # the idle check is cancelled along with the pair
+        self.assertEqual(len(self._transit_server.timers), 0)
+        self.assertEqual([e["mood"] for e in self._usage.events], ["happy"])
+
+    def _offloaded_idle_pair(self):
+        p1, p2 = self._idle_pair()
+        offloader = self._transit_server.offloader = FakeOffloader()
+        sides = sorted(self._transit_server.active_connections._connections,
+                       key=lambda side: not side._first)
+        for side in sides:
+            side._client.offload = True
+        self._advance(62)
+        # the pair is asked for back, rather than closed
+        self.assertTrue(p1.connected)
+        [(client, then)] = offloader.released
+        return p1, p2, offloader, sides, then
+
+    def test_offloaded_idle(self):
+        p1, p2, offloader, sides, then = self._offloaded_idle_pair()
+        then()
+        self.flush()
+        self.assertFalse(p1.connected)
+        self.assertFalse(p2.connected)
+        self.assertEqual([e["mood"] for e in self._usage.events], ["idle"])
+
+    def test_offloaded_active_again(self):
+        p1, p2, offloader, sides, then = self._offloaded_idle_pair()
+        # the relay thread's last report came with the pair
+        sides[1].got_offloaded_bytes(100)
+        then()
+        self.flush()
+        self.assertTrue(p1.connected)
+        self.assertEqual(offloader.resumed, [(sides[0]._client, sides[1]._client)])
+        self.assertEqual(len(self._transit_server.timers), 1)
+        self.assertEqual(self._usage.events, [])
+
+    def test_offloaded_closed_meanwhile(self):
+        p1, p2, offloader, sides, then = self._offloaded_idle_pair()
+        p2.disconnect()
+        self.flush()
+        then()
+        self.flush()
+        self.assertEqual(offloader.resumed, [])
+        self.assertNotIn("idle", [e["mood"] for e in self._usage.events])
+
+    def _timed_protocol(self):
+        self._clock = Clock()
+        self._transit_server.timers = TimerWheel(self._clock)
+        self._transit_server.handshake_timeout = 30
+        return self.new_protocol()
+
+    def test_handshake_timeout(self):
+        p1 = self._timed_protocol()
+        self._advance(29)
+        self.assertTrue(p1.connected)
+        self._advance(2)
+        self.assertFalse(p1.connected)
+        self.assertEqual(len(self._usage.events), 1, self._usage)
+        self.assertEqual(self._usage.events[0]["mood"], "errory")
+        self.assertEqual(self._transit_server.get_counters()["handshake_timeouts"], 1)
+
+    def test_handshake_trickle(self):
+        p1 = self._timed_protocol()
+        # a byte at a time, never finishing the line
+        for _ in range(3):
+            p1.send(b"p")
+            self._advance(10)
+        self.assertFalse(p1.connected)
+        self.assertEqual(len(self._usage.events), 1, self._usage)
+        self.assertEqual(self._usage.events[0]["mood"], "errory")
+        self.assertEqual(self._transit_server.get_counters()["handshake_timeouts"], 1)
+
+    def test_handshake_in_time(self):
+        p1 = self._timed_protocol()
+        self._advance(29)
+        p1.send(handshake(b"\x00"*32, side=b"\x01"*8))
+        self.flush()
+        self.assertEqual(len(self._transit_server.timers), 0)
+        self._advance(60)
+        self.assertTrue(p1.connected)
+        p1.disconnect()
+        self.flush()
+        self.assertEqual(self._usage.events[0]["mood"], "lonely")
+        self.assertEqual(self._transit_server.get_counters()["handshake_timeouts"], 0)
+
+    def test_evicted(self):
+        # room for 3 descriptors before we evict, down to 2
+        self._transit_server.fd_monitor = FdMonitor(
+            10, 0.3, 0.2, count_fds=lambda: None)
+        p1 = self.new_protocol()
+        p1.send(handshake(b"\x00"*32, side=b"\x01"*8))
+        self.flush()
+        p2 = self.new_protocol()
+        p2.send(handshake(b"\x02"*32, side=b"\x01"*8))
+        self.flush()
+        self.assertEqual(self._usage.events, [])
+
+        # the third connection pushes out the one that waited longest
+        p3 = self.new_protocol()
+        self.flush()
+        self.assertFalse(p1.connected)
+        self.assertEqual(len(self._usage.events), 1, self._usage)
+        self.assertEqual(self._usage.events[0]["mood"], "evicted")
+        self.assertEqual(self._transit_server.get_counters()["evicted"], 1)
+        self.assertEqual(len(self._transit_server.pending_requests._requests), 1)
+
+        # .. and can still be p2's partner
+        p3.send(handshake(b"\x02"*32, side=b"\x02"*8))
+        self.flush()
+        self.assertEqual(p3.get_received_data(), b"ok\n")
+        p3.disconnect()
+        self.flush()
+        self.assertFalse(p2.connected)
+        self.assertEqual(self._usage.events[1]["mood"], "happy")
+        self.assertEqual(self._transit_server.fd_monitor.estimate(), 0)
+
+    def test_trace(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        trace = self._transit_server.trace = TraceBuffer(
+            directory, sample=1, anomalies=["lonely"])
+        p1 = self.new_protocol()
+        p1.send(handshake(b"\x00"*32, side=b"\x01"*8))
+        self.flush()
+        p1.disconnect()
+        self.flush()
+        self.assertEqual([(old, input, new) for (_, old, input, new, _) in trace.entries()], [
+            ("listening", "connection_made", "wait_relay"),
+            ("wait_relay", "please_relay_for_side", "wait_partner"),
+            ("wait_partner", "connection_lost", "done"),
+        ])
+        # a lonely ending is what we asked to hear about
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+    def test_shed(self):
+        monitor = self._transit_server.lag_monitor = LagMonitor(Clock(), threshold=0.1)
+        for _ in range(3):
+            monitor.record(1.0)
+        p1 = self.new_protocol()
+        self.flush()
+        # refused, and not recorded
+        self.assertFalse(p1.connected)
+        self.assertEqual(self._usage.events, [])
+        self.assertEqual(self._transit_server.get_counters()["shed"], 1)
+
+        while monitor.shedding:
+            monitor.record(0.0)
+        p2 = self.new_protocol()
+        self.flush()
+        self.assertTrue(p2.connected)
+        p2.disconnect()
+        self.flush()
+        self.assertEqual(self._usage.events[0]["mood"], "empty")
+        [record] = self._request_log._sink.records
+        self.assertEqual((record["event"], record["reason"]), ("refused", "overloaded"))
+
+    def test_request_log(self):
+        records = self._request_log._sink.records
+        p1 = self.new_protocol()
+        p2 = self.new_protocol()
+        token1 = b"\x00"*32
+        p1.send(handshake(token1, side=b"\x01"*8))
+        p2.send(handshake(token1, side=b"\x02"*8))
+        self.flush()
+        p1.disconnect()
+        self.flush()
+        # (each side hears about the other)
+        self.assertEqual(sorted((r["event"], r["token"]) for r in records), [
+            ("buddy_disconnected", "0000000000000000-0101010101010101"),
+            ("buddy_disconnected", "0000000000000000-0202020202020202"),
+        ])
+
+        p3 = self.new_protocol()
+        p3.send(b"please DELAY " + hexlify(token1) + b"\n")
+        self.flush()
+        self.assertEqual(records[-1]["event"], "bad_handshake")
+        self.assertIn("time", records[-1])
+        p3.disconnect()
+
+    def test_request_log_sampled(self):
+        # nothing is formatted for the events that aren't kept
+        self._request_log = RequestLogger(RecordingSink(), sample=0.5)
+        records = self._request_log._sink.records
+        for _ in range(4):
+            p = self.new_protocol()
+            p.send(b"please DELAY " + hexlify(b"\x00"*32) + b"\n")
+            self.flush()
+            p.disconnect()
+        self.assertEqual([r["event"] for r in records], ["bad_handshake"] * 2)
+
     def test_redundant(self):
         p1a = self.new_protocol()
         p1b = self.new_protocol()
@@ -614,6 +1082,7 @@ class Usage(ServerBase, unittest.TestCase):
         p2.send(handshake(token1, side=side2))
         self.flush()
         self.assertEqual(len(self._transit_server.pending_requests._requests), 0)
+        self.assertEqual(len(self._transit_server.pending_requests._lonely), 0)
         self.assertEqual(len(self._usage.events), 2, self._usage)
         self.assertEqual(self._usage.events[1]["mood"], "redundant")
 
@@ -649,7 +1118,7 @@ class UsageWebSockets(Usage):
         return self.new_protocol_ws()
 
     def new_protocol_ws(self):
-        pump, proto = _new_protocol_ws(self._transit_server, self.log_requests)
+        pump, proto = _new_protocol_ws(self._transit_server, self._request_log)
         self._pumps.append(pump)
         return proto
 
@@ -661,6 +1130,12 @@ class UsageWebSockets(Usage):
         because it is semantically invalid or no handshake (yet).
         """
 
+    def test_handshake_trickle(self):
+        """
+        Like test_short, this only makes sense for TCP: a WebSocket
+        message is either a handshake or a bad one.
+        """
+
     def test_send_non_binary_message(self):
         """
         A non-binary WebSocket message is an error
@@ -685,3 +1160,32 @@ class State(unittest.TestCase):
             "-",
             self.state.get_token(),
         )
+
+    def test_no_rate_without_timers(self):
+        self.state._note_activity(1000)
+        self.assertEqual(self.state.get_rate(), 0.0)
+        self.assertIdentical(self.state._last_activity, None)
+
+    def test_rate(self):
+        clock = Clock()
+        timers = TimerWheel(clock)
+        state = TransitServerState(None, None, timers)
+        buddy = TransitServerState(None, None, timers)
+        state._session = buddy._session = Session(1, state, buddy, 0.0)
+        # a steady 1000 bytes/second, noted once per tick
+        for _ in range(100):
+            state._note_activity(1000)
+            clock.advance(1)
+            timers.now = clock.seconds()
+        self.assertTrue(999.0 < state.get_rate() < 1001.0, state.get_rate())
+        self.assertEqual(state._last_activity, 99.0)
+        # the partner's bytes count towards the same average
+        self.assertEqual(buddy.get_rate(), state.get_rate())
+
+        # then silence: reading the average is enough for it to fall
+        clock.advance(30)
+        timers.now = clock.seconds()
+        self.assertTrue(45.0 < state.get_rate() < 55.0, state.get_rate())
+        clock.advance(60)
+        timers.now = clock.seconds()
+        self.assertLess(state.get_rate(), 1.0)
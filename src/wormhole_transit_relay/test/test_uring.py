@@ -0,0 +1,77 @@
+import ctypes
+import os
+import socket
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from .. import uring
+from ..offload import Offloader
+from .test_offload import PumpMixin, RelayMixin, _wait_for
+
+
+class Ring(unittest.TestCase):
+    if not uring.available():
+        skip = "io_uring is not available"
+
+    def test_send_recv(self):
+        ring = uring.Ring(8)
+        self.addCleanup(ring.close)
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        out = bytearray(b"hello")
+        out_address = ctypes.addressof((ctypes.c_char * 5).from_buffer(out))
+        into = bytearray(5)
+        into_address = ctypes.addressof((ctypes.c_char * 5).from_buffer(into))
+        ring.prep(uring._OP_SEND, a.fileno(), out_address, 5, 10)
+        ring.prep(uring._OP_RECV, b.fileno(), into_address, 5, 11)
+        done = []
+        while len(done) < 2:
+            ring.submit(wait=True)
+            done.extend(ring.completions())
+        self.assertEqual(sorted(done), [(10, 5), (11, 5)])
+        self.assertEqual(into, b"hello")
+
+
+class UringPump(PumpMixin, unittest.TestCase):
+    if not uring.available():
+        skip = "io_uring is not available"
+
+    def make_pump(self, call_from_thread):
+        return uring.UringPump(call_from_thread, "report", "finished")
+
+
+class Relay(RelayMixin, unittest.TestCase):
+    if not uring.available():
+        skip = "io_uring is not available"
+
+    def make_offloader(self):
+        return Offloader(reactor, 1, 0, pump=uring.UringPump)
+
+    @inlineCallbacks
+    def test_relay(self):
+        a = yield self._connect(b"1" * 16)
+        b = yield self._connect(b"2" * 16)
+        yield _wait_for(lambda: a.received == b"ok\n" and b.received == b"ok\n")
+        a.received = b.received = b""
+
+        a.transport.write(b"hello")
+        yield _wait_for(lambda: b.received == b"hello")
+        # taken over as soon as the first data arrived
+        self.assertEqual(self.offloader.offloaded, 1)
+
+        payload = os.urandom(1000 * 1000)
+        b.transport.write(payload)
+        yield _wait_for(lambda: len(a.received) == len(payload))
+        self.assertEqual(a.received, payload)
+
+        b.transport.loseConnection()
+        yield _wait_for(lambda: not a.connected)
+        yield _wait_for(lambda: self.recorder.events)
+        [event] = self.recorder.events
+        self.assertEqual(event["mood"], "happy")
+        self.assertEqual(event["total_bytes"], len(payload) + 5)
+
+
+    def test_idle(self):
+        return self._idle_after(b"hello")
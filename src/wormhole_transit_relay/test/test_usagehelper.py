@@ -0,0 +1,170 @@
+import io
+import json
+import os
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.internet.error import ProcessTerminated
+from .. import database
+from ..usagehelper import (
+    UsageHelper,
+    encode_usage,
+    encode_stats,
+    decode,
+    read_frames,
+    main,
+)
+
+
+class FakeProcessTransport(object):
+    def __init__(self):
+        self.written = []
+        self.producer = None
+        self.stdin_closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+
+class FakeReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env=None, childFDs=None):
+        self.spawned.append((protocol, args, childFDs))
+
+
+def _frames(data):
+    return [decode(payload) for payload in read_frames(io.BytesIO(data))]
+
+
+class Codec(unittest.TestCase):
+    def test_usage(self):
+        frame = encode_usage(100.0, 2.5, None, 1234, "jilted", 4)
+        self.assertLess(len(frame), 50)
+        self.assertEqual(_frames(frame), [("record_usage", dict(
+            started=100.0, total_time=2.5, waiting_time=None,
+            total_bytes=1234, mood="jilted", weight=4))])
+
+    def test_stats(self):
+        data = (encode_stats(1, 2, 3, 4, 5, None)
+                + encode_stats(1, 2, 3, 4, 5, {"happy": (10, 500), "lonely": (1, 0)}))
+        [(_, first), (_, second)] = _frames(data)
+        self.assertEqual(first, dict(rebooted=1, updated=2, connected=3, waiting=4,
+                                     incomplete_bytes=5, totals=None))
+        self.assertEqual(second["totals"], {"happy": (10, 500), "lonely": (1, 0)})
+
+    def test_truncated(self):
+        frame = encode_usage(100.0, 2.5, 1.0, 1234, "happy", 1)
+        self.assertEqual(_frames(frame + frame[:-1]), _frames(frame))
+
+
+class Child(unittest.TestCase):
+    def test_main(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        dbfile = os.path.join(directory, "usage.sqlite")
+        logfile = os.path.join(directory, "usage.log")
+        fd = os.open(logfile, os.O_WRONLY | os.O_CREAT)
+        stdin = io.BytesIO(
+            encode_usage(100.0, 2.5, None, 1234, "lonely", 1)
+            + encode_stats(50, 200, 2, 1, 0, None)
+        )
+        self.assertEqual(main(["--usage-db", dbfile, "--log-fd", str(fd)], stdin), 0)
+
+        db = database.get_db(dbfile)
+        self.assertEqual(
+            db.execute("SELECT `started`, `total_bytes`, `mood` FROM `usage`").fetchall(),
+            [dict(started=100, total_bytes=1234, mood=database.mood_code("lonely"))])
+        self.assertEqual(db.execute("SELECT `connected` FROM `current`").fetchall(),
+                         [dict(connected=2)])
+        with open(logfile) as f:
+            self.assertEqual(json.loads(f.read())["mood"], "lonely")
+
+
+class Helper(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.helper = UsageHelper(self.reactor, ["--log-fd", "5"], [5])
+        self.helper.startService()
+        [(protocol, args, child_fds)] = self.reactor.spawned
+        self.assertEqual(args[1:], ["-m", "wormhole_transit_relay.usagehelper", "--log-fd", "5"])
+        self.assertEqual(child_fds, {0: "w", 1: 1, 2: 2, 5: 5})
+        self.protocol = protocol
+        self.transport = FakeProcessTransport()
+        protocol.makeConnection(self.transport)
+
+    def _record(self, n):
+        for i in range(n):
+            self.helper.record_usage(started=100 + i, total_time=1.0, mood="happy")
+
+    def test_batched(self):
+        self._record(3)
+        self.assertEqual(self.transport.written, [])
+        self.reactor.advance(UsageHelper.INTERVAL)
+        [data] = self.transport.written
+        self.assertEqual([kwargs["started"] for (_, kwargs) in _frames(data)],
+                         [100, 101, 102])
+
+    def test_paused(self):
+        self.patch(UsageHelper, "MAX_QUEUED", 2)
+        helper = UsageHelper(self.reactor, [])
+        helper._started(self.transport)
+        self.assertIs(self.transport.producer, helper)
+        helper.pauseProducing()
+        for i in range(3):
+            helper.record_usage(started=i, mood="happy")
+        self.reactor.advance(UsageHelper.INTERVAL)
+        self.assertEqual(self.transport.written, [])
+        # the oldest went
+        self.assertEqual(helper.dropped, 1)
+        helper.resumeProducing()
+        [data] = self.transport.written
+        self.assertEqual([kwargs["started"] for (_, kwargs) in _frames(data)], [1, 2])
+
+    def test_died(self):
+        self._record(2)
+        self.protocol.processEnded(Failure(ProcessTerminated(exitCode=1)))
+        self.assertEqual(self.helper.dropped, 2)
+        # the relay carries on, counting what it can't record
+        self._record(1)
+        self.assertEqual(self.helper.dropped, 3)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def test_stop(self):
+        self._record(1)
+        d = self.helper.stopService()
+        self.assertEqual(len(self.transport.written), 1)
+        self.assertTrue(self.transport.stdin_closed)
+        self.assertNoResult(d)
+        self.protocol.processEnded(Failure(ProcessTerminated(exitCode=0)))
+        self.successResultOf(d)
+        self.assertEqual(self.helper.dropped, 0)
+
+
+class RealChild(unittest.TestCase):
+    def test_records(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        dbfile = os.path.join(directory, "usage.sqlite")
+        database.get_db(dbfile).close()
+        helper = UsageHelper(reactor, ["--usage-db", dbfile])
+        helper.startService()
+        helper.record_usage(started=100, total_time=1.0, total_bytes=10, mood="happy")
+        d = helper.stopService()
+
+        def check(_):
+            db = database.get_db(dbfile)
+            self.assertEqual(db.execute("SELECT `total_bytes` FROM `usage`").fetchall(),
+                             [dict(total_bytes=10)])
+            self.assertEqual(helper.dropped, 0)
+        d.addCallback(check)
+        return d
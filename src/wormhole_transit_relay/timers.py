@@ -0,0 +1,144 @@
+"""
+A hashed timing wheel, for the many coarse per-connection timeouts.
+
+A relay with tens of thousands of connections would otherwise give the
+reactor tens of thousands of delayed calls, each one rescheduled (a heap
+operation) whenever its connection makes progress. These timeouts only
+need to be accurate to about a second, so instead each one goes into one
+of ``slots`` buckets, and a single reactor call every ``tick`` seconds
+fires whatever is in the current bucket. Scheduling and cancelling are
+O(1), and while nothing is scheduled the wheel makes no reactor calls at
+all.
+
+The wheel also keeps ``now``, the reactor's time as of the last tick (or
+the last ``schedule()``), which connections use as a cheap clock when
+noting their activity.
+"""
+
+import math
+
+from twisted.python import log
+
+
+class _Timer(object):
+    """
+    A scheduled call, which may be cancelled.
+    """
+
+    def __init__(self, wheel, slot, rounds, f, args):
+        self._wheel = wheel
+        self._slot = slot
+        self._rounds = rounds
+        self._f = f
+        self._args = args
+        self.active = True
+
+    def cancel(self):
+        """
+        Don't make the call. Does nothing if it has already happened (or
+        been cancelled).
+        """
+        if self.active:
+            self.active = False
+            self._wheel._remove(self)
+
+
+class TimerWheel(object):
+    """
+    I call things after (roughly) a given delay: each call happens at
+    the first tick at or after its deadline, so up to ``tick`` seconds
+    late, and never early by more than the time since the previous tick.
+    """
+
+    def __init__(self, reactor, tick=1.0, slots=512):
+        self._reactor = reactor
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._position = 0
+        self._count = 0
+        self._call = None
+        self._advancing = False
+        self._last_tick = reactor.seconds()
+        self.now = self._last_tick
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, f, *args):
+        """
+        Call ``f(*args)`` in about ``delay`` seconds.
+
+        :returns: an object with a ``cancel()`` method
+        """
+        self.now = self._reactor.seconds()
+        idle = self._call is None and not self._advancing
+        if idle:
+            # start counting ticks from now
+            self._last_tick = self.now
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        rounds, offset = divmod(ticks, len(self._slots))
+        if offset == 0:
+            rounds -= 1
+        slot = (self._position + offset) % len(self._slots)
+        timer = _Timer(self, slot, rounds, f, args)
+        self._slots[slot].add(timer)
+        self._count += 1
+        if idle:
+            self._call = self._reactor.callLater(self.tick, self._advance)
+        return timer
+
+    def stop(self):
+        """
+        Forget every scheduled call (e.g. when shutting down).
+        """
+        for slot in self._slots:
+            for timer in slot:
+                timer.active = False
+            slot.clear()
+        self._count = 0
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _remove(self, timer):
+        self._slots[timer._slot].discard(timer)
+        self._count -= 1
+        if not self._count and self._call is not None and not self._advancing:
+            self._call.cancel()
+            self._call = None
+
+    def _advance(self):
+        self._call = None
+        self.now = self._reactor.seconds()
+        # if the reactor was busy (or the machine asleep), catch up on
+        # the ticks we missed
+        ticks = max(1, int((self.now - self._last_tick) / self.tick))
+        self._last_tick += ticks * self.tick
+        self._advancing = True
+        try:
+            for _ in range(ticks):
+                self._position = (self._position + 1) % len(self._slots)
+                self._fire(self._slots[self._position])
+                if not self._count:
+                    break
+        finally:
+            self._advancing = False
+        if self._count:
+            delay = max(0, self._last_tick + self.tick - self.now)
+            self._call = self._reactor.callLater(delay, self._advance)
+
+    def _fire(self, slot):
+        for timer in list(slot):
+            if not timer.active:
+                # cancelled by an earlier callback
+                continue
+            if timer._rounds:
+                timer._rounds -= 1
+                continue
+            slot.discard(timer)
+            self._count -= 1
+            timer.active = False
+            try:
+                timer._f(*timer._args)
+            except Exception:
+                log.err(None, "error in timer callback")
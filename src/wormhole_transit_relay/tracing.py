@@ -0,0 +1,142 @@
+"""
+A flight recorder for the connection state-machines.
+
+A TraceBuffer attaches a tracer to one in every ``1/sample`` new
+connections (counted, not random, so the choice costs one decrement per
+connection), and each transition of those connections' state-machines
+goes into a fixed-size ring buffer as a tuple of (connection number,
+old state, input, new state, timestamp). Connections that aren't sampled
+carry no tracer at all, so at the default 1% this is cheap enough to
+leave on permanently.
+
+The buffer is written out, oldest transition first, whenever the process
+gets SIGUSR2, and whenever a connection finishes with one of the
+``anomalies`` moods (but at most once every DUMP_INTERVAL seconds, so a
+flood of them can't turn into a flood of files).
+"""
+
+import os
+import signal
+import time
+from itertools import count
+
+from twisted.application.service import Service
+from twisted.python import log
+
+# 'SIGUSR2' is unix-only
+TRACE_SIGNAL = getattr(signal, "SIGUSR2", None)
+
+
+class TraceBuffer(object):
+    """
+    I keep the last ``size`` transitions of the sampled connections, and
+    write them into ``directory`` on demand.
+    """
+
+    # seconds between dumps caused by anomalies
+    DUMP_INTERVAL = 60.0
+
+    def __init__(self, directory, size=4096, sample=0.01, anomalies=(), clock=time.time):
+        """
+        :param float sample: the fraction of connections to trace
+
+        :param anomalies: the moods that cause a dump
+        """
+        if not 0 < sample <= 1:
+            raise ValueError("sample must be more than 0, and at most 1")
+        self._directory = directory
+        self._entries = [None] * size
+        self._next = 0 # total transitions recorded, ever
+        self._every = max(1, int(round(1 / sample)))
+        self._countdown = 1 # so the first connection is traced
+        self._ids = count(1)
+        self._anomalies = frozenset(anomalies)
+        self._clock = clock
+        self._last_dump = None
+
+    def __len__(self):
+        return min(self._next, len(self._entries))
+
+    def maybe_trace(self, state):
+        """
+        A new connection's TransitServerState has been created: trace it,
+        if it is one of our sample.
+        """
+        self._countdown -= 1
+        if self._countdown:
+            return
+        self._countdown = self._every
+        connection = next(self._ids)
+        entries = self._entries
+        clock = self._clock
+
+        def tracer(old, input, new):
+            entries[self._next % len(entries)] = (connection, old, input, new, clock())
+            self._next += 1
+        state.set_trace_function(tracer)
+
+    def entries(self):
+        """
+        :returns list: the transitions we have, oldest first
+        """
+        size = len(self._entries)
+        if self._next <= size:
+            return self._entries[:self._next]
+        start = self._next % size
+        return self._entries[start:] + self._entries[:start]
+
+    def finished(self, state):
+        """
+        A connection (traced or not) has closed: dump if its mood is one
+        of our anomalies.
+        """
+        mood = state.get_mood()
+        if mood not in self._anomalies:
+            return
+        now = self._clock()
+        if self._last_dump is not None and now - self._last_dump < self.DUMP_INTERVAL:
+            return
+        self._last_dump = now
+        self.dump(mood)
+
+    def dump(self, reason):
+        """
+        Write every transition we have into a new file.
+
+        :returns: the file's name
+        """
+        path = os.path.join(self._directory, "trace-{}-{}-{}.txt".format(
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid(), reason))
+        with open(path, "w") as f:
+            for (connection, old, input, new, timestamp) in self.entries():
+                f.write("{:.6f} {} {} --{}--> {}\n".format(timestamp, connection, old, input, new))
+        log.msg("wrote {} state-machine transitions to {}".format(len(self), path))
+        return path
+
+
+class TraceService(Service):
+    """
+    Dumps my TraceBuffer whenever the process gets ``signum``.
+    """
+
+    def __init__(self, reactor, trace, signum=TRACE_SIGNAL):
+        self._reactor = reactor
+        self.trace = trace
+        self._signum = signum
+        self._previous = None
+
+    def startService(self):
+        Service.startService(self)
+        if self._signum is None:
+            log.msg("no SIGUSR2 on this platform, so traces are only dumped on anomalies")
+            return
+        self._previous = signal.signal(self._signum, self._signalled)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._signum is not None:
+            signal.signal(self._signum, self._previous or signal.SIG_DFL)
+
+    def _signalled(self, signum, frame):
+        # see profiling.ProfilerService
+        self._reactor.callFromThread(self.trace.dump, "signal")
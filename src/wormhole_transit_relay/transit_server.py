@@ -1,6 +1,5 @@
 import re
 import time
-from twisted.python import log
 from twisted.protocols.basic import LineReceiver
 from autobahn.twisted.websocket import WebSocketServerProtocol
 
@@ -18,8 +17,74 @@ from wormhole_transit_relay.server_state import (
     ActiveConnections,
     ITransitClient,
 )
+from wormhole_transit_relay.requestlog import log_request
+from wormhole_transit_relay.sockopts import SocketOptions
 from zope.interface import implementer
 
+# listeners without a 'socket_options' attribute get just SO_KEEPALIVE
+DEFAULT_SOCKET_OPTIONS = SocketOptions()
+
+
+def _refuse(protocol):
+    """
+    Decide whether to serve a new connection at all.
+
+    :returns: None, or why the connection is refused: "overloaded" or
+        "over_limit"
+    """
+    lag_monitor = protocol.factory.transit.lag_monitor
+    if lag_monitor is not None and lag_monitor.refuse():
+        return "overloaded"
+    if not _acquire_address(protocol):
+        return "over_limit"
+    return None
+
+
+def _acquire_address(protocol):
+    """
+    Count a new connection against its source address.
+
+    :returns bool: False if that source already has as many connections
+        as it may (see limits.py)
+    """
+    limiter = protocol.factory.transit.limiter
+    if limiter is None:
+        return True
+    key = limiter.key_for(getattr(protocol.transport.getPeer(), "host", None))
+    if key is None:
+        return True
+    if not limiter.acquire(key):
+        return False
+    protocol._limit_key = key
+    return True
+
+
+def _release_address(protocol):
+    if protocol._limit_key is not None:
+        protocol.factory.transit.limiter.release(protocol._limit_key)
+        protocol._limit_key = None
+
+
+def _count_opened(protocol):
+    """
+    Tell the Transit's FdMonitor (if any) about a new connection, which
+    may evict some lonely ones.
+    """
+    transit = protocol.factory.transit
+    if transit.fd_monitor is not None:
+        transit.fd_monitor.connection_made(transit.pending_requests)
+
+
+def _count_closed(protocol):
+    if protocol.factory.transit.fd_monitor is not None:
+        protocol.factory.transit.fd_monitor.connection_lost(protocol._state)
+
+
+def _trace_finished(protocol):
+    # (the connection's state-machine has had its last input)
+    if protocol.factory.transit.trace is not None:
+        protocol.factory.transit.trace.finished(protocol._state)
+
 
 @implementer(ITransitClient)
 class TransitConnection(LineReceiver):
@@ -28,12 +93,20 @@ class TransitConnection(LineReceiver):
     # This must be >= to the longest possible handshake message.
 
     MAX_LENGTH = 1024
+    kind = "tcp"
     started_time = None
+    # None until the Offloader has decided whether to take this pair
+    offload = None
+    # what we are counted under by the Transit's limiter, if anything
+    _limit_key = None
 
     def send(self, data):
         """
         ITransitClient API
         """
+        if isinstance(data, memoryview):
+            # our partner's read buffer (see fastpath.py): use it now
+            data = self.factory.transit.relay_reader.send_view(self.transport, data)
         self.transport.write(data)
 
     def disconnect(self):
@@ -48,14 +121,21 @@ class TransitConnection(LineReceiver):
         """
         self._buddy = other
         self._buddy._client.transport.registerProducer(self.transport, True)
+        transit = self.factory.transit
+        if isinstance(other._client, TransitConnection):
+            if transit.relay_reader is not None:
+                transit.relay_reader.install(self)
+            if transit.relay_writer is not None:
+                transit.relay_writer.install(self)
+            if transit.offloader is not None:
+                transit.offloader.paired(self, other._client)
 
     def disconnect_partner(self):
         """
         ITransitClient API
         """
         assert self._buddy is not None, "internal error: no buddy"
-        if self.factory.log_requests:
-            log.msg("buddy_disconnected {}".format(self._buddy.get_token()))
+        log_request(self.factory, "buddy_disconnected", token=self._buddy.get_token)
         self._buddy._client.disconnect()
         self._buddy = None
 
@@ -67,14 +147,23 @@ class TransitConnection(LineReceiver):
         self._state = TransitServerState(
             self.factory.transit.pending_requests,
             self.factory.transit.usage,
+            self.factory.transit.timers,
+            self.factory.transit.idle_timeout,
+            self.factory.transit.handshake_timeout,
         )
+        if self.factory.transit.trace is not None:
+            self.factory.transit.trace.maybe_trace(self._state)
+        _count_opened(self)
+        refusal = _refuse(self)
+        if refusal is not None:
+            log_request(self.factory, "refused", reason=refusal,
+                        peer=lambda: str(self.transport.getPeer()))
+            self._state.refused()
+            self.transport.abortConnection()
+            return
         self._state.connection_made(self)
-        self.transport.setTcpKeepAlive(True)
-
-        # uncomment to turn on state-machine tracing
-        # def tracer(oldstate, theinput, newstate):
-        #     print("TRACE: {}: {} --{}--> {}".format(id(self), oldstate, theinput, newstate))
-        # self._state.set_trace_function(tracer)
+        socket_options = getattr(self.factory, "socket_options", DEFAULT_SOCKET_OPTIONS)
+        socket_options.apply(self.transport)
 
     def lineReceived(self, line):
         """
@@ -94,6 +183,13 @@ class TransitConnection(LineReceiver):
             side = new.group(2)
             self._state.please_relay_for_side(token, side)
 
+        # early data: "please relay {64} for side {16} with early-data\n"
+        early = re.search(br"^please relay (\w{64}) for side (\w{16}) with early-data$", line)
+        if early:
+            token = early.group(1)
+            side = early.group(2)
+            self._state.please_relay_for_side_with_early_data(token, side)
+
         if token is None:
             self._state.bad_token()
         else:
@@ -109,10 +205,20 @@ class TransitConnection(LineReceiver):
         # practice, this buffers about 10MB per connection, after which
         # point the sender will only transmit data as fast as the
         # receiver can handle it.
+        offloader = self.factory.transit.offloader
+        buddy = self._state._buddy
+        if offloader is not None and buddy is not None:
+            # only plain TCP pairs can be pumped by a thread
+            if isinstance(buddy._client, TransitConnection):
+                if offloader.observe(self, buddy._client, data):
+                    return
         self._state.got_bytes(data)
 
     def connectionLost(self, reason):
+        _release_address(self)
+        _count_closed(self)
         self._state.connection_lost()
+        _trace_finished(self)
 
 
 class Transit(object):
@@ -132,6 +238,14 @@ class Transit(object):
     receive "ok\n" until the other side has also connected and submitted a
     matching token (and differing SIDE).
 
+    A client may instead begin with "please relay TOKEN for SIDE with
+    early-data\n", and then send up to EARLY_DATA_MAX bytes right away,
+    without waiting for "ok\n". I hold on to them, and the other side
+    receives them right after its own "ok\n". Sending more than that
+    before "ok\n" is treated like sending any data before "ok\n" in the
+    other forms. (Older relays answer this handshake with "bad
+    handshake\n", so clients can fall back to the plain form.)
+
     In addition, the connections will be dropped after MAXLENGTH bytes have
     been sent by either side, or MAXTIME seconds have elapsed after the
     matching connections were established. A future API will reveal these
@@ -152,6 +266,32 @@ class Transit(object):
     # TODO: unused
     MAXTIME = 60*SECONDS
 
+    # an offload.Offloader, if elephant pairs should be moved to threads
+    offloader = None
+    # a fastpath.RelayReader, if paired TCP connections should read into
+    # a reusable buffer
+    relay_reader = None
+    # a fastpath.VectoredWriter, if paired TCP connections should flush
+    # their queued chunks with sendmsg
+    relay_writer = None
+    # a timers.TimerWheel for per-connection timeouts (and as a cheap
+    # clock for tracking activity), and the idle timeout in seconds
+    timers = None
+    idle_timeout = None
+    # a limits.ConnectionLimiter, if connections per source are capped
+    limiter = None
+    # seconds a new connection has to send its handshake, or None
+    handshake_timeout = None
+    # a fdpressure.FdMonitor, if lonely connections should be evicted
+    # when we are short of file descriptors
+    fd_monitor = None
+    # a lag.LagMonitor, measuring the reactor's delays (and perhaps
+    # shedding new connections when they are too long)
+    lag_monitor = None
+    # a tracing.TraceBuffer, recording the transitions of a sample of
+    # connections
+    trace = None
+
     def __init__(self, usage, get_timestamp):
         self.active_connections = ActiveConnections()
         self.pending_requests = PendingRequests(self.active_connections)
@@ -159,28 +299,54 @@ class Transit(object):
         self._timestamp = get_timestamp
         self._rebooted = self._timestamp()
 
-    def update_stats(self):
+    def get_stats(self):
+        """
+        :returns: dict of gauges describing what the relay is doing right
+            now: ``connected``, ``waiting`` and ``incomplete_bytes``
+        """
         # TODO: when a connection is half-closed, len(active) will be odd. a
         # moment later (hopefully) the other side will disconnect, but
         # _update_stats isn't updated until later.
 
         # "waiting" doesn't count multiple parallel connections from the same
         # side
+        return {
+            "connected": len(self.active_connections),
+            "waiting": len(self.pending_requests._requests),
+            "incomplete_bytes": self.active_connections.incomplete_bytes,
+        }
+
+    def get_counters(self):
+        """
+        :returns: dict of counters of things that happened since we
+            started: ``handshake_timeouts``, ``over_limit`` and
+            ``evicted``, and those of our UsageTracker and LagMonitor (if
+            any)
+        """
+        counters = {
+            "handshake_timeouts": self.pending_requests.handshake_timeouts,
+            "over_limit": self.limiter.refused if self.limiter is not None else 0,
+            "evicted": self.fd_monitor.evicted if self.fd_monitor is not None else 0,
+        }
+        counters.update(self.usage.get_counters())
+        if self.lag_monitor is not None:
+            counters.update(self.lag_monitor.get_counters())
+        return counters
+
+    def update_stats(self):
         self.usage.update_stats(
             rebooted=self._rebooted,
             updated=self._timestamp(),
-            connected=len(self.active_connections._connections),
-            waiting=len(self.pending_requests._requests),
-            incomplete_bytes=sum(
-                tc._total_sent
-                for tc in self.active_connections._connections
-            ),
+            **self.get_stats()
         )
 
 
 @implementer(ITransitClient)
 class WebSocketTransitConnection(WebSocketServerProtocol):
+    kind = "websocket"
     started_time = None
+    # what we are counted under by the Transit's limiter, if anything
+    _limit_key = None
 
     def send(self, data):
         """
@@ -206,8 +372,7 @@ class WebSocketTransitConnection(WebSocketServerProtocol):
         ITransitClient API
         """
         assert self._buddy is not None, "internal error: no buddy"
-        if self.factory.log_requests:
-            log.msg("buddy_disconnected {}".format(self._buddy.get_token()))
+        log_request(self.factory, "buddy_disconnected", token=self._buddy.get_token)
         self._buddy._client.disconnect()
         self._buddy = None
 
@@ -221,16 +386,36 @@ class WebSocketTransitConnection(WebSocketServerProtocol):
         self._state = TransitServerState(
             self.factory.transit.pending_requests,
             self.factory.transit.usage,
+            self.factory.transit.timers,
+            self.factory.transit.idle_timeout,
+            self.factory.transit.handshake_timeout,
         )
-
-        # uncomment to turn on state-machine tracing
-        # def tracer(oldstate, theinput, newstate):
-        #    print("WSTRACE: {}: {} --{}--> {}".format(id(self), oldstate, theinput, newstate))
-        # self._state.set_trace_function(tracer)
+        if self.factory.transit.trace is not None:
+            self.factory.transit.trace.maybe_trace(self._state)
+        _count_opened(self)
+        refusal = _refuse(self)
+        if refusal is not None:
+            log_request(self.factory, "refused", reason=refusal,
+                        peer=lambda: str(self.transport.getPeer()))
+            self._state.refused()
+            # (through autobahn, so it won't go on to open the WebSocket)
+            self.dropConnection(abort=True)
+            return
+        socket_options = getattr(self.factory, "socket_options", DEFAULT_SOCKET_OPTIONS)
+        socket_options.apply(self.transport)
 
     def onOpen(self):
         self._state.connection_made(self)
 
+    def connectionLost(self, reason):
+        """
+        IProtocol API
+        """
+        _release_address(self)
+        _count_closed(self)
+        super(WebSocketTransitConnection, self).connectionLost(reason)
+        _trace_finished(self)
+
     def onMessage(self, payload, isBinary):
         """
         We may have a 'handshake' on our hands or we may just have some bytes to relay
@@ -254,6 +439,13 @@ class WebSocketTransitConnection(WebSocketServerProtocol):
                 side = new.group(2)
                 self._state.please_relay_for_side(token, side)
 
+            # early data: "please relay {64} for side {16} with early-data"
+            early = re.search(br"^please relay (\w{64}) for side (\w{16}) with early-data$", payload)
+            if early:
+                token = early.group(1)
+                side = early.group(2)
+                self._state.please_relay_for_side_with_early_data(token, side)
+
             if token is None:
                 self._state.bad_token()
         else:
@@ -0,0 +1,467 @@
+"""
+An io_uring pump for relayed TCP pairs (Linux only).
+
+Instead of a callback (and a recv/send system call) per chunk per
+connection, a single thread keeps one receive or send in flight for each
+direction of every pair it owns, and submits all of the new operations
+and collects all of the finished ones with a single ``io_uring_enter``
+call. Under load one system call covers many connections.
+
+This talks to the kernel directly through ``ctypes`` (there is no
+io_uring in the standard library), using only the original ring layout
+and the ``IORING_OP_SEND``/``IORING_OP_RECV`` opcodes. We never use
+SQPOLL, so the kernel only looks at the rings during ``io_uring_enter``,
+and that system call orders our reads and writes of the shared memory.
+
+``available()`` says whether the running kernel will let us use it; if
+not, --relay-backend=io_uring falls back to the normal path.
+"""
+
+import ctypes
+import errno
+import mmap
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+from .offload import BUFSIZE, REPORT_INTERVAL
+
+_NR_SETUP = 425
+_NR_ENTER = 426
+
+_OFF_SQ_RING = 0
+_OFF_CQ_RING = 0x8000000
+_OFF_SQES = 0x10000000
+
+_FEAT_SINGLE_MMAP = 1 << 0
+_FEAT_NODROP = 1 << 1
+_FEAT_FAST_POLL = 1 << 5
+# we rely on completions never being dropped, and on sockets being polled
+# by the kernel rather than by a blocked worker thread
+_REQUIRED_FEATURES = _FEAT_NODROP | _FEAT_FAST_POLL
+
+_ENTER_GETEVENTS = 1
+
+_OP_ASYNC_CANCEL = 14
+_OP_SEND = 26
+_OP_RECV = 27
+
+_MSG_NOSIGNAL = 0x4000
+
+# user_data values: 0 is the waker, 1 a cancellation, and operations on
+# flows are (flow id << 1 | op)
+_WAKER = 0
+_CANCEL = 1
+_RECV = 0
+_SEND = 1
+
+_SQE = struct.Struct("=BBHiQQIIQHHiQQ")
+_CQE = struct.Struct("=QiI")
+_U32 = struct.Struct("=I")
+
+
+class _SQRingOffsets(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint32) for name in (
+        "head", "tail", "ring_mask", "ring_entries", "flags", "dropped",
+        "array", "resv1")] + [("user_addr", ctypes.c_uint64)]
+
+
+class _CQRingOffsets(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint32) for name in (
+        "head", "tail", "ring_mask", "ring_entries", "overflow", "cqes",
+        "flags", "resv1")] + [("user_addr", ctypes.c_uint64)]
+
+
+class _Params(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint32) for name in (
+        "sq_entries", "cq_entries", "flags", "sq_thread_cpu",
+        "sq_thread_idle", "features", "wq_fd")] + [
+        ("resv", ctypes.c_uint32 * 3),
+        ("sq_off", _SQRingOffsets),
+        ("cq_off", _CQRingOffsets),
+    ]
+
+
+_libc = None
+
+
+def _syscall(*args):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.syscall.restype = ctypes.c_long
+    # it's variadic, so make sure every integer is passed as a long
+    result = _libc.syscall(*[
+        ctypes.c_long(a) if isinstance(a, int) else a
+        for a in args
+    ])
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Ring(object):
+    """
+    A minimal io_uring: queue SQEs with ``prep()``, then ``submit()``
+    them and collect the completions.
+    """
+
+    def __init__(self, entries):
+        params = _Params()
+        self.fd = _syscall(_NR_SETUP, entries, ctypes.byref(params))
+        self.features = params.features
+        try:
+            self._map(params)
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.entries = params.sq_entries
+        self._sq_queued = 0
+
+    def _map(self, params):
+        sq, cq = params.sq_off, params.cq_off
+        sq_size = sq.array + params.sq_entries * 4
+        cq_size = cq.cqes + params.cq_entries * _CQE.size
+        flags = mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0)
+        prot = mmap.PROT_READ | mmap.PROT_WRITE
+        if params.features & _FEAT_SINGLE_MMAP:
+            sq_size = cq_size = max(sq_size, cq_size)
+        self._sq_ring = mmap.mmap(self.fd, sq_size, flags, prot, offset=_OFF_SQ_RING)
+        if params.features & _FEAT_SINGLE_MMAP:
+            self._cq_ring = self._sq_ring
+        else:
+            self._cq_ring = mmap.mmap(self.fd, cq_size, flags, prot, offset=_OFF_CQ_RING)
+        self._sqes = mmap.mmap(self.fd, params.sq_entries * _SQE.size, flags, prot,
+                               offset=_OFF_SQES)
+
+        self._sq_head = sq.head
+        self._sq_tail = sq.tail
+        self._sq_mask = _U32.unpack_from(self._sq_ring, sq.ring_mask)[0]
+        self._cq_head = cq.head
+        self._cq_tail = cq.tail
+        self._cq_mask = _U32.unpack_from(self._cq_ring, cq.ring_mask)[0]
+        self._cqes = cq.cqes
+        # SQE i always lives in slot i
+        for i in range(params.sq_entries):
+            _U32.pack_into(self._sq_ring, sq.array + 4 * i, i)
+        self._tail = _U32.unpack_from(self._sq_ring, self._sq_tail)[0]
+
+    def space(self):
+        """
+        :returns int: how many more SQEs can be queued before submit()
+        """
+        head = _U32.unpack_from(self._sq_ring, self._sq_head)[0]
+        return self.entries - ((self._tail - head) & 0xffffffff)
+
+    def prep(self, opcode, fd, addr, length, user_data, op_flags=0):
+        index = self._tail & self._sq_mask
+        _SQE.pack_into(self._sqes, index * _SQE.size,
+                       opcode, 0, 0, fd, 0, addr, length, op_flags,
+                       user_data, 0, 0, 0, 0, 0)
+        self._tail = (self._tail + 1) & 0xffffffff
+        self._sq_queued += 1
+
+    def submit(self, wait):
+        """
+        Hand everything queued to the kernel and, if ``wait``, block until
+        at least one operation has completed.
+        """
+        _U32.pack_into(self._sq_ring, self._sq_tail, self._tail)
+        to_submit, self._sq_queued = self._sq_queued, 0
+        try:
+            _syscall(_NR_ENTER, self.fd, to_submit, 1 if wait else 0,
+                     _ENTER_GETEVENTS if wait else 0, None, 0)
+        except OSError as e:
+            if e.errno not in (errno.EINTR, errno.EAGAIN, errno.EBUSY):
+                raise
+
+    def completions(self):
+        """
+        :returns: a list of ``(user_data, result)`` for every completed
+            operation not yet collected
+        """
+        head = _U32.unpack_from(self._cq_ring, self._cq_head)[0]
+        tail = _U32.unpack_from(self._cq_ring, self._cq_tail)[0]
+        done = []
+        while head != tail:
+            offset = self._cqes + (head & self._cq_mask) * _CQE.size
+            user_data, result, _ = _CQE.unpack_from(self._cq_ring, offset)
+            done.append((user_data, result))
+            head = (head + 1) & 0xffffffff
+        _U32.pack_into(self._cq_ring, self._cq_head, head)
+        return done
+
+    def close(self):
+        self._sqes.close()
+        if self._cq_ring is not self._sq_ring:
+            self._cq_ring.close()
+        self._sq_ring.close()
+        os.close(self.fd)
+
+
+def available():
+    """
+    :returns bool: True if this kernel lets us use io_uring, with the
+        features we need
+    """
+    try:
+        ring = Ring(4)
+    except (OSError, AttributeError, TypeError):
+        # ENOSYS (too old, or not Linux), EPERM (forbidden by a seccomp
+        # filter or the kernel.io_uring_disabled sysctl), ...
+        return False
+    ring.close()
+    return (ring.features & _REQUIRED_FEATURES) == _REQUIRED_FEATURES
+
+
+class _Flow(object):
+    """
+    One direction of a pair. At most one operation is in flight for
+    each flow: a receive into the buffer when it is empty, otherwise a
+    send of what is left in it.
+    """
+
+    def __init__(self, ident, src, dst, head=b""):
+        self.ident = ident
+        self.src = src
+        self.dst = dst
+        self.buffer = bytearray(BUFSIZE)
+        self._address = ctypes.addressof(
+            (ctypes.c_char * BUFSIZE).from_buffer(self.buffer))
+        self.buffer[:len(head)] = head
+        self.start, self.end = 0, len(head)
+        self.inflight = None
+        self.moved = 0
+
+    def pending(self):
+        return self.end - self.start
+
+    def prep(self, ring):
+        if self.pending():
+            ring.prep(_OP_SEND, self.dst.fileno(), self._address + self.start,
+                      self.pending(), self.ident << 1 | _SEND, _MSG_NOSIGNAL)
+            self.inflight = _SEND
+        else:
+            ring.prep(_OP_RECV, self.src.fileno(), self._address, BUFSIZE,
+                      self.ident << 1 | _RECV)
+            self.inflight = _RECV
+
+    def leftover(self):
+        return bytes(self.buffer[self.start:self.end])
+
+
+class _Pair(object):
+    def __init__(self, key, sockets, flows):
+        self.key = key
+        self.sockets = sockets
+        self.flows = flows
+        self.reported = [0, 0]
+        self.closing = False
+        self.closed = None
+
+    def unreported(self):
+        return [f.moved - r for (f, r) in zip(self.flows, self.reported)]
+
+
+class UringPump(threading.Thread):
+    """
+    Relays between the sockets of many pairs, with one io_uring. This has
+    the same interface as offload.RelayPump, so the Offloader can use
+    either.
+    """
+
+    ENTRIES = 1024
+
+    def __init__(self, call_from_thread, report, finished):
+        threading.Thread.__init__(self, name="relay-uring", daemon=True)
+        self._call = call_from_thread
+        self._report = report
+        self._finished = finished
+        self._ring = Ring(self.ENTRIES)
+        self._new = queue.SimpleQueue()
+        self._releasing = queue.SimpleQueue()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_w.setblocking(False)
+        self._waker_buffer = bytearray(64)
+        self._waker_address = ctypes.addressof(
+            (ctypes.c_char * 64).from_buffer(self._waker_buffer))
+        self._pairs = set()
+        self._flows = {}
+        self._dirty = []
+        self._inflight = 0
+        self._next_ident = 1
+        self._stopping = False
+        self.remaining = [] # (key, closed, leftovers, moved) of pairs left at stop()
+
+    def load(self):
+        return len(self._pairs) + self._new.qsize()
+
+    def add_pair(self, key, sock0, sock1, head=b""):
+        """
+        Start relaying between two connected sockets; see
+        RelayPump.add_pair. Thread-safe.
+        """
+        self._new.put((key, (sock0, sock1), head))
+        self._wake()
+
+    def release_pair(self, key):
+        """
+        Hand a pair back; see RelayPump.release_pair. Thread-safe.
+        """
+        self._releasing.put(key)
+        self._wake()
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wake()
+        self.join()
+        self._ring.close()
+        self._waker_r.close()
+        self._waker_w.close()
+
+    def _wake(self):
+        try:
+            self._waker_w.send(b"x")
+        except BlockingIOError:
+            pass # already awake
+
+    def _prep(self, *args):
+        if not self._ring.space():
+            self._ring.submit(wait=False)
+        self._ring.prep(*args)
+
+    def _arm_waker(self):
+        self._prep(_OP_RECV, self._waker_r.fileno(), self._waker_address,
+                   len(self._waker_buffer), _WAKER)
+
+    def run(self):
+        self._arm_waker()
+        next_report = time.monotonic() + REPORT_INTERVAL
+        while True:
+            self._add_new_pairs()
+            while not self._releasing.empty():
+                key = self._releasing.get()
+                for pair in list(self._pairs):
+                    if pair.key == key and not pair.closing:
+                        self._close(pair, None)
+            if self._stopping:
+                for pair in list(self._pairs):
+                    if not pair.closing:
+                        self._close(pair, None)
+                if not self._inflight:
+                    break
+            dirty, self._dirty = self._dirty, []
+            for flow in dirty:
+                pair = self._flows.get(flow.ident)
+                if pair is not None and not pair.closing and flow.inflight is None:
+                    flow.prep(self._ring)
+                    self._inflight += 1
+            self._ring.submit(wait=True)
+            for user_data, result in self._ring.completions():
+                self._complete(user_data, result)
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + REPORT_INTERVAL
+                self._send_report()
+
+    def _add_new_pairs(self):
+        while not self._new.empty():
+            key, sockets, head = self._new.get()
+            flows = []
+            for i in (0, 1):
+                flow = _Flow(self._next_ident, sockets[i], sockets[1 - i],
+                             head if i == 0 else b"")
+                self._next_ident += 1
+                flows.append(flow)
+            pair = _Pair(key, sockets, flows)
+            for flow in flows:
+                self._flows[flow.ident] = pair
+            for sock in sockets:
+                # let the kernel poll the sockets for us, rather than
+                # getting EAGAIN back
+                sock.setblocking(True)
+            self._pairs.add(pair)
+            self._dirty.extend(flows)
+
+    def _complete(self, user_data, result):
+        if user_data == _WAKER:
+            self._arm_waker()
+            return
+        if user_data == _CANCEL:
+            return
+        ident, op = user_data >> 1, user_data & 1
+        pair = self._flows[ident]
+        i = 0 if pair.flows[0].ident == ident else 1
+        flow = pair.flows[i]
+        flow.inflight = None
+        self._inflight -= 1
+        if result == -errno.EAGAIN or result == -errno.EINTR:
+            self._dirty.append(flow)
+        elif result == -errno.ECANCELED:
+            pass
+        elif op == _RECV:
+            if result > 0:
+                flow.start, flow.end = 0, result
+                flow.moved += result
+                self._dirty.append(flow)
+            elif not pair.closing:
+                # 0 is EOF, anything else an error: either way the
+                # source has gone
+                self._close(pair, i)
+        else:
+            if result >= 0:
+                flow.start += result
+                self._dirty.append(flow)
+            elif not pair.closing:
+                self._close(pair, 1 - i)
+        # (_close() above may already have released it)
+        if (pair.closing and pair in self._pairs
+                and not any(f.inflight is not None for f in pair.flows)):
+            self._release(pair)
+
+    def _close(self, pair, closed):
+        """
+        Stop relaying this pair. Its buffers must stay alive until the
+        kernel has finished with any operation still in flight, so this
+        cancels those, and _release() happens when they have completed.
+        """
+        pair.closing = True
+        pair.closed = closed
+        inflight = False
+        for flow in pair.flows:
+            if flow.inflight is not None:
+                inflight = True
+                self._prep(_OP_ASYNC_CANCEL, -1, flow.ident << 1 | flow.inflight,
+                           0, _CANCEL)
+        if not inflight:
+            self._release(pair)
+
+    def _release(self, pair):
+        self._pairs.discard(pair)
+        for flow in pair.flows:
+            del self._flows[flow.ident]
+        for sock in pair.sockets:
+            sock.setblocking(False)
+        leftovers = [pair.flows[1].leftover(), pair.flows[0].leftover()]
+        moved = pair.unreported()
+        if self._stopping:
+            self.remaining.append((pair.key, pair.closed, leftovers, moved))
+            return
+        if any(moved):
+            self._call(self._report, [(pair.key, moved)])
+        self._call(self._finished, pair.key, pair.closed, leftovers)
+
+    def _send_report(self):
+        reports = []
+        for pair in self._pairs:
+            moved = pair.unreported()
+            if any(moved):
+                reports.append((pair.key, moved))
+                pair.reported = [f.moved for f in pair.flows]
+        if reports:
+            self._call(self._report, reports)
@@ -1,26 +1,43 @@
 import time
 import json
+import threading
+from collections import deque
 
+from twisted.application.service import Service
+from twisted.internet.defer import gatherResults, succeed
+from twisted.internet.threads import deferToThreadPool
 from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from zope.interface import (
     implementer,
     Interface,
 )
 
+from .database import mood_code, db_filename, open_existing_db, PartitionedDB
 
-def create_usage_tracker(blur_usage, log_file, usage_db):
+
+def create_usage_tracker(blur_usage, log_file, usage_db, sampler=None, reactor=None):
     """
     :param int blur_usage: see UsageTracker
 
     :param log_file: None or a file-like object to write JSON-encoded
         lines of usage information to.
 
-    :param usage_db: None or an sqlite3 database connection
+    :param usage_db: None, an sqlite3 database connection, or a
+        PartitionedDB
+
+    :param sampler: None or a UsageSampler, see UsageTracker
+
+    :param reactor: None, or the reactor to deliver records to the
+        backends from, see UsageTracker
 
     :returns: a new UsageTracker instance configured with backends.
     """
-    tracker = UsageTracker(blur_usage)
-    if usage_db:
+    tracker = UsageTracker(blur_usage, sampler, reactor)
+    if isinstance(usage_db, PartitionedDB):
+        tracker.add_backend(PartitionedDatabaseUsageRecorder(usage_db))
+    elif usage_db:
         tracker.add_backend(DatabaseUsageRecorder(usage_db))
     if log_file:
         tracker.add_backend(LogFileUsageRecorder(log_file))
@@ -32,7 +49,7 @@ class IUsageWriter(Interface):
     Records actual usage statistics in some way
     """
 
-    def record_usage(started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None):
+    def record_usage(started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
         """
         :param int started: timestemp when this connection began
 
@@ -46,6 +63,11 @@ class IUsageWriter(Interface):
             record the total bytes (but count both).
 
         :param str mood: the 'mood' of the connection
+
+        :param int weight: how many connections this record stands
+            for. This is 1 unless records are being sampled, in which
+            case it is the sampling interval (so sums of weights, or of
+            weight * total_bytes, are unbiased estimates).
         """
 
 
@@ -58,7 +80,7 @@ class MemoryUsageRecorder:
     def __init__(self):
         self.events = []
 
-    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None):
+    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
         """
         IUsageWriter.
         """
@@ -68,6 +90,7 @@ class MemoryUsageRecorder:
             "waiting_time": waiting_time,
             "total_bytes": total_bytes,
             "mood": mood,
+            "weight": weight,
         }
         self.events.append(data)
 
@@ -79,13 +102,14 @@ class LogFileUsageRecorder:
     one record per line.
     """
 
+    # the disk may keep us waiting: a BackendQueue gives us our records
+    # with write_batch(), in a thread
+    blocking = True
+
     def __init__(self, writable_file):
         self._file = writable_file
 
-    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None):
-        """
-        IUsageWriter.
-        """
+    def _line(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
         data = {
             "started": started,
             "total_time": total_time,
@@ -93,9 +117,29 @@ class LogFileUsageRecorder:
             "total_bytes": total_bytes,
             "mood": mood,
         }
-        self._file.write(json.dumps(data) + "\n")
+        if weight != 1:
+            # only sampled records say how many connections they stand for
+            data["weight"] = weight
+        return json.dumps(data) + "\n"
+
+    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
+        """
+        IUsageWriter.
+        """
+        self._file.write(self._line(started, total_time, waiting_time, total_bytes, mood, weight))
         self._file.flush()
 
+    def write_batch(self, records):
+        """
+        Write ``records`` (dicts of record_usage arguments), and flush
+        once. This runs in a thread (see BackendQueue).
+
+        :returns: a list of Failures, for the records we couldn't write
+        """
+        self._file.write("".join(self._line(**data) for data in records))
+        self._file.flush()
+        return []
+
 
 @implementer(IUsageWriter)
 class DatabaseUsageRecorder:
@@ -105,23 +149,407 @@ class DatabaseUsageRecorder:
 
     def __init__(self, db):
         self._db = db
-
-    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None):
+        # A database file (rather than ":memory:") can be written from a
+        # thread, with a connection of its own: a BackendQueue then gives
+        # us our records with write_batch(), and the statistics with
+        # write_stats(), so the reactor never waits for the write lock.
+        self._dbfile = db_filename(db)
+        self.blocking = self._dbfile is not None
+        # (stats_db, db_for, commit, close) for the connections
+        # write_batch() and write_stats() open in their thread, and keep
+        # until close_writer()
+        self._writer = None
+
+    def _db_for(self, started):
         """
-        IUsageWriter.
+        :returns: the database connection that usage records for
+            connections which began at ``started`` are written to
         """
-        self._db.execute(
+        return self._db
+
+    def _insert(self, db, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
+        db.execute(
             "INSERT INTO `usage`"
-            " (`started`, `total_time`, `waiting_time`,"
-            "  `total_bytes`, `result`)"
-            " VALUES (?,?,?,?,?)",
-            (started, total_time, waiting_time, total_bytes, mood)
+            " (`started`, `total_time_ms`, `waiting_time_ms`,"
+            "  `total_bytes`, `mood`, `weight`)"
+            " VALUES (?,?,?,?,?,?)",
+            (int(started), _ms(total_time or 0), _ms(waiting_time),
+             int(total_bytes or 0), mood_code(mood), weight)
         )
+
+    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
+        """
+        IUsageWriter.
+        """
+        db = self._db_for(started)
+        self._insert(db, started, total_time, waiting_time, total_bytes, mood, weight)
         # original code did "self._update_stats()" here, thus causing
         # "global" stats update on every connection update .. should
         # we repeat this behavior, or really only record every
         # 60-seconds with the timer?
-        self._db.commit()
+        db.commit()
+
+    def _open_in_thread(self):
+        """
+        :returns: ``(stats_db, db_for, commit, close)``: the new
+            connection of our own for update_stats(), a function like
+            _db_for using new connections, and functions which commit and
+            close them
+        """
+        db = open_existing_db(self._dbfile)
+        return db, (lambda started: db), db.commit, db.close
+
+    def write_batch(self, records):
+        """
+        Write ``records`` (dicts of record_usage arguments) in one
+        transaction. This runs in a thread (see BackendQueue), like
+        retention.UsagePruner, with connections opened by the first
+        batch and kept for the ones after it (so they must all come from
+        the same thread, until close_writer()).
+
+        :returns: a list of Failures, for the records we couldn't write
+        """
+        _, db_for, commit, _ = self._open_writer()
+        failures = []
+        try:
+            for data in records:
+                try:
+                    self._insert(db_for(data["started"]), **data)
+                except Exception:
+                    failures.append(Failure())
+        finally:
+            try:
+                commit()
+            except Exception:
+                # start again with new connections next time
+                self.close_writer()
+                raise
+        return failures
+
+    def _open_writer(self):
+        if self._writer is None:
+            self._writer = self._open_in_thread()
+        return self._writer
+
+    def close_writer(self):
+        """
+        Close the connections write_batch() and write_stats() opened,
+        from their thread.
+        """
+        if self._writer is not None:
+            close = self._writer[-1]
+            self._writer = None
+            close()
+
+    def update_stats(self, rebooted, updated, connected, waiting,
+                     incomplete_bytes, totals=None):
+        """
+        Replace the `current` statistics, add them to `stats_history`
+        (and, if ``totals`` is not None, update the exact per-mood
+        `usage_totals`).
+
+        :param dict totals: None, or mood -> (connections, total_bytes)
+        """
+        self._write_stats(self._db, rebooted, updated, connected, waiting,
+                          incomplete_bytes, totals)
+
+    def write_stats(self, rebooted, updated, connected, waiting,
+                    incomplete_bytes, totals=None):
+        """
+        Like update_stats, but with the connection write_batch() uses, in
+        its thread (see BackendQueue).
+        """
+        stats_db = self._open_writer()[0]
+        try:
+            self._write_stats(stats_db, rebooted, updated, connected, waiting,
+                              incomplete_bytes, totals)
+        except Exception:
+            # (without the half-written transaction)
+            self.close_writer()
+            raise
+
+    def _write_stats(self, db, rebooted, updated, connected, waiting,
+                     incomplete_bytes, totals):
+        db.execute("DELETE FROM `current`")
+        db.execute(
+            "INSERT INTO `current`"
+            " (`rebooted`, `updated`, `connected`, `waiting`,"
+            "  `incomplete_bytes`)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (int(rebooted), int(updated), connected, waiting,
+             incomplete_bytes)
+        )
+        # .. and keep it, in the same transaction
+        db.execute(
+            "INSERT OR REPLACE INTO `stats_history`"
+            " (`updated`, `connected`, `waiting`, `incomplete_bytes`)"
+            " VALUES (?, ?, ?, ?)",
+            (int(updated), connected, waiting, incomplete_bytes)
+        )
+        if totals is not None:
+            db.executemany(
+                "INSERT OR REPLACE INTO `usage_totals`"
+                " (`updated`, `mood`, `connections`, `total_bytes`)"
+                " VALUES (?, ?, ?, ?)",
+                [(int(updated), mood_code(mood), connections, int(total_bytes))
+                 for (mood, (connections, total_bytes)) in totals.items()]
+            )
+        db.commit()
+
+
+class PartitionedDatabaseUsageRecorder(DatabaseUsageRecorder):
+    """
+    Write usage records into per-period database files. The `current`
+    statistics still go into the index database.
+    """
+
+    def __init__(self, partitioned_db):
+        super(PartitionedDatabaseUsageRecorder, self).__init__(partitioned_db.index)
+        self._partitions = partitioned_db
+        # Held while we write records (and so while we open partitions),
+        # and by retention.prune_partitions() while it drops one, from
+        # its own thread.
+        self.lock = threading.Lock()
+        self._writer_partitions = None # the PartitionedDB write_batch() uses
+        self._releasing = set() # partitions to close after we next write
+
+    def _db_for(self, started):
+        return self._partitions.partition_for(started)
+
+    def _close_released(self, partitioned):
+        for start in self._releasing:
+            partitioned.close_partition(start)
+        self._releasing.clear()
+
+    def record_usage(self, **kwargs):
+        """
+        IUsageWriter.
+        """
+        with self.lock:
+            try:
+                super(PartitionedDatabaseUsageRecorder, self).record_usage(**kwargs)
+            finally:
+                self._close_released(self._partitions)
+
+    def _open_in_thread(self):
+        partitioned = self._writer_partitions = PartitionedDB(
+            self._dbfile, self._partitions.period, open_existing_db(self._dbfile))
+        return (partitioned.index, partitioned.partition_for,
+                partitioned.commit, partitioned.close)
+
+    def write_batch(self, records):
+        with self.lock:
+            try:
+                return super(PartitionedDatabaseUsageRecorder, self).write_batch(records)
+            finally:
+                if self._writer_partitions is not None:
+                    self._close_released(self._writer_partitions)
+
+    def release_partition(self, start):
+        """
+        retention.prune_partitions() wants to drop the partition
+        beginning at ``start``. This is called from its thread, with
+        ``lock`` held.
+
+        :returns bool: True if we don't have it open, so it can be
+            dropped now. Otherwise we close it when we have next written
+            (so it can be dropped next time), and return False.
+        """
+        open_partitions = self._partitions.open_partitions()
+        if self._writer_partitions is not None:
+            open_partitions |= self._writer_partitions.open_partitions()
+        if start not in open_partitions:
+            return True
+        self._releasing.add(start)
+        return False
+
+
+class UsageSampler(object):
+    """
+    Decides which usage records are written out in full: one out of
+    every N, counted separately for each mood (so rare moods can be
+    kept at a higher rate than "happy" and "lonely"). Records that are
+    kept carry N as their weight.
+    """
+
+    def __init__(self, rate, mood_rates=None):
+        """
+        :param int rate: keep one record in this many (1 keeps them all)
+
+        :param dict mood_rates: None, or a dict mapping a mood to the
+            rate for that mood, overriding ``rate``
+        """
+        self._rate = rate
+        self._mood_rates = dict(mood_rates or {})
+        self._seen = {} # mood -> records since the last one we kept
+
+    def weight(self, mood):
+        """
+        :returns int: 0 if this record should be dropped, otherwise the
+            weight to record it with
+        """
+        rate = self._mood_rates.get(mood, self._rate)
+        if rate <= 1:
+            return 1
+        seen = self._seen.get(mood, 0)
+        self._seen[mood] = (seen + 1) % rate
+        return rate if seen == 0 else 0
+
+
+class BackendQueue(object):
+    """
+    Delivers usage records to one backend soon after they are recorded
+    (rather than while a connection is being torn down).
+
+    A backend that may keep us waiting for the disk (one whose
+    ``blocking`` is True) gets everything queued at once, with its
+    ``write_batch()``, in a thread; the next batch waits until that one
+    is written. When we are flushed, it is also asked to
+    ``close_writer()`` (if it has one) in that thread. The others are
+    called from the reactor, for at most BATCH records or TIME_SLICE
+    seconds per turn, before everything else has a go.
+
+    At most ``max_queued`` records wait: when a backend falls that far
+    behind, the oldest are dropped (and counted). A backend that raises
+    an exception has it logged (and counted), and goes on getting the
+    records after it.
+    """
+
+    # records delivered from the reactor in one turn ..
+    BATCH = 50
+    # .. or, if it takes longer, seconds spent delivering them
+    TIME_SLICE = 0.005
+
+    def __init__(self, backend, reactor, max_queued=10000, in_thread=None):
+        """
+        :param in_thread: None to deliver from the reactor, or called like
+            ``in_thread(f, *args)`` to run ``f`` in a thread, returning a
+            Deferred, for a blocking backend (see JSONLinesSink)
+        """
+        self.backend = backend
+        self._reactor = reactor
+        self._in_thread = in_thread
+        self._queue = deque(maxlen=max_queued)
+        self._call = None
+        self._write = None # the Deferred for a batch being written in a thread
+        self.dropped = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, data):
+        if len(self._queue) == self._queue.maxlen:
+            # (the deque pushes out the oldest itself)
+            self.dropped += 1
+        self._queue.append(data)
+        self._schedule()
+
+    def _schedule(self):
+        if self._call is None and self._write is None and self._queue:
+            self._call = self._reactor.callLater(0, self._deliver)
+
+    def _deliver(self):
+        self._call = None
+        if self._in_thread is not None:
+            records = list(self._queue)
+            self._queue.clear()
+            d = self._write = self._in_thread(self.backend.write_batch, records)
+            d.addCallbacks(self._written, self._batch_failed, errbackArgs=(len(records),))
+            d.addBoth(self._write_done)
+            return
+        deadline = time.perf_counter() + self.TIME_SLICE
+        for _ in range(min(self.BATCH, len(self._queue))):
+            self._record(self._queue.popleft())
+            if time.perf_counter() >= deadline:
+                break
+        self._schedule()
+
+    def _record(self, data):
+        try:
+            self.backend.record_usage(**data)
+        except Exception:
+            self._failed(Failure())
+
+    def _failed(self, failure):
+        self.failed += 1
+        log.err(failure, "usage backend {!r} failed".format(self.backend))
+
+    def _written(self, failures):
+        for failure in failures:
+            self._failed(failure)
+
+    def _batch_failed(self, failure, count):
+        self.failed += count
+        log.err(failure, "usage backend {!r} failed".format(self.backend))
+
+    def _write_done(self, _):
+        self._write = None
+        self._schedule()
+
+    def _deliver_rest(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        records = list(self._queue)
+        self._queue.clear()
+        if self._in_thread is None:
+            for data in records:
+                self._record(data)
+            return succeed(None)
+        d = succeed([])
+        if records:
+            d = self._in_thread(self.backend.write_batch, records)
+        d.addCallbacks(self._written, self._batch_failed, errbackArgs=(len(records),))
+        close_writer = getattr(self.backend, "close_writer", None)
+        if close_writer is not None:
+            # (in the thread that opened them)
+            d.addCallback(lambda _: self._in_thread(close_writer))
+            d.addErrback(log.err, "usage backend {!r} failed to close".format(self.backend))
+        return d
+
+    def update_stats(self, *args):
+        """
+        Give the backend (if it keeps them) the general statistics: a
+        blocking backend gets them with ``write_stats()``, in its thread.
+        If that fails, the error is logged, and we carry on.
+
+        :param args: see DatabaseUsageRecorder.update_stats
+        """
+        if getattr(self.backend, "update_stats", None) is None:
+            return
+        if self._in_thread is None:
+            _update_stats(self.backend, args)
+            return
+        d = self._in_thread(self.backend.write_stats, *args)
+        d.addErrback(log.err, "usage backend {!r} failed to update stats".format(self.backend))
+
+    def flush(self):
+        """
+        Deliver every waiting record now (after the batch being written
+        in a thread, if there is one), and have a blocking backend close
+        the connections it keeps in that thread.
+
+        :returns Deferred: fires when they have all been delivered
+        """
+        if self._write is None:
+            return self._deliver_rest()
+        d = self._write
+        d.addCallback(lambda _: self._deliver_rest())
+        return d
+
+
+class UsageFlushService(Service):
+    """
+    Delivers the records still queued for the backends when we stop.
+    """
+
+    def __init__(self, tracker):
+        self._tracker = tracker
+
+    def stopService(self):
+        Service.stopService(self)
+        return self._tracker.flush()
 
 
 class UsageTracker(object):
@@ -129,21 +557,54 @@ class UsageTracker(object):
     Tracks usage statistics of connections
     """
 
-    def __init__(self, blur_usage):
+    def __init__(self, blur_usage, sampler=None, reactor=None, in_thread=None):
         """
         :param int blur_usage: None or the number of seconds to use as a
             window around which to blur time statistics (e.g. "60" means times
             will be rounded to 1 minute intervals). When blur_usage is
             non-zero, sizes will also be rounded into buckets of "one
             megabyte", "one gigabyte" or "lots"
+
+        :param sampler: None to send every record to the backends, or a
+            UsageSampler to only send some of them. Exact per-mood
+            totals are kept either way, and written to the database
+            with the other statistics when sampling.
+
+        :param reactor: None to give each record to every backend right
+            away, or a reactor to queue them for each backend (see
+            BackendQueue)
+
+        :param in_thread: how a BackendQueue runs a blocking backend in a
+            thread (by default, in a thread of our own, always the same one)
         """
         self._backends = set()
+        self._reactor = reactor
+        self._writer = None # our ThreadPool, once a blocking backend needs it
+        if in_thread is None and reactor is not None:
+            in_thread = self._in_writer_thread
+        self._in_thread = in_thread
+        self._queues = [] # BackendQueue, if we have a reactor
         self._blur_usage = blur_usage
+        self._sampler = sampler
+        self._totals = {} # mood -> [connections, total_bytes]
         if blur_usage:
             log.msg("blurring access times to %d seconds" % self._blur_usage)
         else:
             log.msg("not blurring access times")
 
+    def _in_writer_thread(self, f, *args):
+        """
+        Run ``f(*args)`` in our own thread (rather than the reactor's
+        pool): the blocking backends keep their sqlite3 connections
+        between batches, and those may only be used from the thread that
+        opened them.
+        """
+        if self._writer is None:
+            self._writer = ThreadPool(1, 1, "usage-writer")
+            self._writer.start()
+            self._reactor.addSystemEventTrigger("during", "shutdown", self._writer.stop)
+        return deferToThreadPool(self._reactor, self._writer, f, *args)
+
     def add_backend(self, backend):
         """
         Add a new backend.
@@ -151,6 +612,19 @@ class UsageTracker(object):
         :param IUsageWriter backend: the backend to add
         """
         self._backends.add(backend)
+        if self._reactor is not None:
+            in_thread = self._in_thread if getattr(backend, "blocking", False) else None
+            self._queues.append(BackendQueue(backend, self._reactor, in_thread=in_thread))
+
+    def get_backend(self, kind):
+        """
+        :returns: one of our backends which is an instance of ``kind``,
+            or None
+        """
+        for backend in self._backends:
+            if isinstance(backend, kind):
+                return backend
+        return None
 
     def record(self, started, buddy_started, result, bytes_sent, buddy_bytes):
         """
@@ -182,6 +656,18 @@ class UsageTracker(object):
             # we're recording what the state-machine remembered in any
             # case
 
+        totals = self._totals.get(result)
+        if totals is None:
+            totals = self._totals[result] = [0, 0]
+        totals[0] += 1
+        totals[1] += total_bytes or 0
+
+        weight = 1
+        if self._sampler is not None:
+            weight = self._sampler.weight(result)
+            if not weight:
+                return
+
         if self._blur_usage:
             started = self._blur_usage * (started // self._blur_usage)
             total_bytes = blur_size(total_bytes)
@@ -195,8 +681,17 @@ class UsageTracker(object):
             "waiting_time": waiting_time,
             "total_bytes": total_bytes,
             "mood": result,
+            "weight": weight,
         })
 
+    def get_totals(self):
+        """
+        :returns dict: mood -> (connections, total_bytes), exact (even
+            if sampling), since startup or (when sampling) since they
+            were last written to the database
+        """
+        return dict((mood, tuple(t)) for (mood, t) in self._totals.items())
+
     def update_stats(self, rebooted, updated, connected, waiting,
                      incomplete_bytes):
         """
@@ -204,26 +699,74 @@ class UsageTracker(object):
         """
         # in original code, this is only recorded in the database
         # .. perhaps a better way to do this, but ..
-        for backend in self._backends:
-            if isinstance(backend, DatabaseUsageRecorder):
-                backend._db.execute("DELETE FROM `current`")
-                backend._db.execute(
-                    "INSERT INTO `current`"
-                    " (`rebooted`, `updated`, `connected`, `waiting`,"
-                    "  `incomplete_bytes`)"
-                    " VALUES (?, ?, ?, ?, ?)",
-                    (int(rebooted), int(updated), connected, waiting,
-                     incomplete_bytes)
-                )
+        totals = self.get_totals() if self._sampler is not None else None
+        args = (rebooted, updated, connected, waiting, incomplete_bytes, totals)
+        if self._reactor is not None:
+            for queue in self._queues:
+                queue.update_stats(*args)
+        else:
+            for backend in self._backends:
+                # (the DatabaseUsageRecorders, and a usagehelper.UsageHelper
+                # which has them in another process)
+                if getattr(backend, "update_stats", None) is not None:
+                    _update_stats(backend, args)
+        if self._sampler is not None:
+            self._totals = {}
+
+    def get_counters(self):
+        """
+        :returns dict: ``usage_dropped``, the records our backends fell
+            too far behind to get, and ``usage_failed``, the records one
+            raised an exception for
+        """
+        return {
+            # (a usagehelper.UsageHelper counts the records it loses too)
+            "usage_dropped": (sum(q.dropped for q in self._queues)
+                              + sum(getattr(b, "dropped", 0) for b in self._backends)),
+            "usage_failed": sum(q.failed for q in self._queues),
+        }
+
+    def flush(self):
+        """
+        Deliver every queued record now.
+
+        :returns Deferred: fires when they have all been delivered
+        """
+        return gatherResults([queue.flush() for queue in self._queues])
 
     def _notify_backends(self, data):
         """
         Internal helper. Tell every backend we have about a new usage record.
         """
+        if self._reactor is not None:
+            for queue in self._queues:
+                queue.put(data)
+            return
         for backend in self._backends:
             backend.record_usage(**data)
 
 
+def _update_stats(backend, args):
+    """
+    Call ``backend.update_stats(*args)`` from the reactor, logging (rather
+    than raising) any error: this runs from a TimerService, which would
+    stop calling us after an exception.
+    """
+    try:
+        backend.update_stats(*args)
+    except Exception:
+        log.err(Failure(), "usage backend {!r} failed to update stats".format(backend))
+
+
+def _ms(seconds):
+    """
+    Durations are stored in the database as integer milliseconds.
+    """
+    if seconds is None:
+        return None
+    return int(round(seconds * 1000))
+
+
 def round_to(size, coarseness):
     return int(coarseness*(1+int((size-1)/coarseness)))
 
@@ -0,0 +1,318 @@
+"""
+Recording usage from a separate process.
+
+With --usage-helper, the --usage-db= database and the --log-fd= file are
+written by a child process (``python -m wormhole_transit_relay.usagehelper``)
+instead of the relay itself, so the SQLite work and JSON encoding don't
+compete with relaying for the relay's GIL. The relay's UsageHelper packs
+each record into a few dozen bytes with ``struct``, and writes whatever
+has accumulated to the child's stdin every INTERVAL seconds.
+
+Nothing the child does can stop the relay: if the pipe is full the
+records wait (up to MAX_QUEUED of them, then the oldest are dropped), and
+if the child exits every record from then on is dropped. Either way they
+are counted, in ``usage_dropped``.
+"""
+
+import argparse
+import math
+import os
+import struct
+import sys
+import traceback
+from collections import deque
+
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+from zope.interface import implementer
+
+from .database import get_db, get_partitioned_db
+from .usage import (
+    IUsageWriter,
+    DatabaseUsageRecorder,
+    PartitionedDatabaseUsageRecorder,
+    LogFileUsageRecorder,
+)
+
+# every record is a frame: its length, then the record
+_FRAME = struct.Struct("<H")
+_USAGE = b"U"
+_STATS = b"S"
+# (after the tag) started, total_time, waiting_time (NaN for None),
+# total_bytes, weight; then the mood
+_USAGE_FIELDS = struct.Struct("<dddQI")
+# (after the tag) rebooted, updated, connected, waiting,
+# incomplete_bytes, number of totals (0xffff for None); then the totals
+_STATS_FIELDS = struct.Struct("<ddIIQH")
+# connections, total_bytes, length of the mood; then the mood
+_TOTAL_FIELDS = struct.Struct("<QQB")
+_NO_TOTALS = 0xffff
+
+
+def _frame(payload):
+    return _FRAME.pack(len(payload)) + payload
+
+
+def encode_usage(started, total_time, waiting_time, total_bytes, mood, weight):
+    """
+    :returns bytes: one framed usage record (see IUsageWriter)
+    """
+    return _frame(_USAGE + _USAGE_FIELDS.pack(
+        started,
+        total_time or 0.0,
+        math.nan if waiting_time is None else waiting_time,
+        int(total_bytes or 0),
+        weight,
+    ) + mood.encode("ascii"))
+
+
+def encode_stats(rebooted, updated, connected, waiting, incomplete_bytes, totals):
+    """
+    :returns bytes: one framed statistics update (see
+        DatabaseUsageRecorder.update_stats)
+    """
+    parts = [_STATS, _STATS_FIELDS.pack(
+        rebooted, updated, connected, waiting, incomplete_bytes,
+        _NO_TOTALS if totals is None else len(totals),
+    )]
+    for mood, (connections, total_bytes) in (totals or {}).items():
+        name = mood.encode("ascii")
+        parts.append(_TOTAL_FIELDS.pack(connections, int(total_bytes), len(name)) + name)
+    return _frame(b"".join(parts))
+
+
+def decode(payload):
+    """
+    :returns: ("record_usage", kwargs) or ("update_stats", kwargs)
+    """
+    tag, body = payload[:1], payload[1:]
+    if tag == _USAGE:
+        (started, total_time, waiting_time, total_bytes, weight) = \
+            _USAGE_FIELDS.unpack_from(body)
+        return ("record_usage", dict(
+            started=started,
+            total_time=total_time,
+            waiting_time=None if math.isnan(waiting_time) else waiting_time,
+            total_bytes=total_bytes,
+            mood=body[_USAGE_FIELDS.size:].decode("ascii"),
+            weight=weight,
+        ))
+    if tag == _STATS:
+        (rebooted, updated, connected, waiting, incomplete_bytes, count) = \
+            _STATS_FIELDS.unpack_from(body)
+        offset = _STATS_FIELDS.size
+        totals = None
+        if count != _NO_TOTALS:
+            totals = {}
+            for _ in range(count):
+                (connections, total_bytes, length) = _TOTAL_FIELDS.unpack_from(body, offset)
+                offset += _TOTAL_FIELDS.size
+                mood = body[offset:offset + length].decode("ascii")
+                offset += length
+                totals[mood] = (connections, total_bytes)
+        return ("update_stats", dict(
+            rebooted=rebooted,
+            updated=updated,
+            connected=connected,
+            waiting=waiting,
+            incomplete_bytes=incomplete_bytes,
+            totals=totals,
+        ))
+    raise ValueError("unknown record type {!r}".format(tag))
+
+
+def read_frames(f):
+    """
+    :returns: a generator of the payloads of the frames in binary file
+        ``f``, until it ends
+    """
+    while True:
+        header = f.read(_FRAME.size)
+        if len(header) < _FRAME.size:
+            return
+        (length,) = _FRAME.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            return
+        yield payload
+
+
+@implementer(IUsageWriter)
+class UsageHelper(Service):
+    """
+    I run the usage backends in a child process, and send it the records
+    given to me.
+    """
+
+    # frames waiting for the child before we start dropping the oldest
+    MAX_QUEUED = 10000
+    # seconds between writes to the child
+    INTERVAL = 0.1
+
+    def __init__(self, reactor, args, child_fds=()):
+        """
+        :param list args: command-line arguments for the child (see
+            main())
+
+        :param child_fds: file descriptors of ours the child should have
+            too (like the --log-fd= one)
+        """
+        self._reactor = reactor
+        self._args = list(args)
+        self._child_fds = tuple(child_fds)
+        self._queue = deque(maxlen=self.MAX_QUEUED)
+        self._transport = None
+        self._paused = False
+        self._call = None
+        self._ended = False
+        self._waiting = [] # Deferreds for the child exiting
+        self.dropped = 0
+
+    def startService(self):
+        Service.startService(self)
+        child_fds = {0: "w", 1: 1, 2: 2}
+        for fd in self._child_fds:
+            child_fds[fd] = fd
+        self._reactor.spawnProcess(
+            _HelperProtocol(self),
+            sys.executable,
+            [sys.executable, "-m", "wormhole_transit_relay.usagehelper"] + self._args,
+            env=os.environ,
+            childFDs=child_fds,
+        )
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._ended or self._transport is None:
+            return succeed(None)
+        self._flush()
+        # the child writes what it has, and exits
+        self._transport.closeStdin()
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def record_usage(self, started=None, total_time=None, waiting_time=None, total_bytes=None, mood=None, weight=1):
+        """
+        IUsageWriter.
+        """
+        self._put(encode_usage(started, total_time, waiting_time, total_bytes, mood, weight))
+
+    def update_stats(self, rebooted, updated, connected, waiting,
+                     incomplete_bytes, totals=None):
+        """
+        See DatabaseUsageRecorder.update_stats
+        """
+        self._put(encode_stats(rebooted, updated, connected, waiting,
+                               incomplete_bytes, totals))
+
+    def _put(self, frame):
+        if self._ended:
+            self.dropped += 1
+            return
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(frame)
+        if self._call is None:
+            self._call = self._reactor.callLater(self.INTERVAL, self._flush)
+
+    def _flush(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        if self._transport is None or self._paused or not self._queue:
+            return
+        data = b"".join(self._queue)
+        self._queue.clear()
+        self._transport.write(data)
+
+    # IPushProducer, for the pipe to the child
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._flush()
+
+    def stopProducing(self):
+        self._paused = True
+
+    # from _HelperProtocol
+
+    def _started(self, transport):
+        self._transport = transport
+        transport.registerProducer(self, True)
+        self._flush()
+
+    def _ended_with(self, reason):
+        self._ended = True
+        self._transport = None
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self.running:
+            log.msg("usage helper exited ({}), dropping usage records from now on".format(
+                reason.getErrorMessage()))
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+
+class _HelperProtocol(ProcessProtocol):
+    def __init__(self, helper):
+        self._helper = helper
+
+    def connectionMade(self):
+        self._helper._started(self.transport)
+
+    def processEnded(self, reason):
+        self._helper._ended_with(reason)
+
+
+def backends_from_args(args):
+    """
+    :returns list: the usage backends that the child's ``args`` ask for
+    """
+    backends = []
+    if args.usage_db is not None:
+        if args.usage_db_partition is not None:
+            backends.append(PartitionedDatabaseUsageRecorder(
+                get_partitioned_db(args.usage_db, args.usage_db_partition)))
+        else:
+            backends.append(DatabaseUsageRecorder(get_db(args.usage_db)))
+    if args.log_fd is not None:
+        backends.append(LogFileUsageRecorder(os.fdopen(args.log_fd, "w")))
+    return backends
+
+
+def main(argv=None, stdin=None):
+    """
+    The child: read records from stdin until it closes, and give them to
+    the backends.
+    """
+    parser = argparse.ArgumentParser(
+        description="write a Transit Relay's usage records (see --usage-helper)")
+    parser.add_argument("--usage-db")
+    parser.add_argument("--usage-db-partition")
+    parser.add_argument("--log-fd", type=int)
+    args = parser.parse_args(argv)
+    backends = backends_from_args(args)
+    for payload in read_frames(stdin or sys.stdin.buffer):
+        method, kwargs = decode(payload)
+        for backend in backends:
+            try:
+                getattr(backend, method, lambda **kwargs: None)(**kwargs)
+            except Exception:
+                # (the relay sees this on its stderr)
+                traceback.print_exc()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())